@@ -1,12 +1,67 @@
 # app/__init__.py
 '''App Initialisation'''
+import os
 from flask import Flask
+from .encryption import DEFAULT_COMPRESSION, AGGREGATE_VALUE_BITS
+from .store import configure_compression
+from .keys import DEFAULT_POOL_SIZE, DEFAULT_ROTATION_POOL_SIZE, configure_pool
+from .jobs import DEFAULT_JOB_WORKERS, DEFAULT_QUEUE_DEPTH, configure_jobs
+from .metrics import set_enabled
+from .tuning import load_profile
+from .sharding import DEFAULT_SHARD_TIMEOUT
+from .bulk import INGEST_BATCH_SIZE
 from .routes import main
 
 
-def create_app():
-    '''Create app function'''
+def create_app(config=None):
+    '''
+    Create app function
+
+    Args:
+        config: mapping of settings applied before the defaults below, so settings
+            that are applied at startup (pool sizes, job workers, ...) can be overridden
+    '''
     app = Flask(__name__)
+    app.config.from_mapping(config or {})
+    # Codec for ciphertexts returned to clients, one of app.encryption.COMPRESSION_MODES
+    app.config.setdefault('CIPHERTEXT_COMPRESSION', DEFAULT_COMPRESSION)
+    # Codec for records written to the stores; readers accept every mode
+    app.config.setdefault('STORE_COMPRESSION', app.config['CIPHERTEXT_COMPRESSION'])
+    configure_compression(app.config['STORE_COMPRESSION'])
+    # Bits kept for aggregate values when returned ciphertexts are mod-switched down,
+    # taken from the tuning profile when the keys were generated by app.tuning
+    profile = load_profile()
+    app.config.setdefault('AGGREGATE_VALUE_BITS', profile['value_bits'] if profile else AGGREGATE_VALUE_BITS)
+    # Contexts kept per pool (public and secret, PHE_CONTEXT_POOL_SIZE), contexts kept per
+    # pool of contexts holding the rotation keys (PHE_ROTATION_POOL_SIZE) and seconds a
+    # request waits for one. The keys are checked once here rather than on every checkout.
+    app.config.setdefault('CONTEXT_POOL_SIZE', int(os.environ.get('PHE_CONTEXT_POOL_SIZE', DEFAULT_POOL_SIZE)))
+    app.config.setdefault('ROTATION_POOL_SIZE',
+                          int(os.environ.get('PHE_ROTATION_POOL_SIZE', DEFAULT_ROTATION_POOL_SIZE)))
+    app.config.setdefault('CONTEXT_CHECKOUT_TIMEOUT', 30)
+    if not configure_pool(app.config['CONTEXT_POOL_SIZE'], app.config['ROTATION_POOL_SIZE']):
+        print("Encryption keys unavailable; requests needing a context will fail")
+    # Background job threads (PHE_JOB_WORKERS) and jobs allowed to wait for one
+    # (PHE_JOB_QUEUE_DEPTH), see app.jobs
+    app.config.setdefault('JOB_WORKERS', int(os.environ.get('PHE_JOB_WORKERS', DEFAULT_JOB_WORKERS)))
+    app.config.setdefault('JOB_QUEUE_DEPTH', int(os.environ.get('PHE_JOB_QUEUE_DEPTH', DEFAULT_QUEUE_DEPTH)))
+    configure_jobs(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_DEPTH'])
+    # Hot-path timers behind /metrics, and a JSON log line of every request's stages
+    app.config.setdefault('METRICS_ENABLED', True)
+    app.config.setdefault('TRACE_REQUESTS', False)
+    set_enabled(app.config['METRICS_ENABLED'])
+    # Worker node base URLs for /sharded_aggregation (comma separated in PHE_SHARD_URLS),
+    # and the store a worker node aggregates for /shard/aggregate (the row store if None)
+    shard_urls = os.environ.get('PHE_SHARD_URLS', '')
+    app.config.setdefault('SHARD_URLS', [url.strip() for url in shard_urls.split(',') if url.strip()])
+    app.config.setdefault('SHARD_TIMEOUT', DEFAULT_SHARD_TIMEOUT)
+    app.config.setdefault('SHARD_DATA_PATH', None)
+    # Records per append of POST /records/bulk, seconds it, /encrypt_all and DELETE /records
+    # wait for another ingest into the same store to finish and the Retry-After they answer
+    # with when it does not finish in time
+    app.config.setdefault('BULK_BATCH_SIZE', INGEST_BATCH_SIZE)
+    app.config.setdefault('BULK_LOCK_TIMEOUT', 5)
+    app.config.setdefault('BULK_RETRY_AFTER', 10)
     app.register_blueprint(main)
 
     return app
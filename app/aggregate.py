@@ -0,0 +1,129 @@
+'''Homomorphic Aggregation Module'''
+import os
+from app.encryption import (
+    add_encrypted,
+    deserialised_bytes,
+)
+from app.keys import get_context, worker_pool
+from app import metrics
+from app.store import STORE_COMPRESSION, read_header, record_count, iter_records
+
+# Partitions smaller than this are not worth shipping to a worker process
+MIN_PARTITION_SIZE = 64
+
+# Public Pyfhel context owned by each worker process
+_worker_encryption_obj = None
+
+
+def _init_worker():
+    '''
+    Loads the public context once per worker process.
+    '''
+    global _worker_encryption_obj
+    _worker_encryption_obj = get_context()
+
+def tree_sum(ciphertexts):
+    '''
+    Sums ciphertexts with a pairwise tree reduction, so the result is always a
+    ciphertext and the reduction depth is log2(len(ciphertexts)).
+    The input is consumed as a stream; at most log2(n) partial sums are held at once.
+
+    Args:
+        ciphertexts: iterable of PyCtxt objects
+
+    Returns:
+        PyCtxt: the homomorphic sum, or None if the iterable is empty
+    '''
+    # stack holds (height, partial sum) pairs with strictly decreasing heights
+    stack = []
+    for ciphertext in ciphertexts:
+        height = 0
+        while stack and stack[-1][0] == height:
+            _, partial = stack.pop()
+            ciphertext = add_encrypted(partial, ciphertext)
+            height += 1
+        stack.append((height, ciphertext))
+
+    if not stack:
+        return None
+    _, total = stack.pop()
+    while stack:
+        _, partial = stack.pop()
+        total = add_encrypted(partial, total)
+    return total
+
+def _sum_partition(path, start, stop):
+    '''
+    Sums records [start, stop) of the store inside a worker process and returns
+    the partial sum as bytes.
+    '''
+    ciphertexts = (ciphertext for _, ciphertext in iter_records(path, _worker_encryption_obj, start, stop))
+    partial = tree_sum(ciphertexts)
+    return partial.to_bytes(STORE_COMPRESSION) if partial is not None else None
+
+def partition(n_items, n_partitions):
+    '''
+    Splits range(n_items) into at most n_partitions contiguous, near-equal (start, stop) ranges.
+    '''
+    n_partitions = max(1, min(n_partitions, n_items))
+    size, remainder = divmod(n_items, n_partitions)
+    ranges = []
+    start = 0
+    for index in range(n_partitions):
+        stop = start + size + (1 if index < remainder else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+def _reported(items, sizes, progress):
+    '''
+    Yields items unchanged, calling progress with the running total of their sizes
+    after each one.
+    '''
+    processed = 0
+    for item, size in zip(items, sizes):
+        processed += size
+        if progress is not None:
+            progress(processed)
+        yield item
+
+def parallel_aggregate(path, encryption_obj, workers=None, stop=None, progress=None):
+    '''
+    Homomorphically sums every record of a store (or its first stop record positions)
+    by partitioning it across worker processes. Each worker streams and tree-sums its own range straight from the store,
+    and the partial sums are combined with a final tree reduction in the calling process.
+
+    Args:
+        path: record store written by app.store
+        encryption_obj: Pyfhel object with the public context loaded
+        workers: maximum number of worker processes (defaults to the CPU count)
+        stop: number of record positions to sum (defaults to every record)
+        progress: optional callback called with the number of record positions summed
+            so far, every MIN_PARTITION_SIZE records in process or per finished partition
+
+    Returns:
+        PyCtxt: the homomorphic sum, or None if nothing could be aggregated
+    '''
+    workers = workers or os.cpu_count() or 1
+    n_records = record_count(path) if stop is None else stop
+    n_partitions = min(workers, -(-n_records // MIN_PARTITION_SIZE))
+    if n_partitions <= 1:
+        # Summed in process, MIN_PARTITION_SIZE records at a time so progress can be reported
+        batches = partition(n_records, -(-n_records // MIN_PARTITION_SIZE))
+        partials = (
+            tree_sum(ciphertext for _, ciphertext in iter_records(path, encryption_obj, start, stop))
+            for start, stop in batches
+        )
+        partials = _reported(partials, [stop - start for start, stop in batches], progress)
+        return tree_sum(partial for partial in partials if partial is not None)
+
+    ranges = partition(n_records, n_partitions)
+    starts, stops = zip(*ranges)
+    mod_level = read_header(path).mod_level
+    with worker_pool(n_partitions, _init_worker) as executor:
+        partials = metrics.merged(executor.map(metrics.measured(_sum_partition), [path] * n_partitions,
+                                               starts, stops))
+        partials = _reported(partials, [stop - start for start, stop in ranges], progress)
+        return tree_sum(
+            deserialised_bytes(partial, encryption_obj, mod_level) for partial in partials if partial is not None
+        )
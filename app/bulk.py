@@ -0,0 +1,204 @@
+'''Bulk Ingest Module
+
+Lets data owners push records they encrypted themselves, so the server never sees
+the plaintext. A batch is streamed as raw bytes in the record framing of app.store,
+with no JSON or base64 around the ciphertexts:
+
+    header:  BATCH_MAGIC (8 bytes) | version (uint16) | context fingerprint (32 bytes)
+             | mod level (uint16)
+    record:  Record ID (int64) | keys length (uint32) | payload length (uint32)
+             | plaintext keys (UTF-8 JSON object, may be empty) | payload (to_bytes() output)
+    ...      records follow until the end of the stream
+
+The fingerprint must match the server's context and public key, and the mod level
+must be the level of the target store. Every record is loaded under the context, which
+rejects ciphertexts of any other parameter set, and added to a zero ciphertext at the
+store level, which rejects ciphertexts at any other level. The original bytes are
+written unchanged, INGEST_BATCH_SIZE records per append, and the stream is only read
+as fast as records are validated and written, so a fast client is slowed to disk speed.
+'''
+import json
+import struct
+import threading
+import time
+from app.encryption import context_fingerprint, encrypt_value, deserialised_bytes, mod_switch_to_level
+from app.store import RECORD_HEADER, create_store, read_header, check_fingerprint, append_records
+
+BATCH_MAGIC = b'PHEBATCH'
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct('<8sH32sH')
+
+# Records validated before each append to the store
+INGEST_BATCH_SIZE = 256
+
+# Largest plaintext keys object and ciphertext payload accepted per record
+MAX_KEYS_LENGTH = 64 * 1024
+MAX_PAYLOAD_LENGTH = 64 * 1024 * 1024
+
+# One ingest per store at a time; appends from two streams would interleave
+_ingest_locks = {}
+_lock = threading.Lock()
+
+
+def batch_header(encryption_obj, mod_level):
+    '''
+    Returns the header of a batch of records encrypted under encryption_obj at mod_level.
+    '''
+    return BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, context_fingerprint(encryption_obj), mod_level)
+
+def batch_record(record_id, payload, keys=None):
+    '''
+    Frames one record of a batch.
+
+    Args:
+        record_id: Record ID
+        payload: to_bytes() output of the ciphertext at the batch's mod level
+        keys: optional dict of plaintext grouping keys
+    '''
+    key_bytes = json.dumps(keys, ensure_ascii=False).encode('utf-8') if keys else b''
+    return RECORD_HEADER.pack(int(record_id), len(key_bytes), len(payload)) + key_bytes + payload
+
+def write_batch(file, encryption_obj, records, mod_level, compression='zstd'):
+    '''
+    Writes a batch to a binary file-like object, switching each ciphertext down to mod_level.
+
+    Args:
+        records: iterable of (Record ID, PyCtxt), optionally followed by a dict of plaintext keys
+
+    Returns:
+        int: number of records written
+    '''
+    file.write(batch_header(encryption_obj, mod_level))
+    n_records = 0
+    for record_id, ciphertext, *keys in records:
+        payload = mod_switch_to_level(encryption_obj, ciphertext, mod_level).to_bytes(compression)
+        file.write(batch_record(record_id, payload, keys[0] if keys else None))
+        n_records += 1
+    return n_records
+
+def _read_exactly(stream, n_bytes):
+    '''
+    Reads n_bytes from a stream, returning fewer only at the end of the stream.
+    '''
+    chunks = []
+    while n_bytes > 0:
+        chunk = stream.read(n_bytes)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
+
+def read_batch_header(stream):
+    '''
+    Reads the header of a batch.
+    Raises ValueError if it is not a batch of a supported version.
+
+    Returns:
+        Tuple: (context fingerprint, mod level)
+    '''
+    data = _read_exactly(stream, BATCH_HEADER.size)
+    if len(data) != BATCH_HEADER.size:
+        raise ValueError("Batch header is truncated")
+    magic, version, fingerprint, mod_level = BATCH_HEADER.unpack(data)
+    if magic != BATCH_MAGIC:
+        raise ValueError("Not a record batch")
+    if version != BATCH_VERSION:
+        raise ValueError(f"Unsupported batch version {version}")
+    return fingerprint, mod_level
+
+def iter_batch_records(stream):
+    '''
+    Streams (Record ID, keys dict, payload bytes) from a batch after its header.
+    Raises ValueError on a truncated or oversized record.
+    '''
+    while True:
+        header = _read_exactly(stream, RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) != RECORD_HEADER.size:
+            raise ValueError("Record header is truncated")
+        record_id, key_length, payload_length = RECORD_HEADER.unpack(header)
+        if key_length > MAX_KEYS_LENGTH or payload_length > MAX_PAYLOAD_LENGTH:
+            raise ValueError(f"Record ID {record_id} is larger than allowed")
+        data = _read_exactly(stream, key_length + payload_length)
+        if len(data) != key_length + payload_length:
+            raise ValueError(f"Record ID {record_id} is truncated")
+        keys = json.loads(data[:key_length]) if key_length else {}
+        if not isinstance(keys, dict):
+            raise ValueError(f"Keys of Record ID {record_id} are not an object")
+        yield record_id, keys, data[key_length:]
+
+def ingest_lock(path):
+    '''
+    Returns the lock serialising ingests into the store at path.
+    '''
+    with _lock:
+        return _ingest_locks.setdefault(path, threading.Lock())
+
+def prepare_store(path, encryption_obj, mod_level, replace=False):
+    '''
+    Returns the mod level of the store bulk records are appended to, creating the
+    store at mod_level if it is missing or replace is set.
+    Raises ValueError if the store was written under a different context.
+    '''
+    if not replace:
+        try:
+            return check_fingerprint(path, encryption_obj).mod_level
+        except FileNotFoundError:
+            pass
+    create_store(path, encryption_obj, mod_level)
+    return read_header(path).mod_level
+
+def ingest_records(path, encryption_obj, stream, mod_level, batch_size=INGEST_BATCH_SIZE):
+    '''
+    Validates the records of a streamed batch and appends them to a store.
+    The caller must hold ingest_lock(path) and have read the batch header.
+    Records are appended batch_size at a time, so when a record is invalid the
+    batches before it stay in the store; the error says how many were appended.
+
+    Args:
+        path: record store prepared with prepare_store
+        encryption_obj: Pyfhel object with the public context loaded
+        stream: binary stream positioned after the batch header
+        mod_level: mod level of the store, which every record must be at
+        batch_size: records per append
+
+    Returns:
+        Dict: records appended, payload bytes, elapsed seconds and records/sec
+
+    Raises:
+        ValueError: on a truncated or invalid record
+    '''
+    start_time = time.perf_counter()
+    # Adding a record to a zero ciphertext at the store level fails unless the record is at that level
+    probe = mod_switch_to_level(encryption_obj, encrypt_value(encryption_obj, 0.0), mod_level)
+    n_records = 0
+    n_bytes = 0
+    pending = []
+    try:
+        for record_id, keys, payload in iter_batch_records(stream):
+            ciphertext = deserialised_bytes(payload, encryption_obj, mod_level)
+            if ciphertext is None or ciphertext.size() != 2:
+                raise ValueError(f"Record ID {record_id} is not a valid ciphertext for this context")
+            try:
+                ciphertext + probe
+            except Exception:
+                raise ValueError(f"Record ID {record_id} is not at mod level {mod_level}") from None
+            pending.append((record_id, payload, keys))
+            n_bytes += len(payload)
+            if len(pending) == batch_size:
+                n_records += append_records(path, encryption_obj, pending)
+                pending = []
+        if pending:
+            n_records += append_records(path, encryption_obj, pending)
+    except ValueError as e:
+        raise ValueError(f"{e} ({n_records} records appended)") from None
+
+    elapsed = time.perf_counter() - start_time
+    return {
+        "records": n_records,
+        "bytes": n_bytes,
+        "seconds": elapsed,
+        "records_per_sec": n_records / elapsed if elapsed > 0 else 0.0,
+    }
@@ -0,0 +1,216 @@
+'''Encrypted Aggregate Cache Module
+
+Keeps a running homomorphic sum of a record store together with the watermark
+(number of record positions) it covers. Appended records are folded in with one
+addition each, deleted records are taken out with sub_encrypted, and the sum is
+only recomputed from scratch when the store is recreated or the cache is lost.
+The state is kept in memory and persisted next to the store as '<path>.agg', stamped
+with the context fingerprint of the store it was computed from, so a sum left over
+from previous keys is rebuilt rather than returned.
+
+Each store has its own state lock, held only while the state is read or updated, and
+a scan lock that serialises full rescans of that store. A rescan runs without the
+state lock, so deletions and aggregations of other stores are never blocked behind it;
+if the store changed while it ran, the result is discarded and the scan repeated.
+'''
+import os
+import struct
+import threading
+from app.encryption import add_encrypted, sub_encrypted, deserialised_bytes, context_fingerprint
+from app.aggregate import tree_sum, parallel_aggregate
+from app.store import (
+    STORE_COMPRESSION,
+    read_header,
+    check_fingerprint,
+    record_count,
+    deleted_positions,
+    find_record,
+    delete_record,
+    iter_records,
+)
+
+CACHE_MAGIC = b'PHEAGG02'
+CACHE_HEADER = struct.Struct('<8s32s16sQQI')
+
+# Cached aggregate state per store path, and the (state, scan) locks of each path
+_aggregates = {}
+_path_locks = {}
+_lock = threading.Lock()
+
+
+def cache_path(path):
+    '''
+    Returns the path of the persisted aggregate for a store file.
+    '''
+    return f"{path}.agg"
+
+def _save_state(path, state):
+    '''
+    Persists the aggregate state atomically.
+    '''
+    total = state['total'].to_bytes(STORE_COMPRESSION) if state['total'] is not None else b''
+    temp_path = f"{cache_path(path)}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(CACHE_HEADER.pack(CACHE_MAGIC, state['fingerprint'], state['store_id'],
+                                     state['watermark'], state['n_deleted'], len(total)))
+        file.write(total)
+    os.replace(temp_path, cache_path(path))
+
+def _load_state(path, encryption_obj):
+    '''
+    Loads the persisted aggregate state, or returns None if there is none or it was
+    computed under a different context than encryption_obj.
+    '''
+    try:
+        with open(cache_path(path), 'rb') as file:
+            magic, fingerprint, store_id, watermark, n_deleted, length = \
+                CACHE_HEADER.unpack(file.read(CACHE_HEADER.size))
+            payload = file.read(length)
+    except (FileNotFoundError, struct.error):
+        return None
+    if magic != CACHE_MAGIC or fingerprint != context_fingerprint(encryption_obj):
+        return None
+    total = deserialised_bytes(payload, encryption_obj, read_header(path).mod_level) if length else None
+    if length and total is None:
+        return None
+    return {'fingerprint': fingerprint, 'store_id': store_id, 'watermark': watermark,
+            'n_deleted': n_deleted, 'total': total}
+
+def _current_state(path, encryption_obj):
+    '''
+    Returns the in-memory state, falling back to the persisted one.
+    '''
+    state = _aggregates.get(path)
+    if state is None:
+        state = _load_state(path, encryption_obj)
+    return state
+
+def path_locks(path):
+    '''
+    Returns the (state lock, scan lock) pair of a store path.
+    '''
+    with _lock:
+        return _path_locks.setdefault(path, (threading.Lock(), threading.Lock()))
+
+def _store_version(path):
+    '''
+    Returns (context fingerprint, store id, record positions, deleted records) of a store.
+    '''
+    header = read_header(path)
+    return header.fingerprint, header.store_id, record_count(path), len(deleted_positions(path))
+
+def _is_stale(state, fingerprint, store_id, count, n_deleted):
+    '''
+    Returns True if a cached state cannot be brought up to date by catching up appends.
+    '''
+    return (
+        state is None
+        or state['fingerprint'] != fingerprint
+        or state['store_id'] != store_id
+        or state['watermark'] > count
+        or state['n_deleted'] != n_deleted
+    )
+
+def _catch_up(path, encryption_obj, state, count):
+    '''
+    Adds the records appended since the state's watermark and persists the state.
+    Must be called with the state lock of path held.
+    '''
+    if state['watermark'] < count:
+        appended = tree_sum(
+            ciphertext for _, ciphertext in iter_records(path, encryption_obj, state['watermark'], count)
+        )
+        if appended is not None:
+            state['total'] = appended if state['total'] is None else add_encrypted(state['total'], appended)
+        state['watermark'] = count
+        _save_state(path, state)
+    _aggregates[path] = state
+    return state['total'], state['watermark']
+
+def cached_aggregate(path, encryption_obj, workers=None, refresh=False, progress=None):
+    '''
+    Returns the homomorphic sum of every live record in the store.
+    When the cache is current this is a lookup. When records were appended, only
+    the new ones are added. A full parallel scan only runs if the store was recreated,
+    was changed by another process in a way the cache cannot follow, or refresh is True.
+
+    Args:
+        path: record store written by app.store
+        encryption_obj: Pyfhel object with the public context loaded
+        workers: maximum number of worker processes for a full scan
+        refresh: discard the cached sum and rescan
+        progress: optional callback passed to parallel_aggregate for a full scan
+
+    Returns:
+        Tuple: (PyCtxt sum or None for an empty store, watermark)
+
+    Raises:
+        ValueError: if the store was encrypted under a different context
+    '''
+    check_fingerprint(path, encryption_obj)
+    state_lock, scan_lock = path_locks(path)
+    with state_lock:
+        version = _store_version(path)
+        state = None if refresh else _current_state(path, encryption_obj)
+        if not _is_stale(state, *version):
+            return _catch_up(path, encryption_obj, state, version[2])
+
+    with scan_lock:
+        while True:
+            with state_lock:
+                version = _store_version(path)
+                state = None if refresh else _current_state(path, encryption_obj)
+                if not _is_stale(state, *version):
+                    # Another request finished a rescan while this one waited for the scan lock
+                    return _catch_up(path, encryption_obj, state, version[2])
+            fingerprint, store_id, count, n_deleted = version
+            total = parallel_aggregate(path, encryption_obj, workers=workers, stop=count, progress=progress)
+            with state_lock:
+                current_fingerprint, current_id, current_count, current_deleted = _store_version(path)
+                unchanged = current_fingerprint == fingerprint and current_id == store_id and current_deleted == n_deleted
+                if unchanged and current_count >= count:
+                    state = {'fingerprint': fingerprint, 'store_id': store_id, 'watermark': count,
+                             'n_deleted': n_deleted, 'total': total}
+                    _save_state(path, state)
+                    return _catch_up(path, encryption_obj, state, current_count)
+            # The store was recreated or had records deleted during the scan
+            refresh = False
+
+def remove_record(path, encryption_obj, record_id):
+    '''
+    Deletes a record from the store and subtracts it from the cached sum.
+
+    Returns:
+        True if the record was deleted, False if no live record has that Record ID
+    '''
+    state_lock, _ = path_locks(path)
+    with state_lock:
+        position = find_record(path, record_id)
+        if position is None:
+            return False
+
+        state = _current_state(path, encryption_obj)
+        deleted = deleted_positions(path)
+        header = read_header(path)
+        current = (
+            state is not None
+            and state['fingerprint'] == header.fingerprint == context_fingerprint(encryption_obj)
+            and state['store_id'] == header.store_id
+            and state['n_deleted'] == len(deleted)
+        )
+        if current:
+            if position < state['watermark']:
+                live = state['watermark'] - len([other for other in deleted if other < state['watermark']])
+                if live == 1:
+                    # Subtracting the last record would leave a transparent ciphertext
+                    state['total'] = None
+                else:
+                    _, ciphertext = next(iter_records(path, encryption_obj, position, position + 1))
+                    state['total'] = sub_encrypted(state['total'], ciphertext)
+            state['n_deleted'] += 1
+            _aggregates[path] = state
+            delete_record(path, position)
+            _save_state(path, state)
+        else:
+            delete_record(path, position)
+        return True
@@ -0,0 +1,139 @@
+'''Bulk Decryption Module
+
+Decrypts the row-layout record store in batches straight into preallocated NumPy
+arrays, and turns those batches into CSV or NPY byte chunks that can be streamed to
+a client without building the whole table in memory.
+'''
+import csv
+import io
+import numpy as np
+from app.encryption import decrypt_value
+from app.store import record_count, deleted_positions, iter_records
+
+# Records decrypted into one batch of NumPy arrays
+DEFAULT_BATCH_SIZE = 1024
+
+
+def live_record_count(path):
+    '''
+    Returns the number of records in the store that are not deleted.
+    '''
+    return record_count(path) - len(deleted_positions(path))
+
+def decrypt_batches(path, encryption_obj, n_columns, batch_size=DEFAULT_BATCH_SIZE, strict=False):
+    '''
+    Decrypts the live records of a store into batches of NumPy arrays.
+    The same two buffers are refilled for every batch, so consumers must copy a batch
+    they want to keep past the next iteration.
+
+    Args:
+        path: record store written by app.store
+        encryption_obj: Pyfhel object with the secret key loaded
+        n_columns: number of financial columns (slots) per record
+        batch_size: number of records per batch
+        strict: raise ValueError on the first record that fails to deserialize or
+            decrypt instead of skipping it
+
+    Yields:
+        Tuple: (int64 array of Record IDs, float64 array of shape (rows, n_columns))
+    '''
+    record_ids = np.empty(batch_size, dtype=np.int64)
+    values = np.empty((batch_size, n_columns), dtype=np.float64)
+    n_rows = 0
+    for record_id, ciphertext in iter_records(path, encryption_obj, strict=strict):
+        decrypted_values = decrypt_value(encryption_obj, ciphertext)
+        if decrypted_values is None:
+            if strict:
+                raise ValueError(f"Decryption failed for Record ID: {record_id}")
+            print(f"Decryption failed for Record ID: {record_id}")
+            continue
+        record_ids[n_rows] = record_id
+        values[n_rows] = decrypted_values[:n_columns]
+        n_rows += 1
+        if n_rows == batch_size:
+            yield record_ids, values
+            n_rows = 0
+    if n_rows:
+        yield record_ids[:n_rows], values[:n_rows]
+
+def decrypt_store(path, encryption_obj, n_columns, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Decrypts every live record of a store into one preallocated array.
+
+    Returns:
+        Tuple: (int64 array of Record IDs, float64 array of shape (records, n_columns))
+    '''
+    n_live = live_record_count(path)
+    record_ids = np.empty(n_live, dtype=np.int64)
+    values = np.empty((n_live, n_columns), dtype=np.float64)
+    n_rows = 0
+    for batch_ids, batch_values in decrypt_batches(path, encryption_obj, n_columns, batch_size):
+        record_ids[n_rows:n_rows + len(batch_ids)] = batch_ids
+        values[n_rows:n_rows + len(batch_ids)] = batch_values
+        n_rows += len(batch_ids)
+    return record_ids[:n_rows], values[:n_rows]
+
+def csv_chunks(batches, columns, totals=None, id_column='Record ID'):
+    '''
+    Formats decrypted batches as CSV, yielding the header and then one chunk per batch.
+
+    Args:
+        batches: iterable of (Record IDs, values) as yielded by decrypt_batches
+        columns: names of the financial columns
+        totals: optional float64 array of len(columns) the column sums are added to
+        id_column: name of the Record ID column
+
+    Yields:
+        bytes: UTF-8 encoded CSV
+    '''
+    # Column names may hold commas or quotes, so the header is written with CSV quoting
+    header = io.StringIO()
+    csv.writer(header, lineterminator='\n').writerow([id_column, *columns])
+    yield header.getvalue().encode('utf-8')
+    fmt = ['%d'] + ['%.2f'] * len(columns)
+    for record_ids, values in batches:
+        if totals is not None:
+            totals += values.sum(axis=0)
+        buffer = io.StringIO()
+        np.savetxt(buffer, np.column_stack((record_ids, values)), fmt=fmt, delimiter=',')
+        yield buffer.getvalue().encode('utf-8')
+
+def npy_dtype(columns, id_column='Record ID'):
+    '''
+    Returns the structured dtype of the NPY export: the Record ID and one float64 per column.
+    '''
+    return np.dtype([(id_column, '<i8')] + [(column, '<f8') for column in columns])
+
+def npy_chunks(batches, columns, n_rows, totals=None, id_column='Record ID'):
+    '''
+    Formats decrypted batches as a single NPY file holding a structured array.
+    n_rows must be the number of rows the batches hold, since the header comes first,
+    so the batches should come from decrypt_batches(strict=True): a skipped record
+    would leave the file shorter than its header says.
+    Raises ValueError if the batches hold more or fewer rows than n_rows.
+
+    Yields:
+        bytes: the NPY header followed by one chunk per batch
+    '''
+    dtype = npy_dtype(columns, id_column)
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': (n_rows,),
+    })
+    yield header.getvalue()
+    written = 0
+    for record_ids, values in batches:
+        written += len(record_ids)
+        if written > n_rows:
+            raise ValueError(f"The records hold more than the {n_rows} rows in the NPY header")
+        if totals is not None:
+            totals += values.sum(axis=0)
+        rows = np.empty(len(record_ids), dtype=dtype)
+        rows[id_column] = record_ids
+        for index, column in enumerate(columns):
+            rows[column] = values[:, index]
+        yield rows.tobytes()
+    if written != n_rows:
+        raise ValueError(f"The records hold {written} of the {n_rows} rows in the NPY header")
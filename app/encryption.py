@@ -4,12 +4,51 @@ import os
 import base64
 import pickle
 import gzip
+import hashlib
+import math
+import time
+import weakref
 from Pyfhel import Pyfhel, PyCtxt
+from app.metrics import stage, record_ciphertext
 
-KEY_DIR = os.path.join(os.path.dirname(__file__), '..', 'keys')
+# Key files live in keys/ unless PHE_KEY_DIR points elsewhere (e.g. a benchmark's scratch keys)
+KEY_DIR = os.environ.get('PHE_KEY_DIR', os.path.join(os.path.dirname(__file__), '..', 'keys'))
 
+# Parameters chosen by app.tuning, saved next to the keys they were generated with
+PROFILE_FILE = 'profile.json'
 
-def generate_keys(n_value=2**14, scale_bits=30):
+# Coefficient modulus bit sizes: a 60-bit base prime, one 30-bit prime per rescale and the
+# last prime, which SEAL keeps as the special prime for key switching
+DEFAULT_QI_SIZES = [60, 30, 30, 30, 60]
+
+# Ciphertext serialisation modes: gzip around uncompressed bytes (legacy) or SEAL native compression.
+# SEAL's 'zlib' mode is left out: Pyfhel passes no compression level and it saves nothing over 'none'
+COMPRESSION_MODES = ('gzip', 'zstd', 'none')
+DEFAULT_COMPRESSION = 'zstd'
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Bits reserved for aggregate values when choosing how far a ciphertext can be mod-switched
+AGGREGATE_VALUE_BITS = 40
+MOD_SWITCH_MARGIN_BITS = 10
+
+# Context fingerprints of loaded Pyfhel objects, dropped with the object
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+class DepthExhaustedError(ValueError):
+    '''
+    Raised when a multiplication needs a rescale prime the ciphertext has no level left for.
+    '''
+
+
+class KeyedPyfhel(Pyfhel):
+    '''
+    Pyfhel object loaded from the key files. Unlike the Cython base class it can be
+    weakly referenced, so its context fingerprint is only computed once.
+    '''
+
+
+def generate_keys(n_value=2**14, scale_bits=30, rotation_steps=None, qi_sizes=None):
     '''
     Generates Pyfhel context, public and private keys for CKKS, and saves them to files.
     Returns True if successful, False otherwise.
@@ -17,6 +56,9 @@ def generate_keys(n_value=2**14, scale_bits=30):
     Args:
         n_value: polynomial modulus degree (must be a power of 2)
         scale_bits: bits of precision for the scaling factor
+        rotation_steps: rotation steps to generate keys for. None generates the full
+            power-of-two set in both directions, an empty list skips rotation keys.
+        qi_sizes: bit sizes of the coefficient modulus primes (defaults to DEFAULT_QI_SIZES)
     '''
     try:
         # Ensure the keys directory exists
@@ -31,39 +73,75 @@ def generate_keys(n_value=2**14, scale_bits=30):
                                 #  conversion: x_fix = round(x_float * scale)
                                 #  You can use this as default scale or use a different
                                 #  scale on each operation (set in HE.encryptFrac)
-            'qi_sizes': [60, 30, 30, 30, 60]
+            'qi_sizes': list(qi_sizes or DEFAULT_QI_SIZES)
         }
 
         encryption_obj = Pyfhel()
         encryption_obj.contextGen(**ckks_params)
         encryption_obj.keyGen()
         encryption_obj.relinKeyGen()
-        encryption_obj.rotateKeyGen()
+
+        start_time = time.perf_counter()
+        if rotation_steps is None:
+            encryption_obj.rotateKeyGen()
+        elif rotation_steps:
+            encryption_obj.rotateKeyGen(sorted(set(rotation_steps)))
+        rotate_seconds = time.perf_counter() - start_time
 
         # Save context and keys
         encryption_obj.save_context(os.path.join(KEY_DIR, 'context.pkl'))
         encryption_obj.save_public_key(os.path.join(KEY_DIR, 'public_key.pkl'))
         encryption_obj.save_secret_key(os.path.join(KEY_DIR, 'secret_key.pkl'))
         encryption_obj.save_relin_key(os.path.join(KEY_DIR, 'relin_key.pkl'))
-        encryption_obj.save_rotate_key(os.path.join(KEY_DIR, 'rotate_key.pkl'))
+        rotate_key_path = os.path.join(KEY_DIR, 'rotate_key.pkl')
+        if rotation_steps is None or rotation_steps:
+            rotate_bytes = encryption_obj.save_rotate_key(rotate_key_path)
+        else:
+            # Never leave rotation keys from a previous key set next to the new keys
+            if os.path.exists(rotate_key_path):
+                os.remove(rotate_key_path)
+            rotate_bytes = 0
+        # A tuning profile only describes the keys it was saved with; app.tuning writes a new one
+        profile_path = os.path.join(KEY_DIR, PROFILE_FILE)
+        if os.path.exists(profile_path):
+            os.remove(profile_path)
 
         print(f"CKKS Context and Keys generated and saved to {KEY_DIR}")
+        if rotation_steps is not None:
+            report_rotation_savings(n_value, len(set(rotation_steps)), rotate_seconds, rotate_bytes)
         return True
     except Exception as e:
         print(f"An unexpected error occured: {e}")
         return False
 
-def load_context_public():
+def report_rotation_savings(n_value, n_steps, seconds, n_bytes):
+    '''
+    Prints the time and bytes saved by generating n_steps rotation keys instead of
+    the full power-of-two set (2 * log2(n/2) keys). Per-key cost is assumed uniform.
+    '''
+    full_steps = 2 * (n_value // 2).bit_length() - 2
+    if n_steps:
+        full_seconds = seconds / n_steps * full_steps
+        full_bytes = n_bytes / n_steps * full_steps
+        print(f"Rotation keys: {n_steps}/{full_steps} steps, {n_bytes} bytes in {seconds:.2f}s "
+              f"(saved ~{full_bytes - n_bytes:.0f} bytes, ~{full_seconds - seconds:.2f}s)")
+    else:
+        print(f"Rotation keys: skipped all {full_steps} steps")
+
+def load_context_public(rotate=True):
     '''
     Loads Context and Public keys from files
     Returns a Pyfhel object with public context
+    Rotation keys are optional and only loaded if they were generated and rotate is True
     '''
     try:
-        encryption_obj = Pyfhel()
+        encryption_obj = KeyedPyfhel()
         encryption_obj.load_context(os.path.join(KEY_DIR, 'context.pkl'))
         encryption_obj.load_public_key(os.path.join(KEY_DIR, 'public_key.pkl'))
         encryption_obj.load_relin_key(os.path.join(KEY_DIR, 'relin_key.pkl'))
-        encryption_obj.load_rotate_key(os.path.join(KEY_DIR, 'rotate_key.pkl'))
+        rotate_key_path = os.path.join(KEY_DIR, 'rotate_key.pkl')
+        if rotate and os.path.exists(rotate_key_path):
+            encryption_obj.load_rotate_key(rotate_key_path)
         return encryption_obj
     except FileNotFoundError:
         print("One or more public Pyfhel files not found")
@@ -81,6 +159,27 @@ def load_secret(encryption_obj):
         print("Secret key file not found")
         return None
 
+def context_fingerprint(encryption_obj):
+    '''
+    Returns a SHA-256 fingerprint of the CKKS parameters and public key in the Pyfhel object.
+    Ciphertexts are only usable with a context that has the same fingerprint.
+    The fingerprint of a KeyedPyfhel is memoized, since the keys of a loaded object never
+    change; plain Pyfhel objects are hashed on every call.
+    '''
+    try:
+        return _fingerprints[encryption_obj]
+    except (KeyError, TypeError):
+        pass
+    digest = hashlib.sha256()
+    digest.update(encryption_obj.to_bytes_context('none'))
+    digest.update(encryption_obj.to_bytes_public_key('none'))
+    fingerprint = digest.digest()
+    try:
+        _fingerprints[encryption_obj] = fingerprint
+    except TypeError:
+        pass
+    return fingerprint
+
 def encrypt_value(encryption_obj, value):
     '''
     Encrypts a float using the CKKS scheme in the Pyfhel object.
@@ -93,7 +192,8 @@ def encrypt_value(encryption_obj, value):
         PyCtxt: An encrypted ciphertext of the input float
     '''
     try:
-        ciphertext = encryption_obj.encrypt(value)
+        with stage('encrypt'):
+            ciphertext = encryption_obj.encrypt(value)
         return ciphertext
     except Exception as e:
         print(f"An error occurred while encrypting: {e}")
@@ -111,7 +211,8 @@ def decrypt_value(encryption_obj, ciphertext):
         List: A list where the decrypted value is loacted in the [0] index
     '''
     try:
-        value = encryption_obj.decrypt(ciphertext)
+        with stage('decrypt'):
+            value = encryption_obj.decrypt(ciphertext)
         return value
     except Exception as e:
         print(f"An error occurred while decrypting: {e}")
@@ -127,7 +228,8 @@ def add_encrypted(ciphertext_1, ciphertext_2):
     Returns:
         Sum: PyCtxt object 
     '''
-    return ciphertext_1 + ciphertext_2
+    with stage('add'):
+        return ciphertext_1 + ciphertext_2
 
 def sub_encrypted(ciphertext_1, ciphertext_2):
     '''
@@ -139,7 +241,8 @@ def sub_encrypted(ciphertext_1, ciphertext_2):
     Returns:
         Sum: PyCtxt object 
     '''
-    return ciphertext_1 - ciphertext_2
+    with stage('add'):
+        return ciphertext_1 - ciphertext_2
 
 def multiply_encrypted(encryption_obj, ciphertext_1, ciphertext_2):
     '''
@@ -147,48 +250,140 @@ def multiply_encrypted(encryption_obj, ciphertext_1, ciphertext_2):
 
     Args:
         encryption_obj: Pyfhel object containing the relinearization keys
-        ciphertext_1, ciphertext_2: encrypted PyCtxt Objects
+        ciphertext_1, ciphertext_2: encrypted PyCtxt Objects (ciphertext_2 may also be
+            a PyPtxt encoded at the same mod level)
     
     Returns:
         Product: PyCtxt object after multiplication and relinearization
+
+    Raises:
+        DepthExhaustedError: if the ciphertext is at the last data prime, so the
+            product could not be rescaled
     '''
-    product = ciphertext_1 * ciphertext_2
-    encryption_obj.relinearize(product)
-    encryption_obj.rescale_to_next(product)
+    if rescale_levels(encryption_obj, ciphertext_1) < 1:
+        raise DepthExhaustedError(
+            f"No multiplicative level left at mod level {ciphertext_1.mod_level} of a "
+            f"{len(encryption_obj.qi_sizes)}-prime modulus chain; regenerate the keys with a deeper chain")
+    with stage('multiply'):
+        product = ciphertext_1 * ciphertext_2
+        encryption_obj.relinearize(product)
+        encryption_obj.rescale_to_next(product)
     return product
 
-def serialised_encrypted(ciphertext):
+def ciphertext_bytes(ciphertext, compression=DEFAULT_COMPRESSION):
+    '''
+    Serializes a ciphertext to bytes with one of COMPRESSION_MODES.
+    'gzip' wraps the uncompressed SEAL bytes, the other modes use SEAL's native codecs.
+    Updates the ciphertext size, mod level and scale gauges.
+    '''
+    if compression not in COMPRESSION_MODES:
+        raise ValueError(f"Unknown compression mode '{compression}'")
+    with stage('serialize'):
+        if compression == 'gzip':
+            data = gzip.compress(ciphertext.to_bytes('none'))
+        else:
+            data = ciphertext.to_bytes(compression)
+    record_ciphertext(ciphertext, len(data), compression)
+    return data
+
+def serialised_encrypted(ciphertext, compression=DEFAULT_COMPRESSION):
     '''
     Serializes encrypted data into compressed base64-encoded bytes.
     '''
     try:
-        serialized_bytes = ciphertext.to_bytes()
-        compressed_bytes = gzip.compress(serialized_bytes)
-        encoded_str = base64.b64encode(compressed_bytes).decode('utf-8')
+        serialized_bytes = ciphertext_bytes(ciphertext, compression)
+        with stage('base64'):
+            encoded_str = base64.b64encode(serialized_bytes).decode('utf-8')
         return encoded_str
     except Exception as e:
         print(f"An error occurred during serialization: {e}")
         return None
 
-def deserialised(data, encryption_obj):
+def deserialised(data, encryption_obj, mod_level=0):
     '''
     Deserializes a serialized encrypted data string back into a PyCtxt object.
 
     Args:
         data: Base64-encoded string of the serialized ciphertext.
         encryption_obj: Pyfhel object.
+        mod_level: number of moduli the ciphertext was switched down by before serialization.
 
     Returns:
         PyCtxt: The deserialized ciphertext object, or None if deserialization fails.
     '''
     try:
-        compressed_bytes = base64.b64decode(data)
-        serialized_bytes = gzip.decompress(compressed_bytes)
-        encrypted = PyCtxt(pyfhel=encryption_obj)
-        encrypted.from_bytes(serialized_bytes, 'float')
+        with stage('base64'):
+            serialized_bytes = base64.b64decode(data)
+    except Exception as e:
+        print(f"An error occurred during deserialization: {e}")
+        return None
+    return deserialised_bytes(serialized_bytes, encryption_obj, mod_level)
+
+def deserialised_bytes(data, encryption_obj, mod_level=0):
+    '''
+    Deserializes raw ciphertext bytes back into a PyCtxt object.
+    SEAL records its own compression mode, so only gzip needs to be detected.
+    The mod level is not part of SEAL's serialization and has to be restored by the
+    caller, otherwise Pyfhel mis-aligns the ciphertext with fresh ones on addition.
+
+    Args:
+        data: bytes produced by ciphertext_bytes() or PyCtxt.to_bytes() in any mode.
+        encryption_obj: Pyfhel object.
+        mod_level: number of moduli the ciphertext was switched down by before serialization.
+
+    Returns:
+        PyCtxt: The deserialized ciphertext object, or None if deserialization fails.
+    '''
+    try:
+        if data[:2] == GZIP_MAGIC:
+            with stage('gunzip'):
+                data = gzip.decompress(data)
+        with stage('deserialize'):
+            encrypted = PyCtxt(pyfhel=encryption_obj)
+            encrypted.from_bytes(data, 'float')
+            encrypted.mod_level = mod_level
         return encrypted
     except Exception as e:
         print(f"An error occurred during deserialization: {e}")
         return None
- 
-    
\ No newline at end of file
+
+def lowest_mod_level(encryption_obj, value_bits=AGGREGATE_VALUE_BITS, depth=0):
+    '''
+    Returns how many moduli a ciphertext can be switched down by while still holding
+    values up to 2**value_bits at the context scale after `depth` more rescalings.
+    Addition-only aggregation needs depth 0; every plaintext or ciphertext
+    multiplication a later query applies needs one more level.
+
+    Args:
+        encryption_obj: Pyfhel object with a CKKS context loaded
+        value_bits: bits needed for the largest expected (aggregated) value
+        depth: multiplicative depth the ciphertext must keep
+
+    Returns:
+        int: target mod level (0 keeps the full modulus chain)
+    '''
+    # The last qi is the special prime used for key switching, never part of a ciphertext
+    data_primes = list(encryption_obj.qi_sizes[:-1])
+    needed_bits = math.log2(encryption_obj.scale) + value_bits + MOD_SWITCH_MARGIN_BITS
+    level = 0
+    while level + depth + 1 < len(data_primes) and \
+            sum(data_primes[:len(data_primes) - level - depth - 1]) >= needed_bits:
+        level += 1
+    return level
+
+def rescale_levels(encryption_obj, ciphertext):
+    '''
+    Returns how many more multiplications (one rescale each) a ciphertext has room for.
+    '''
+    # The last qi is the special prime, and a ciphertext at the last data prime cannot be rescaled
+    return len(encryption_obj.qi_sizes) - 2 - ciphertext.mod_level
+
+def mod_switch_to_level(encryption_obj, ciphertext, mod_level):
+    '''
+    Returns a copy of the ciphertext switched down to mod_level, leaving the input untouched.
+    Ciphertexts already at or below that level are copied unchanged.
+    '''
+    switched = ciphertext.copy()
+    while switched.mod_level < mod_level:
+        encryption_obj.mod_switch_to_next(switched)
+    return switched
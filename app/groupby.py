@@ -0,0 +1,120 @@
+'''Group-By Aggregation Module
+
+Sums the row-layout record store per value of one or more plaintext dimensions kept
+next to the Record ID (see app.store). The dimension values are read first without
+touching any ciphertext, groups are hash-partitioned across worker processes, and each
+worker reads only the records of its own groups, so every record is read and added
+exactly once however many groups there are.
+'''
+import os
+import zlib
+from app.encryption import deserialised_bytes
+from app.aggregate import MIN_PARTITION_SIZE, tree_sum
+from app.keys import get_context, worker_pool
+from app import metrics
+from app.store import STORE_COMPRESSION, read_header, read_records, iter_record_keys
+
+# Records read from the store at a time while summing a group
+READ_BATCH_SIZE = 256
+
+# Public Pyfhel context owned by each worker process
+_worker_encryption_obj = None
+
+
+def _init_worker():
+    '''
+    Loads the public context once per worker process.
+    '''
+    global _worker_encryption_obj
+    _worker_encryption_obj = get_context()
+
+def group_key(keys, dimensions):
+    '''
+    Returns the group a record belongs to: its values of the dimensions joined with '|',
+    or None if the record has no value for one of them.
+    '''
+    values = [keys.get(dimension) for dimension in dimensions]
+    if any(value is None for value in values):
+        return None
+    return '|'.join(str(value) for value in values)
+
+def group_positions(path, dimensions):
+    '''
+    Maps every group to the positions of its live records, in store order.
+    Records missing a dimension are left out.
+
+    Returns:
+        Dict: group key -> list of record positions
+    '''
+    groups = {}
+    for position, _, keys in iter_record_keys(path):
+        key = group_key(keys, dimensions)
+        if key is not None:
+            groups.setdefault(key, []).append(position)
+    return groups
+
+def hash_partition(groups, n_partitions):
+    '''
+    Assigns each group to one of n_partitions partitions by a stable hash of its key.
+
+    Returns:
+        List: n_partitions dicts of group key -> positions
+    '''
+    partitions = [{} for _ in range(n_partitions)]
+    for key, positions in groups.items():
+        partitions[zlib.crc32(key.encode('utf-8')) % n_partitions][key] = positions
+    return partitions
+
+def sum_groups(path, encryption_obj, groups):
+    '''
+    Sums the records of each group, reading them in batches of READ_BATCH_SIZE.
+
+    Returns:
+        Dict: group key -> PyCtxt sum
+    '''
+    totals = {}
+    for key, positions in groups.items():
+        def ciphertexts():
+            for start in range(0, len(positions), READ_BATCH_SIZE):
+                yield from read_records(path, encryption_obj, positions[start:start + READ_BATCH_SIZE])
+        totals[key] = tree_sum(ciphertexts())
+    return totals
+
+def _sum_partition(path, groups):
+    '''
+    Sums the groups of one hash partition inside a worker process and returns
+    the group sums as bytes.
+    '''
+    totals = sum_groups(path, _worker_encryption_obj, groups)
+    return {key: total.to_bytes(STORE_COMPRESSION) for key, total in totals.items()}
+
+def group_aggregate(path, encryption_obj, dimensions, workers=None):
+    '''
+    Homomorphically sums the live records of a store per group in a single pass.
+
+    Args:
+        path: record store written by app.store
+        encryption_obj: Pyfhel object with the public context loaded
+        dimensions: plaintext dimension names to group by
+        workers: maximum number of worker processes (defaults to the CPU count)
+
+    Returns:
+        Tuple: (dict of group key -> PyCtxt sum, dict of group key -> number of records)
+    '''
+    groups = group_positions(path, dimensions)
+    counts = {key: len(positions) for key, positions in groups.items()}
+    workers = workers or os.cpu_count() or 1
+    n_records = sum(counts.values())
+    n_partitions = min(workers, len(groups), -(-n_records // MIN_PARTITION_SIZE))
+    if n_partitions <= 1:
+        return sum_groups(path, encryption_obj, groups), counts
+
+    partitions = [partition for partition in hash_partition(groups, n_partitions) if partition]
+    mod_level = read_header(path).mod_level
+    totals = {}
+    with worker_pool(len(partitions), _init_worker) as executor:
+        partials = executor.map(metrics.measured(_sum_partition), [path] * len(partitions), partitions)
+        for partial in metrics.merged(partials):
+            for key, total in partial.items():
+                totals[key] = deserialised_bytes(total, encryption_obj, mod_level)
+    return totals, counts
@@ -0,0 +1,322 @@
+'''Parallel Encryption Module
+
+parallel_encrypt() encrypts a DataFrame that is already in memory. stream_encrypt()
+encrypts a CSV file of any size in constant memory as a pipeline of generators:
+
+    read     the CSV is parsed chunk_size rows at a time against an explicit dtype schema
+    encrypt  at most MAX_PENDING_PER_WORKER chunks per worker process are in flight
+    write    each encrypted chunk is appended to the store in CSV order as it completes
+
+After every append a checkpoint next to the store records how far the CSV has been
+ingested, so an interrupted ingest resumes from the last appended chunk instead of
+starting over.
+'''
+import collections
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from app.encryption import encrypt_value, lowest_mod_level, mod_switch_to_level
+from app.keys import get_context, worker_pool
+from app import metrics
+from app import store
+from app.store import record_bytes, store_compression
+
+DEFAULT_CHUNK_SIZE = 256
+
+# Multiplicative depth kept in stored records for queries that multiply before summing
+STORE_DEPTH = 1
+
+# Chunks submitted to the process pool per worker before waiting for the oldest one
+MAX_PENDING_PER_WORKER = 2
+
+# Rows of a CSV read to infer its schema when none is given
+SCHEMA_SAMPLE_ROWS = 1000
+
+# Public Pyfhel context, store mod level and record compression owned by each worker process
+_worker_encryption_obj = None
+_worker_mod_level = 0
+_worker_compression = None
+
+
+def _init_worker(mod_level=0, compression=None):
+    '''
+    Loads the public context once per worker process.
+    '''
+    global _worker_encryption_obj, _worker_mod_level, _worker_compression
+    _worker_encryption_obj = get_context()
+    _worker_mod_level = mod_level
+    _worker_compression = compression
+
+def _encrypt_chunk(chunk):
+    '''
+    Encrypts one chunk of rows inside a worker process.
+
+    Args:
+        chunk: tuple of a 1-D array of Record IDs, a 2-D float array holding one row
+            of financial values per Record ID and a list of plaintext key dicts
+
+    Returns:
+        List: (Record ID, ciphertext bytes, plaintext keys) tuples in the same order as the input
+    '''
+    record_ids, values, keys = chunk
+    encrypted_rows = []
+    for record_id, financial_values, record_keys in zip(record_ids, values, keys):
+        ciphertext = encrypt_value(_worker_encryption_obj, financial_values)
+        if ciphertext is not None:
+            ciphertext = mod_switch_to_level(_worker_encryption_obj, ciphertext, _worker_mod_level)
+            encrypted_rows.append((record_id, record_bytes(ciphertext, _worker_compression), record_keys))
+        else:
+            print(f"Encryption failed for Record ID: {record_id}")
+    return encrypted_rows
+
+def _encrypt_counted_chunk(chunk):
+    '''
+    Encrypts one chunk of rows inside a worker process.
+
+    Returns:
+        Tuple: (rows in the chunk, encrypted rows as returned by _encrypt_chunk)
+    '''
+    return len(chunk[0]), _encrypt_chunk(chunk)
+
+def bounded_map(executor, function, iterable, max_pending):
+    '''
+    Like executor.map(), but takes items from iterable only while fewer than max_pending
+    are in flight, so a long or lazy iterable is never read far ahead of the results.
+    Results are yielded in submission order.
+    '''
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def dimension_columns(financial_data, id_column='Record ID'):
+    '''
+    Returns the non-numeric columns of a DataFrame, which are kept as plaintext
+    grouping keys instead of being encrypted.
+    '''
+    return [
+        column for column in financial_data.columns
+        if column != id_column and not pd.api.types.is_numeric_dtype(financial_data[column])
+    ]
+
+def split_chunks(financial_data, chunk_size=DEFAULT_CHUNK_SIZE, id_column='Record ID', dimensions=None):
+    '''
+    Splits a DataFrame into (record_ids, values, keys) chunks of at most chunk_size rows,
+    where keys holds one dict of plaintext dimension values per row.
+
+    Args:
+        dimensions: columns kept as plaintext keys (defaults to the non-numeric columns)
+    '''
+    dimensions = dimension_columns(financial_data, id_column) if dimensions is None else list(dimensions)
+    record_ids = financial_data[id_column].to_numpy()
+    values = financial_data.drop(columns=[id_column, *dimensions]).to_numpy(dtype=np.float64)
+    keys = financial_data[dimensions].astype(str).to_dict('records') if dimensions else [{}] * len(record_ids)
+    for start in range(0, len(record_ids), chunk_size):
+        yield record_ids[start:start + chunk_size], values[start:start + chunk_size], keys[start:start + chunk_size]
+
+def parallel_encrypt(financial_data, save_path, encryption_obj, workers=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE, mod_level=None, dimensions=None, backend=store,
+                     progress=None):
+    '''
+    Encrypts a DataFrame row by row on a pool of worker processes.
+    Each worker loads the public context once, chunks are encrypted in parallel and
+    appended to the record store at save_path in their original order as soon as they complete.
+
+    Args:
+        financial_data: pandas DataFrame with a 'Record ID' column and financial columns
+        save_path: record store to (re)create
+        encryption_obj: Pyfhel object with the same public context as the workers
+        workers: number of worker processes (defaults to the CPU count)
+        chunk_size: number of rows sent to a worker at a time
+        mod_level: mod level records are stored at (defaults to the lowest level
+            that still leaves STORE_DEPTH multiplications for aggregate values)
+        dimensions: columns stored as plaintext grouping keys next to the Record ID
+            instead of being encrypted (defaults to the non-numeric columns)
+        backend: store module with create_store and append_records (app.store or app.sqlite_store)
+        progress: optional callable receiving (rows written, total rows) after each chunk
+
+    Returns:
+        Dict: rows written, elapsed seconds and rows/sec throughput
+    '''
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    rows_written = 0
+    if mod_level is None:
+        mod_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+
+    backend.create_store(save_path, encryption_obj, mod_level)
+    chunks = split_chunks(financial_data, chunk_size, dimensions=dimensions)
+    with worker_pool(workers, _init_worker, (mod_level, store_compression())) as executor:
+        encrypted_chunks = bounded_map(executor, metrics.measured(_encrypt_chunk), chunks,
+                                       workers * MAX_PENDING_PER_WORKER)
+        for encrypted_rows in metrics.merged(encrypted_chunks):
+            rows_written += backend.append_records(save_path, encryption_obj, encrypted_rows)
+            if progress is not None:
+                progress(rows_written, len(financial_data))
+
+    elapsed = time.perf_counter() - start_time
+    rows_per_sec = rows_written / elapsed if elapsed > 0 else 0.0
+    print(f"Encrypted {rows_written} rows in {elapsed:.2f}s ({rows_per_sec:.1f} rows/sec) "
+          f"using {workers} workers")
+    return {"rows": rows_written, "seconds": elapsed, "rows_per_sec": rows_per_sec, "workers": workers}
+
+def csv_schema(csv_path, id_column='Record ID'):
+    '''
+    Infers an explicit dtype schema from the first SCHEMA_SAMPLE_ROWS rows of a CSV:
+    int64 for the Record ID, float64 for numeric columns and str for the rest, which
+    are kept as plaintext grouping keys. Rows further down that do not fit the schema
+    make the read fail instead of silently changing a column's type between chunks.
+    '''
+    sample = pd.read_csv(csv_path, nrows=SCHEMA_SAMPLE_ROWS)
+    dimensions = set(dimension_columns(sample, id_column))
+    return {
+        column: 'int64' if column == id_column else str if column in dimensions else 'float64'
+        for column in sample.columns
+    }
+
+def read_csv_chunks(csv_path, schema, chunk_size=DEFAULT_CHUNK_SIZE, skip_rows=0):
+    '''
+    Streams DataFrames of at most chunk_size rows from a CSV, parsed with the given
+    dtype schema, after skipping the first skip_rows data rows.
+    '''
+    reader = pd.read_csv(csv_path, dtype=schema, chunksize=chunk_size,
+                         skiprows=range(1, skip_rows + 1) if skip_rows else None)
+    with reader:
+        yield from reader
+
+def count_csv_rows(csv_path):
+    '''
+    Returns the number of data rows of a CSV by counting its lines in 1 MiB blocks.
+    Quoted values containing newlines are over-counted, so use it for progress only.
+    '''
+    lines = 0
+    last = b'\n'
+    with open(csv_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    return max(0, lines + (last != b'\n') - 1)
+
+def checkpoint_path(save_path):
+    '''
+    Returns the path of the ingest checkpoint that accompanies a store.
+    '''
+    return f"{save_path}.ckpt"
+
+def csv_signature(csv_path):
+    '''
+    Returns the size and modification time of a CSV, which must be unchanged to resume.
+    '''
+    stat = os.stat(csv_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def save_checkpoint(save_path, checkpoint):
+    '''
+    Persists an ingest checkpoint atomically.
+    '''
+    temp_path = f"{checkpoint_path(save_path)}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(checkpoint, file)
+    os.replace(temp_path, checkpoint_path(save_path))
+
+def load_checkpoint(save_path, csv_path, encryption_obj, backend=store):
+    '''
+    Returns the checkpoint of an interrupted ingest of csv_path into save_path, or None
+    if there is none or the store or CSV have changed since it was written.
+    The records field is brought up to date with the store, which may hold a chunk
+    appended after the checkpoint was last saved.
+    '''
+    try:
+        with open(checkpoint_path(save_path), 'r', encoding='utf-8') as file:
+            checkpoint = json.load(file)
+        if backend.store_id(save_path, encryption_obj).hex() != checkpoint['store_id'] or \
+                csv_signature(csv_path) != checkpoint['csv']:
+            print(f"Checkpoint of {save_path} does not match the store or CSV, starting over")
+            return None
+        records = backend.record_count(save_path)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    # Records are appended in CSV order, so any beyond the checkpoint are the rows that follow it
+    checkpoint['rows'] += records - checkpoint['records']
+    checkpoint['records'] = records
+    return checkpoint
+
+def stream_encrypt(csv_path, save_path, encryption_obj, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                   mod_level=None, schema=None, id_column='Record ID', backend=store, resume=False,
+                   progress=None):
+    '''
+    Encrypts a CSV row by row in constant memory and writes it to a record store.
+    Chunks are read, encrypted on a pool of worker processes and appended in CSV order,
+    with at most workers * MAX_PENDING_PER_WORKER chunks held at a time, and the
+    checkpoint is saved after every append and removed once the CSV is done.
+
+    Args:
+        csv_path: CSV with an id_column column, financial columns and optional dimension columns
+        save_path: record store to (re)create, or to resume into
+        encryption_obj: Pyfhel object with the same public context as the workers
+        workers: number of worker processes (defaults to the CPU count)
+        chunk_size: number of rows read, encrypted and appended at a time
+        mod_level: mod level records are stored at (defaults to the lowest level
+            that still leaves STORE_DEPTH multiplications for aggregate values)
+        schema: dict of column -> dtype; 'float64' columns are encrypted, str columns
+            are stored as plaintext keys (defaults to csv_schema())
+        backend: store module (app.store or app.sqlite_store)
+        resume: continue from the checkpoint of an interrupted ingest if it still
+            matches the store and CSV, instead of recreating the store
+        progress: optional callable receiving (rows ingested, estimated total rows) after each chunk
+
+    Returns:
+        Dict: rows ingested by this call, rows skipped as already ingested, elapsed
+        seconds and rows/sec throughput
+    '''
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+    schema = schema or csv_schema(csv_path, id_column)
+    dimensions = [column for column, dtype in schema.items() if column != id_column and dtype is str]
+    total_rows = count_csv_rows(csv_path) if progress is not None else None
+
+    checkpoint = load_checkpoint(save_path, csv_path, encryption_obj, backend) if resume else None
+    if checkpoint is None:
+        if mod_level is None:
+            mod_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+        backend.create_store(save_path, encryption_obj, mod_level)
+        checkpoint = {
+            "store_id": backend.store_id(save_path, encryption_obj).hex(),
+            "csv": csv_signature(csv_path),
+            "mod_level": mod_level,
+            "rows": 0,
+            "records": 0,
+        }
+        save_checkpoint(save_path, checkpoint)
+    else:
+        print(f"Resuming ingest of {csv_path} after {checkpoint['rows']} rows")
+    skipped_rows = checkpoint['rows']
+
+    # Each DataFrame chunk becomes a single (record_ids, values, keys) chunk for the workers
+    chunks = (
+        next(split_chunks(frame, len(frame), id_column, dimensions))
+        for frame in read_csv_chunks(csv_path, schema, chunk_size, skip_rows=skipped_rows)
+    )
+    with worker_pool(workers, _init_worker, (checkpoint['mod_level'], store_compression())) as executor:
+        encrypted_chunks = bounded_map(executor, metrics.measured(_encrypt_counted_chunk), chunks,
+                                       workers * MAX_PENDING_PER_WORKER)
+        for n_rows, encrypted_rows in metrics.merged(encrypted_chunks):
+            checkpoint['records'] += backend.append_records(save_path, encryption_obj, encrypted_rows)
+            checkpoint['rows'] += n_rows
+            save_checkpoint(save_path, checkpoint)
+            if progress is not None:
+                progress(checkpoint['rows'], total_rows)
+    os.remove(checkpoint_path(save_path))
+
+    rows_ingested = checkpoint['rows'] - skipped_rows
+    elapsed = time.perf_counter() - start_time
+    rows_per_sec = rows_ingested / elapsed if elapsed > 0 else 0.0
+    print(f"Encrypted {rows_ingested} rows from {csv_path} in {elapsed:.2f}s ({rows_per_sec:.1f} rows/sec) "
+          f"using {workers} workers")
+    return {"rows": rows_ingested, "skipped_rows": skipped_rows, "seconds": elapsed,
+            "rows_per_sec": rows_per_sec, "workers": workers}
@@ -0,0 +1,209 @@
+'''Background Job Module
+
+Runs long scans (encryption, aggregation, bulk decryption) on a bounded pool of
+background threads, so a request only submits the job and polls it for progress
+instead of holding a connection open for the whole scan. At most queue_depth jobs
+wait for a thread beyond the ones running. A job identical to one that is still
+queued or running is not submitted again: the caller gets the ID of the pending job,
+so a burst of identical requests triggers a single scan.
+Finished jobs keep their result in memory until MAX_FINISHED_JOBS newer jobs finish.
+Large results are written to a temporary file instead (see result_file) and only the
+path is kept; the file is deleted when the job expires.
+'''
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_QUEUE_DEPTH = 16
+
+# Finished jobs whose status and result are kept for polling
+MAX_FINISHED_JOBS = 64
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Job dicts by ID, IDs of pending jobs by coalescing key and finished IDs oldest first
+_jobs = {}
+_pending = {}
+_finished = OrderedDict()
+_executor = None
+_workers = DEFAULT_JOB_WORKERS
+_queue_depth = DEFAULT_QUEUE_DEPTH
+_lock = threading.Lock()
+
+
+def configure_jobs(workers=DEFAULT_JOB_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH):
+    '''
+    Sets the number of job threads and how many jobs may wait for one.
+    Jobs already submitted finish on the previous pool.
+    '''
+    global _executor, _workers, _queue_depth
+    with _lock:
+        _workers = max(1, int(workers))
+        _queue_depth = max(0, int(queue_depth))
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+def result_file(suffix):
+    '''
+    Creates an empty temporary file for a job result. A runner that returns a result
+    dict with the path under 'path' hands the file over to the job, which deletes it
+    when the job expires; a runner that fails must delete it itself.
+
+    Returns:
+        str: path of the new file
+    '''
+    descriptor, path = tempfile.mkstemp(prefix='phe-job-', suffix=suffix)
+    os.close(descriptor)
+    return path
+
+def _discard_result(result):
+    '''
+    Deletes the file holding the result of an expired job, if there is one.
+    '''
+    if isinstance(result, dict) and result.get('path'):
+        try:
+            os.remove(result['path'])
+        except FileNotFoundError:
+            pass
+
+def job_key(kind, params):
+    '''
+    Returns the key under which identical jobs are coalesced.
+    '''
+    return kind, tuple(sorted((name, repr(value)) for name, value in params.items()))
+
+def submit_job(kind, params, runner):
+    '''
+    Queues a job on the background pool, or returns the identical pending job.
+
+    Args:
+        kind: job type, e.g. 'aggregate'
+        params: dict of parameters that, with kind, identify identical jobs
+        runner: callable taking a report(processed, total=None) progress callback
+            and returning the job result
+
+    Returns:
+        Tuple: (job ID, True if an identical pending job was reused),
+        or (None, False) if the queue is full
+    '''
+    global _executor
+    key = job_key(kind, params)
+    with _lock:
+        job_id = _pending.get(key)
+        if job_id is not None:
+            return job_id, True
+        if len(_pending) >= _workers + _queue_depth:
+            print(f"Job queue full, rejecting {kind} job")
+            return None, False
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'kind': kind,
+            'params': params,
+            'key': key,
+            'status': QUEUED,
+            'processed': 0,
+            'total': None,
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'result': None,
+            'error': None,
+        }
+        _jobs[job['id']] = job
+        _pending[key] = job['id']
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='job')
+        _executor.submit(_run_job, job, runner)
+    return job['id'], False
+
+def _run_job(job, runner):
+    '''
+    Runs a job on a pool thread and records its result or error.
+    '''
+    with _lock:
+        job['status'] = RUNNING
+        job['started'] = time.time()
+
+    def report(processed, total=None):
+        with _lock:
+            job['processed'] = processed
+            if total is not None:
+                job['total'] = total
+
+    try:
+        result, status, error = runner(report), DONE, None
+    except Exception as e:
+        print(f"Job {job['id']} failed: {e}")
+        result, status, error = None, FAILED, str(e)
+
+    expired_results = []
+    with _lock:
+        job.update(status=status, result=result, error=error, finished=time.time())
+        _pending.pop(job['key'], None)
+        _finished[job['id']] = None
+        while len(_finished) > MAX_FINISHED_JOBS:
+            expired, _ = _finished.popitem(last=False)
+            expired_results.append(_jobs.pop(expired, {}).get('result'))
+    for expired_result in expired_results:
+        _discard_result(expired_result)
+
+def job_status(job_id):
+    '''
+    Reports the progress of a job. The ETA extrapolates the rate at which rows
+    have been processed so far and is None until the job has reported progress.
+
+    Returns:
+        Dict: id, kind, status, processed, total, elapsed and eta seconds and error,
+        or None if the job is unknown or expired
+    '''
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        job = dict(job)
+
+    elapsed = None
+    eta = None
+    if job['started'] is not None:
+        elapsed = (job['finished'] or time.time()) - job['started']
+    if job['status'] == DONE:
+        eta = 0.0
+    elif job['status'] == RUNNING and job['processed'] and job['total']:
+        eta = elapsed * (job['total'] - job['processed']) / job['processed']
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'processed': job['processed'],
+        'total': job['total'],
+        'elapsed': elapsed,
+        'eta': eta,
+        'error': job['error'],
+    }
+
+def job_result(job_id):
+    '''
+    Returns the result of a finished job.
+
+    Returns:
+        Tuple: (status dict as returned by job_status, result or None until the job is done),
+        or None if the job is unknown or expired
+    '''
+    status = job_status(job_id)
+    if status is None:
+        return None
+    with _lock:
+        job = _jobs.get(job_id)
+        result = job['result'] if job is not None else None
+    return status, result
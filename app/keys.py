@@ -0,0 +1,288 @@
+'''Key Management Module
+
+Contexts are handed out in two ways. get_context() returns one context per process,
+which suits worker processes and scripts. Request handlers check a context out of a
+pool with acquire_context() / pooled_context() instead, so concurrent threads never
+share a Pyfhel object. Public-only and secret-holding contexts are pooled separately
+so the secret key is only loaded into contexts that decrypt, and every pooled context
+is loaded from disk once and then reused. Rotation keys are most of a context's memory
+(one Galois key per step), so they are only loaded into the contexts of separate,
+smaller pools that callers ask for when they rotate.
+'''
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from app.encryption import (
+    KEY_DIR,
+    generate_keys,
+    load_context_public,
+    load_secret,
+)
+from app.packing import COLUMN_LAYOUT, rotation_profile
+from app import metrics
+
+# Rotation keys are optional: they are only generated for layouts that rotate
+KEY_FILES = ('context.pkl', 'public_key.pkl', 'secret_key.pkl', 'relin_key.pkl')
+DEFAULT_N_VALUE = 2**14
+
+# Key files clients may download to encrypt records themselves; the secret key is never served
+PUBLIC_KEY_FILES = {
+    'context': 'context.pkl',
+    'public_key': 'public_key.pkl',
+    'relin_key': 'relin_key.pkl',
+    'rotate_key': 'rotate_key.pkl',
+}
+
+# Maximum number of contexts per pool; pools grow on demand up to this size
+DEFAULT_POOL_SIZE = os.cpu_count() or 1
+# Maximum number of contexts per pool of contexts holding the rotation keys
+DEFAULT_ROTATION_POOL_SIZE = 2
+
+# Pyfhel contexts loaded by this process, keyed by (secret, rotate)
+_contexts = {}
+_lock = threading.Lock()
+
+# Idle pooled contexts per (secret, rotate) kind, the number created per kind, and the pool
+# generation each checked-out context belongs to (regenerating keys starts a new generation)
+_pools = {}
+_pool_created = {}
+_checked_out = {}
+_pool_generation = 0
+_pool_size = DEFAULT_POOL_SIZE
+_rotation_pool_size = DEFAULT_ROTATION_POOL_SIZE
+
+# SHA-256 digests of public key files, keyed by path, valid while (mtime_ns, size) is unchanged
+_digests = {}
+
+# Worker processes are started from a fork server (or spawned where there is none) rather than
+# forked from the app, which runs request and job threads and may hold their locks mid-fork.
+# The server imports the worker modules once, so each worker starts without re-importing them.
+WORKER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+WORKER_MODULES = ['app.aggregate', 'app.groupby', 'app.ingest', 'app.statistics']
+
+
+def keys_exist():
+    '''
+    Returns True if every key file is present and non-empty.
+    '''
+    for file in KEY_FILES:
+        path = os.path.join(KEY_DIR, file)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return False
+    return True
+
+def ensure_keys(regenerate=False, layout=COLUMN_LAYOUT, n_value=DEFAULT_N_VALUE, **keygen_params):
+    '''
+    Generates keys only if they are missing, or always when regenerate is True.
+    Regenerating clears the cached contexts, since data encrypted under the old
+    keys can no longer be decrypted with the new ones.
+
+    Args:
+        regenerate: force a new set of keys even if the files exist
+        layout: storage layout whose rotation profile decides which rotation keys to generate
+        n_value: polynomial modulus degree
+        keygen_params: forwarded to generate_keys
+
+    Returns:
+        True if usable keys are on disk, False otherwise
+    '''
+    with _lock:
+        if keys_exist() and not regenerate:
+            return True
+        _contexts.clear()
+        _reset_pools()
+        return generate_keys(n_value=n_value, rotation_steps=rotation_profile(layout, n_value),
+                             **keygen_params)
+
+def get_context(secret=False, rotate=False):
+    '''
+    Returns the process-wide Pyfhel context, loading it from disk on first use
+    and generating keys only if none exist yet. Worker processes never rotate,
+    so the rotation keys are only loaded when asked for.
+
+    Args:
+        secret: also load the secret key
+        rotate: also load the rotation keys (if they were generated)
+
+    Returns:
+        Pyfhel object, or None if the keys could not be loaded
+    '''
+    kind = (secret, rotate)
+    encryption_obj = _contexts.get(kind)
+    if encryption_obj is not None:
+        return encryption_obj
+
+    if not ensure_keys():
+        return None
+    with _lock:
+        if kind not in _contexts:
+            encryption_obj = _load_context(secret, rotate)
+            if encryption_obj is None:
+                return None
+            _contexts[kind] = encryption_obj
+        return _contexts[kind]
+
+def clear_cache():
+    '''
+    Drops the cached and pooled contexts so the next checkout reloads from disk.
+    '''
+    with _lock:
+        _contexts.clear()
+        _reset_pools()
+
+def _reset_pools():
+    '''
+    Empties every pool. Contexts still checked out are dropped when they are released.
+    Must be called with _lock held.
+    '''
+    global _pool_generation
+    _pools.clear()
+    _pool_created.clear()
+    _pool_generation += 1
+
+def configure_pool(size, rotation_size=DEFAULT_ROTATION_POOL_SIZE):
+    '''
+    Sets the maximum number of contexts kept in each pool, and checks once that
+    the keys the pooled contexts are loaded from exist.
+
+    Args:
+        size: contexts per pool without the rotation keys
+        rotation_size: contexts per pool with the rotation keys
+
+    Returns:
+        True if usable keys are on disk, False otherwise
+    '''
+    global _pool_size, _rotation_pool_size
+    with _lock:
+        _pool_size = max(1, int(size))
+        _rotation_pool_size = max(1, int(rotation_size))
+    return ensure_keys()
+
+def _load_context(secret, rotate):
+    '''
+    Loads a new Pyfhel context from the key files.
+    '''
+    encryption_obj = load_context_public(rotate=rotate)
+    if secret and encryption_obj is not None:
+        encryption_obj = load_secret(encryption_obj)
+    return encryption_obj
+
+def acquire_context(secret=False, rotate=False, timeout=None):
+    '''
+    Checks a context out of a pool for exclusive use by the caller.
+    An idle context is reused if there is one; otherwise a new one is loaded while the
+    pool is below its size, and after that the caller waits for a context to be released.
+    The keys are checked by configure_pool(), not on every checkout.
+
+    Args:
+        secret: check out a context with the secret key loaded
+        rotate: check out a context with the rotation keys loaded (if they were generated)
+        timeout: seconds to wait for a context when the pool is exhausted (None waits forever)
+
+    Returns:
+        Pyfhel object to hand back with release_context(), or None if the keys could
+        not be loaded or no context was released in time
+    '''
+    kind = (secret, rotate)
+    with _lock:
+        generation = _pool_generation
+        pool = _pools.setdefault(kind, queue.LifoQueue())
+        size = _rotation_pool_size if rotate else _pool_size
+        load = pool.empty() and _pool_created.get(kind, 0) < size
+        if load:
+            _pool_created[kind] = _pool_created.get(kind, 0) + 1
+
+    if load:
+        encryption_obj = _load_context(secret, rotate)
+        if encryption_obj is None:
+            with _lock:
+                if generation == _pool_generation:
+                    _pool_created[kind] -= 1
+            return None
+    else:
+        try:
+            encryption_obj = pool.get(timeout=timeout)
+        except queue.Empty:
+            print(f"No {'secret' if secret else 'public'} context became available within {timeout}s")
+            return None
+        if encryption_obj is None:
+            # The keys were regenerated while waiting; check out from the new pool
+            return acquire_context(secret=secret, rotate=rotate, timeout=timeout)
+
+    with _lock:
+        _checked_out[id(encryption_obj)] = (pool, generation)
+    return encryption_obj
+
+def release_context(encryption_obj):
+    '''
+    Returns a context checked out with acquire_context() to its pool.
+    Contexts from before a key regeneration are discarded instead, and anyone still
+    waiting on the old pool is woken up to retry against the new one.
+    '''
+    with _lock:
+        pool, generation = _checked_out.pop(id(encryption_obj))
+        pool.put(encryption_obj if generation == _pool_generation else None)
+
+@contextmanager
+def pooled_context(secret=False, rotate=False, timeout=None):
+    '''
+    Context manager around acquire_context() / release_context().
+    Yields None if no context could be checked out.
+    '''
+    encryption_obj = acquire_context(secret=secret, rotate=rotate, timeout=timeout)
+    try:
+        yield encryption_obj
+    finally:
+        if encryption_obj is not None:
+            release_context(encryption_obj)
+
+def _init_pool_worker(metrics_enabled, initializer, initargs):
+    '''
+    Applies the parent's metrics setting in a new worker process, then runs the pool's initializer.
+    '''
+    metrics.set_enabled(metrics_enabled)
+    initializer(*initargs)
+
+def worker_pool(max_workers, initializer, initargs=()):
+    '''
+    Returns a process pool whose workers load their own context with get_context()
+    in initializer, since nothing is inherited from the parent process.
+    Tasks should be submitted through metrics.measured() so their metrics reach the parent.
+    '''
+    mp_context = multiprocessing.get_context(WORKER_START_METHOD)
+    if WORKER_START_METHOD == 'forkserver':
+        mp_context.set_forkserver_preload(WORKER_MODULES)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=_init_pool_worker,
+                               initargs=(metrics.enabled(), initializer, initargs))
+
+def public_key_file(part):
+    '''
+    Returns the path of a public key file, or None if part is not one or the file is missing.
+    '''
+    file = PUBLIC_KEY_FILES.get(part)
+    if file is None:
+        return None
+    path = os.path.join(KEY_DIR, file)
+    return path if os.path.isfile(path) else None
+
+def key_file_digest(path):
+    '''
+    Returns the hex SHA-256 digest of a key file, hashing it again only after it changes.
+    '''
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    with _lock:
+        _digests[path] = (version, digest.hexdigest())
+    return digest.hexdigest()
@@ -0,0 +1,272 @@
+'''Metrics Module
+
+Per-stage timers, counters and gauges for the encryption hot paths, rendered in the
+Prometheus text format by GET /metrics. Recording a stage costs two perf_counter()
+calls and one short lock, which is small next to any CKKS operation, so metrics stay
+on under load; set_enabled(False) turns every call into a no-op.
+
+Each process keeps its own registry. Worker processes of a parallel scan run their
+tasks through measured(), which sends the metrics recorded during a task back with its
+result, and the parent adds them to its own registry with merged().
+
+A thread can also collect a trace: between start_trace() and finish_trace() every
+stage timed on that thread is added to a per-stage total of calls and seconds.
+'''
+import bisect
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the duration histogram buckets
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Type and help text of every exported metric
+METRICS = {
+    'phe_stage_seconds': ('histogram', 'Time spent in each hot-path stage.'),
+    'phe_stage_errors_total': ('counter', 'Hot-path stage calls that raised.'),
+    'phe_request_seconds': ('histogram', 'Request latency per endpoint.'),
+    'phe_ciphertext_bytes': ('gauge', 'Size of the last serialised ciphertext.'),
+    'phe_ciphertext_mod_level': ('gauge', 'Mod level of the last serialised ciphertext.'),
+    'phe_ciphertext_scale_bits': ('gauge', 'log2 of the scale of the last serialised ciphertext.'),
+}
+
+# Histograms hold [bucket counts, sum, count]; every metric is keyed by (name, labels)
+_enabled = True
+_histograms = {}
+_counters = {}
+_gauges = {}
+_lock = threading.Lock()
+
+# Per-thread trace of stage timings, None when the thread is not tracing
+_trace = threading.local()
+
+
+def set_enabled(enabled):
+    '''
+    Turns recording on or off. Metrics already recorded are kept.
+    '''
+    global _enabled
+    _enabled = bool(enabled)
+
+def reset():
+    '''
+    Drops every recorded metric.
+    '''
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+def enabled():
+    '''
+    Returns True if recording is on.
+    '''
+    return _enabled
+
+def collect():
+    '''
+    Returns every metric recorded since the last collect() (or reset()) as a picklable
+    delta for merge(), and drops them from the registry.
+    '''
+    with _lock:
+        delta = {
+            'histograms': {key: (list(counts), total, count) for key, (counts, total, count) in _histograms.items()},
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+        }
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+    return delta
+
+def merge(delta):
+    '''
+    Adds a delta from collect() to the registry: histograms and counters are summed
+    and gauges take the delta's value. Stages in the delta are added to the trace of
+    the current thread if it is tracing.
+    '''
+    if not _enabled:
+        return
+    with _lock:
+        for key, (counts, total, count) in delta['histograms'].items():
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = [[0] * (len(DURATION_BUCKETS) + 1), 0.0, 0]
+            histogram[0] = [old + new for old, new in zip(histogram[0], counts)]
+            histogram[1] += total
+            histogram[2] += count
+        for key, amount in delta['counters'].items():
+            _counters[key] = _counters.get(key, 0) + amount
+        _gauges.update(delta['gauges'])
+    trace = getattr(_trace, 'stages', None)
+    if trace is not None:
+        for (name, labels), (_, total, count) in delta['histograms'].items():
+            if name == 'phe_stage_seconds':
+                stage_name = dict(labels)['stage']
+                calls, seconds = trace.get(stage_name, (0, 0.0))
+                trace[stage_name] = (calls + count, seconds + total)
+
+def _measured_call(function, *args):
+    '''
+    Calls function inside a worker process.
+
+    Returns:
+        Tuple: (the result, the metrics recorded during the call from collect())
+    '''
+    result = function(*args)
+    return result, collect()
+
+def measured(function):
+    '''
+    Wraps a module-level task function run on a worker process so it returns its
+    metric deltas with its result. The results go through merged() in the parent.
+    '''
+    return functools.partial(_measured_call, function)
+
+def merged(results):
+    '''
+    Merges the metric deltas of measured() task results as they arrive and yields the results.
+    '''
+    for result, delta in results:
+        merge(delta)
+        yield result
+
+def _key(name, labels):
+    '''
+    Returns the registry key of a metric with labels.
+    '''
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    '''
+    Adds a duration to a histogram.
+    '''
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    bucket = bisect.bisect_left(DURATION_BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(DURATION_BUCKETS) + 1), 0.0, 0]
+        histogram[0][bucket] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+def increment(name, amount=1, **labels):
+    '''
+    Adds to a counter.
+    '''
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def set_gauges(values, **labels):
+    '''
+    Sets several gauges that share the same labels at once.
+
+    Args:
+        values: dict of metric name -> value
+    '''
+    if not _enabled:
+        return
+    with _lock:
+        for name, value in values.items():
+            _gauges[_key(name, labels)] = value
+
+@contextmanager
+def stage(name):
+    '''
+    Times the enclosed block as a hot-path stage, counting it as an error if it raises.
+    '''
+    if not _enabled:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment('phe_stage_errors_total', stage=name)
+        raise
+    finally:
+        seconds = time.perf_counter() - start_time
+        observe('phe_stage_seconds', seconds, stage=name)
+        trace = getattr(_trace, 'stages', None)
+        if trace is not None:
+            calls, total = trace.get(name, (0, 0.0))
+            trace[name] = (calls + 1, total + seconds)
+
+def record_ciphertext(ciphertext, n_bytes, compression):
+    '''
+    Updates the ciphertext gauges from a ciphertext that was just serialised.
+    '''
+    set_gauges({
+        'phe_ciphertext_bytes': n_bytes,
+        'phe_ciphertext_mod_level': ciphertext.mod_level,
+        'phe_ciphertext_scale_bits': math.log2(ciphertext.scale),
+    }, compression=compression)
+
+def start_trace():
+    '''
+    Starts collecting the stages timed on the current thread.
+    '''
+    _trace.stages = {}
+
+def finish_trace():
+    '''
+    Stops the trace of the current thread.
+
+    Returns:
+        Dict: stage -> {'calls', 'seconds'}, empty if the thread was not tracing
+    '''
+    stages = getattr(_trace, 'stages', None) or {}
+    _trace.stages = None
+    return {name: {'calls': calls, 'seconds': round(seconds, 6)} for name, (calls, seconds) in stages.items()}
+
+def _labels(labels, **extra):
+    '''
+    Formats labels as {name="value",...} with Prometheus escaping.
+    '''
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+def render():
+    '''
+    Returns every recorded metric in the Prometheus text format.
+    '''
+    with _lock:
+        histograms = {key: (list(counts), total, count) for key, (counts, total, count) in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        source = {'histogram': histograms, 'counter': counters, 'gauge': gauges}[kind]
+        series = sorted((labels, value) for (metric, labels), value in source.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(DURATION_BUCKETS, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{name}_count{_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
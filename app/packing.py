@@ -0,0 +1,306 @@
+'''Slot Packing Module'''
+import os
+import json
+import struct
+import numpy as np
+from app.encryption import (
+    encrypt_value,
+    decrypt_value,
+    add_encrypted,
+    multiply_encrypted,
+    deserialised_bytes,
+    context_fingerprint,
+)
+from app.store import record_bytes
+
+# Storage layouts
+ROW_LAYOUT = 'row'          # One ciphertext per record, one slot per financial column
+COLUMN_LAYOUT = 'column'    # One ciphertext per financial column, one slot per record
+LAYOUTS = (ROW_LAYOUT, COLUMN_LAYOUT)
+
+# Column-layout datasets keep one file per column so a projection only reads its columns,
+# plus a manifest of the column names and the fingerprint of the context they were encrypted under
+PACKED_MANIFEST = 'columns.json'
+
+# Each column file is a sequence of length-prefixed chunks, framed like the row store:
+#     number of Record IDs (uint32) | payload length (uint32) | Record IDs (int64 each)
+#     | payload (to_bytes() output)
+CHUNK_HEADER = struct.Struct('<II')
+
+
+def slot_count(encryption_obj):
+    '''
+    Returns the number of CKKS slots available in a single ciphertext (n/2).
+    '''
+    return encryption_obj.get_nSlots()
+
+def rotation_steps(n_slots):
+    '''
+    Returns the rotation steps used to sum every slot of a ciphertext.
+
+    Args:
+        n_slots: number of slots in the ciphertext (a power of 2)
+
+    Returns:
+        List: powers of two from 1 up to n_slots / 2
+    '''
+    steps = []
+    step = 1
+    while step < n_slots:
+        steps.append(step)
+        step *= 2
+    return steps
+
+def rotation_profile(layout, n_value):
+    '''
+    Returns the rotation steps the aggregation kernels need for a storage layout.
+    The row layout adds ciphertexts slot-wise and needs no rotations; the column
+    layout folds n/2 slots with sum_slots.
+
+    Args:
+        layout: ROW_LAYOUT or COLUMN_LAYOUT
+        n_value: polynomial modulus degree used for keygen
+    '''
+    if layout == COLUMN_LAYOUT:
+        return rotation_steps(n_value // 2)
+    return []
+
+def pack_columns(encryption_obj, financial_data, id_column='Record ID'):
+    '''
+    Encrypts a DataFrame column by column, packing up to n/2 records into each ciphertext.
+
+    Args:
+        encryption_obj: Pyfhel object with the public key loaded
+        financial_data: pandas DataFrame with an id column and numeric financial columns
+        id_column: name of the plaintext identifier column
+
+    Returns:
+        List: one dict per packed ciphertext holding the column name, the Record IDs
+        in slot order and the ciphertext's to_bytes() output, or None if encryption fails
+    '''
+    n_slots = slot_count(encryption_obj)
+    record_ids = financial_data[id_column].tolist()
+    columns = [column for column in financial_data.columns if column != id_column]
+
+    packed_dataset = []
+    for column in columns:
+        values = financial_data[column].to_numpy(dtype=np.float64)
+        for start in range(0, len(values), n_slots):
+            ciphertext = encrypt_value(encryption_obj, values[start:start + n_slots])
+            if ciphertext is None:
+                print(f"Encryption failed for column {column} at record {start}")
+                return None
+            packed_dataset.append({
+                'Column': column,
+                'Record IDs': record_ids[start:start + n_slots],
+                'Encrypted Column': record_bytes(ciphertext)
+            })
+    return packed_dataset
+
+def pack_frames(encryption_obj, frames, id_column='Record ID'):
+    '''
+    Streams pack_columns over DataFrames of at most n/2 rows each (e.g. read_csv_chunks
+    with chunk_size=slot_count()), so the dataset is never held in memory at once.
+
+    Yields:
+        Dict: packed chunks in the format produced by pack_columns
+
+    Raises:
+        ValueError: if a chunk fails to encrypt
+    '''
+    for frame in frames:
+        packed_dataset = pack_columns(encryption_obj, frame, id_column)
+        if packed_dataset is None:
+            raise ValueError("Failed to encrypt a column-layout chunk")
+        yield from packed_dataset
+
+def packed_column_path(directory, index):
+    '''
+    Returns the file holding the packed ciphertexts of the column at index.
+    '''
+    return os.path.join(directory, f"column_{index}.bin")
+
+def save_packed(directory, encryption_obj, packed_dataset):
+    '''
+    Saves the output of pack_columns or pack_frames as one file of raw ciphertext
+    chunks per column plus a manifest of the column names in order, stamped with the
+    fingerprint of encryption_obj. The chunks are written as they arrive, so a stream
+    is saved in one pass.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    # The dataset is only readable again once the manifest is rewritten after the last chunk
+    manifest_path = os.path.join(directory, PACKED_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    files = {}
+    try:
+        for chunk in packed_dataset:
+            file = files.get(chunk['Column'])
+            if file is None:
+                file = files[chunk['Column']] = open(packed_column_path(directory, len(files)), 'wb')
+            payload = chunk['Encrypted Column']
+            file.write(CHUNK_HEADER.pack(len(chunk['Record IDs']), len(payload)))
+            file.write(np.asarray(chunk['Record IDs'], dtype='<i8').tobytes())
+            file.write(payload)
+    finally:
+        for file in files.values():
+            file.close()
+    with open(manifest_path, 'w', encoding='utf-8') as file:
+        json.dump({'fingerprint': context_fingerprint(encryption_obj).hex(), 'columns': list(files)}, file)
+
+def read_manifest(directory):
+    '''
+    Returns the manifest of a saved column-layout dataset.
+    Raises ValueError for a dataset saved without a context fingerprint.
+    '''
+    with open(os.path.join(directory, PACKED_MANIFEST), 'r', encoding='utf-8') as file:
+        manifest = json.load(file)
+    if not isinstance(manifest, dict) or 'fingerprint' not in manifest:
+        raise ValueError(f"{directory} has no context fingerprint, encrypt it again")
+    return manifest
+
+def packed_columns(directory):
+    '''
+    Returns the column names of a saved column-layout dataset in order.
+    '''
+    return read_manifest(directory)['columns']
+
+def load_packed(directory, encryption_obj, columns=None):
+    '''
+    Loads the packed chunks of a saved column-layout dataset, reading only the files
+    of the requested columns.
+
+    Args:
+        directory: directory written by save_packed
+        encryption_obj: Pyfhel object the dataset must have been encrypted under
+        columns: column names to load (defaults to every column)
+
+    Returns:
+        List: chunk dicts in the format produced by pack_columns
+
+    Raises:
+        ValueError: if the dataset was encrypted under a different context or a column is unknown
+    '''
+    manifest = read_manifest(directory)
+    if manifest['fingerprint'] != context_fingerprint(encryption_obj).hex():
+        raise ValueError(f"{directory} was encrypted under a different context")
+    saved_columns = manifest['columns']
+    columns = saved_columns if columns is None else columns
+    unknown = [column for column in columns if column not in saved_columns]
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+
+    packed_dataset = []
+    for column in columns:
+        with open(packed_column_path(directory, saved_columns.index(column)), 'rb') as file:
+            while True:
+                header = file.read(CHUNK_HEADER.size)
+                if not header:
+                    break
+                n_ids, payload_length = CHUNK_HEADER.unpack(header)
+                record_ids = np.frombuffer(file.read(n_ids * 8), dtype='<i8').tolist()
+                packed_dataset.append({
+                    'Column': column,
+                    'Record IDs': record_ids,
+                    'Encrypted Column': file.read(payload_length),
+                })
+    return packed_dataset
+
+def project_slots(encryption_obj, ciphertext, slots):
+    '''
+    Zeroes every slot of a row-packed ciphertext except the given ones with a single
+    masked plaintext multiplication, so only the projected columns can be decrypted.
+
+    Args:
+        encryption_obj: Pyfhel object with the relinearization keys loaded
+        ciphertext: PyCtxt holding one column per slot
+        slots: indices of the slots to keep
+
+    Returns:
+        PyCtxt: the projected ciphertext, one mod level lower than the input
+    '''
+    mask = np.zeros(slot_count(encryption_obj), dtype=np.float64)
+    mask[list(slots)] = 1.0
+    plaintext = encryption_obj.encode(mask)
+    for _ in range(ciphertext.mod_level):
+        encryption_obj.mod_switch_to_next(plaintext)
+    return multiply_encrypted(encryption_obj, ciphertext, plaintext)
+
+def sum_slots(encryption_obj, ciphertext):
+    '''
+    Homomorphically sums every slot of a ciphertext with rotate-and-add.
+    After log2(n/2) rotations each slot holds the total of all slots.
+
+    Args:
+        encryption_obj: Pyfhel object with the rotation keys loaded
+        ciphertext: PyCtxt to sum
+
+    Returns:
+        PyCtxt: ciphertext whose slots all hold the sum of the input slots
+    '''
+    total = ciphertext.copy()
+    for step in rotation_steps(slot_count(encryption_obj)):
+        rotated = encryption_obj.rotate(total, step, in_new_ctxt=True)
+        total = add_encrypted(total, rotated)
+    return total
+
+def aggregate_columns(encryption_obj, packed_dataset):
+    '''
+    Sums each packed column homomorphically: chunks of the same column are added
+    slot-wise, then the slots are folded together with sum_slots.
+
+    Args:
+        encryption_obj: Pyfhel object with the public and rotation keys loaded
+        packed_dataset: list of dicts produced by pack_columns
+
+    Returns:
+        Dict: column name -> PyCtxt holding the column total in every slot
+    '''
+    column_totals = {}
+    for chunk in packed_dataset:
+        ciphertext = deserialised_bytes(chunk['Encrypted Column'], encryption_obj)
+        if ciphertext is None:
+            print(f"Deserialization failed for column {chunk['Column']}")
+            continue
+        if chunk['Column'] in column_totals:
+            column_totals[chunk['Column']] = add_encrypted(column_totals[chunk['Column']], ciphertext)
+        else:
+            column_totals[chunk['Column']] = ciphertext
+
+    return {column: sum_slots(encryption_obj, total) for column, total in column_totals.items()}
+
+def combine_column_totals(encryption_obj, column_totals, slots):
+    '''
+    Gathers column totals into one ciphertext in the row layout, the total of each
+    column in its slot, with one masked multiplication per column. Column-layout
+    results can then be sent to clients exactly like row-layout aggregates.
+
+    Args:
+        encryption_obj: Pyfhel object with the relinearization keys loaded
+        column_totals: dict of column name -> PyCtxt from aggregate_columns
+        slots: dict of column name -> slot index
+
+    Returns:
+        PyCtxt: one mod level lower than the column totals, or None if there are none
+    '''
+    combined = None
+    for column, total in column_totals.items():
+        projected = project_slots(encryption_obj, total, [slots[column]])
+        combined = projected if combined is None else add_encrypted(combined, projected)
+    return combined
+
+def decrypt_column_totals(encryption_obj, column_totals):
+    '''
+    Decrypts the output of aggregate_columns.
+
+    Args:
+        encryption_obj: Pyfhel object with the secret key loaded
+        column_totals: dict of column name -> PyCtxt
+
+    Returns:
+        Dict: column name -> decrypted total (float)
+    '''
+    return {
+        column: float(decrypt_value(encryption_obj, ciphertext)[0])
+        for column, ciphertext in column_totals.items()
+    }
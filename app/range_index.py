@@ -0,0 +1,142 @@
+'''Encrypted Range Index Module
+
+A Fenwick (binary indexed) tree of encrypted partial sums over the record store.
+Node i (1-based) holds the sum of record positions (i - lowbit(i), i], so any prefix
+sum needs at most log2(N) node reads and a range is the difference of two prefixes.
+Because a new node only depends on older nodes, appending a record appends one node
+and never rewrites existing ones, which lets the nodes live in an append-only store
+'<path>.fenwick'. Deleted records are subtracted at query time.
+'''
+import os
+import threading
+import numpy as np
+from app.encryption import add_encrypted, sub_encrypted
+from app.store import (
+    create_store,
+    append_records,
+    read_header,
+    record_count,
+    record_ids,
+    read_records,
+    deleted_positions,
+)
+
+# Nodes are appended to the node store in batches of this size
+NODE_BATCH_SIZE = 64
+
+_lock = threading.Lock()
+
+
+def index_store_path(path):
+    '''
+    Returns the path of the Fenwick node store for a record store.
+    '''
+    return f"{path}.fenwick"
+
+def _source_path(path):
+    '''
+    Returns the path of the file recording which record store the nodes were built from.
+    '''
+    return f"{index_store_path(path)}.src"
+
+def _lowbit(i):
+    '''
+    Returns the lowest set bit of i.
+    '''
+    return i & -i
+
+def prefix_positions(i):
+    '''
+    Returns the 0-based node positions whose sum is the prefix of the first i records.
+    '''
+    positions = []
+    while i > 0:
+        positions.append(i - 1)
+        i -= _lowbit(i)
+    return positions
+
+def child_positions(i):
+    '''
+    Returns the 0-based positions of the nodes that, with record i, make up node i (1-based).
+    '''
+    positions = []
+    j = i - 1
+    while j > i - _lowbit(i):
+        positions.append(j - 1)
+        j -= _lowbit(j)
+    return positions
+
+def update_index(path, encryption_obj):
+    '''
+    Appends Fenwick nodes for records added since the last update, rebuilding the
+    index from scratch if the record store was recreated.
+
+    Returns:
+        int: number of records covered by the index
+    '''
+    with _lock:
+        nodes_path = index_store_path(path)
+        header = read_header(path)
+        try:
+            with open(_source_path(path), 'rb') as file:
+                built_from = file.read()
+        except FileNotFoundError:
+            built_from = None
+        if built_from != header.store_id or not os.path.exists(nodes_path):
+            # Nodes are sums of records, so they live at the record store's mod level
+            create_store(nodes_path, encryption_obj, header.mod_level)
+            with open(_source_path(path), 'wb') as file:
+                file.write(header.store_id)
+
+        n_nodes = record_count(nodes_path)
+        n_records = record_count(path)
+        # Nodes cover deleted records too, so records are read by position rather than
+        # through iter_records, one read of the records and one of their stored children per batch
+        for batch_start in range(n_nodes + 1, n_records + 1, NODE_BATCH_SIZE):
+            batch = range(batch_start, min(batch_start + NODE_BATCH_SIZE, n_records + 1))
+            stored = sorted({position for i in batch for position in child_positions(i) if position < n_nodes})
+            children = dict(zip(stored, read_records(nodes_path, encryption_obj, stored)))
+            for i, node in zip(batch, read_records(path, encryption_obj, [i - 1 for i in batch])):
+                for position in child_positions(i):
+                    node = add_encrypted(node, children[position])
+                children[i - 1] = node
+            append_records(nodes_path, encryption_obj, [(i - 1, children[i - 1]) for i in batch])
+            n_nodes += len(batch)
+        return n_records
+
+def prefix_sum(path, encryption_obj, i):
+    '''
+    Returns the encrypted sum of the first i record positions, or None if i is 0.
+    '''
+    nodes = read_records(index_store_path(path), encryption_obj, prefix_positions(i))
+    total = None
+    for node in nodes:
+        total = node if total is None else add_encrypted(total, node)
+    return total
+
+def range_sum(path, encryption_obj, first_id, last_id):
+    '''
+    Homomorphically sums the live records with first_id <= Record ID <= last_id
+    using O(log N) ciphertext additions. Record IDs must be appended in ascending order.
+
+    Returns:
+        Tuple: (PyCtxt sum or None if no live record is in range, number of records summed)
+    '''
+    update_index(path, encryption_obj)
+    ids = record_ids(path)
+    if np.any(ids[1:] < ids[:-1]):
+        raise ValueError("Record IDs are not in ascending order; range index unavailable")
+
+    start = int(np.searchsorted(ids, first_id, side='left'))
+    stop = int(np.searchsorted(ids, last_id, side='right'))
+    deleted = sorted(position for position in deleted_positions(path) if start <= position < stop)
+    n_live = stop - start - len(deleted)
+    if n_live <= 0:
+        return None, 0
+
+    total = prefix_sum(path, encryption_obj, stop)
+    if start > 0:
+        total = sub_encrypted(total, prefix_sum(path, encryption_obj, start))
+    for record in read_records(path, encryption_obj, deleted):
+        total = sub_encrypted(total, record)
+    return total, n_live
@@ -1,84 +1,271 @@
 # app/routes.py
 '''Module to handle API Routes'''
 import os
-import pandas as pd
-import pickle
-import gzip
+import base64
+import numpy as np
 import json
-from tabulate import tabulate
-from flask import Blueprint, jsonify
-from Pyfhel import Pyfhel, PyCtxt
+import time
+from flask import Blueprint, Response, current_app, g, jsonify, request, send_file, stream_with_context
 from app.encryption import (
-    generate_keys,
-    load_context_public,
-    load_secret,
-    encrypt_value,
     decrypt_value,
-    add_encrypted,
-    sub_encrypted,
-    multiply_encrypted,
     serialised_encrypted,
-    deserialised,
+    ciphertext_bytes,
+    lowest_mod_level,
+    mod_switch_to_level,
+    context_fingerprint,
+    AGGREGATE_VALUE_BITS,
+    DepthExhaustedError,
+)
+from app.cache import cached_aggregate, remove_record
+from app.range_index import range_sum
+from app.statistics import parallel_statistics, decrypt_statistics
+from app.decryption import decrypt_batches, live_record_count, csv_chunks, npy_chunks
+from app.keys import (
+    PUBLIC_KEY_FILES,
+    ensure_keys,
+    acquire_context,
+    release_context,
+    pooled_context,
+    public_key_file,
+    key_file_digest,
+)
+from app.ingest import STORE_DEPTH, stream_encrypt, csv_schema, read_csv_chunks
+from app.bulk import BATCH_MAGIC, BATCH_VERSION, read_batch_header, prepare_store, ingest_records, ingest_lock
+from app.groupby import group_aggregate
+from app import metrics
+from app.tuning import DEFAULT_PRECISION, sample_frames, tune_parameters, save_profile
+from app.sharding import sharded_aggregate
+from app.jobs import DONE, FAILED, submit_job, job_status, job_result, result_file
+from app import sqlite_store
+from app.store import check_fingerprint, read_header, record_count
+from app.packing import (
+    ROW_LAYOUT,
+    COLUMN_LAYOUT,
+    LAYOUTS,
+    slot_count,
+    pack_frames,
+    save_packed,
+    load_packed,
+    project_slots,
+    aggregate_columns,
+    combine_column_totals,
+    decrypt_column_totals,
 )
 
 main = Blueprint('main', __name__)
 
-# Financial Data FIle Dir
+# Financial Data FIle Dir; only its header and schema sample are read at import,
+# the rows are streamed a chunk at a time by the routes that need them
 data_path = os.path.join(os.path.dirname(__file__), '..', 'data/financial_data.csv')
-financial_data = pd.read_csv(data_path)
+data_schema = csv_schema(data_path)
+
+# Encrypted Data File Dir for each storage layout
+encrypted_data_paths = {
+    ROW_LAYOUT: os.path.join(os.path.dirname(__file__), '..', 'data/encrypted_financial_data.bin'),
+    COLUMN_LAYOUT: os.path.join(os.path.dirname(__file__), '..', 'data/encrypted_financial_data_packed'),
+}
+# SQLite store for row-layout records, selected with ?backend=sqlite
+sqlite_data_path = os.path.join(os.path.dirname(__file__), '..', 'data/encrypted_financial_data.db')
+BACKENDS = ('file', 'sqlite')
+
+# Non-numeric columns are stored as plaintext grouping keys, the rest are encrypted
+grouping_columns = [column for column, dtype in data_schema.items() if dtype is str]
+financial_columns = [column for column, dtype in data_schema.items() if dtype == 'float64']
+
+# Output formats of /decrypt_all
+DECRYPT_FORMATS = ('csv', 'npy', 'summary')
+
+# Modes of POST /records/bulk
+BULK_MODES = ('append', 'replace')
+
+# Job types accepted by POST /jobs
+JOB_KINDS = ('encrypt', 'aggregate', 'decrypt')
+
+# Encryption contexts are checked out of the app.keys pools per request
+
+def request_context(secret=False, rotate=False):
+    '''
+    Checks a context out of the app.keys pools for the rest of the request,
+    so concurrent request threads never share a Pyfhel object. Only requests that
+    rotate ask for a context holding the rotation keys.
+    It goes back to the pool when the request is torn down.
+    '''
+    encryption_obj = acquire_context(secret=secret, rotate=rotate,
+                                     timeout=current_app.config['CONTEXT_CHECKOUT_TIMEOUT'])
+    if encryption_obj is not None:
+        g.setdefault('encryption_objs', []).append(encryption_obj)
+    return encryption_obj
+
+@main.teardown_request
+def release_request_contexts(exception):
+    '''
+    Returns the contexts checked out by request_context() to their pools.
+    '''
+    for encryption_obj in g.pop('encryption_objs', []):
+        release_context(encryption_obj)
 
-# Initilise encryption context
-generate_keys()
-encryption_obj = load_context_public()
+@main.errorhandler(DepthExhaustedError)
+def depth_exhausted(error):
+    '''
+    Answers 409 when a query needs a multiplication (a column projection or /statistics)
+    that the current keys leave no modulus level for.
+    '''
+    print(f"Query unavailable: {error}")
+    return jsonify({"error": str(error)}), 409
+
+@main.before_request
+def start_request_timer():
+    '''
+    Starts timing the request, and tracing its stages when TRACE_REQUESTS is set.
+    '''
+    g.request_start = time.perf_counter()
+    if current_app.config['TRACE_REQUESTS']:
+        metrics.start_trace()
+
+@main.teardown_request
+def record_request_metrics(exception):
+    '''
+    Records the request latency and logs the stage trace as one JSON line.
+    Streamed responses are torn down after their last chunk, so they are timed in full.
+    '''
+    start_time = g.pop('request_start', None)
+    if start_time is None:
+        return
+    seconds = time.perf_counter() - start_time
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('phe_request_seconds', seconds, endpoint=endpoint)
+    if current_app.config['TRACE_REQUESTS']:
+        current_app.logger.info(json.dumps({
+            "trace": endpoint,
+            "method": request.method,
+            "path": request.full_path.rstrip('?'),
+            "seconds": round(seconds, 6),
+            "error": repr(exception) if exception is not None else None,
+            "stages": metrics.finish_trace(),
+        }))
+
+@main.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    '''
+    Exposes the stage timers, error counters, request latencies and ciphertext gauges
+    of this process in the Prometheus text format.
+    '''
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @main.route('/encrypt_all', methods=['GET'])
 def encrypt_all():
     """
     Encrypts all financial data (Revenue, Expenses, etc.) in the dataset and saves it to a new binary file.
     Utilizes batching to optimize storage.
+    The ?layout= query parameter selects 'row' (one ciphertext per record, default)
+    or 'column' (one ciphertext per financial column for up to n/2 records).
     """
-    encrypted_dataset = []
-    # Iterate over all rows and encrypt the financial fields using batching
-    for _, row in financial_data.iterrows():
-        financial_values = row.drop(labels=['Record ID']).values.tolist()
-        ciphertext = encrypt_value(encryption_obj, financial_values)
-        if ciphertext is not None:
-            serialized_ciphertext = serialised_encrypted(ciphertext)
-            encrypted_row = {
-                'Record ID': row['Record ID'],
-                'Encrypted Financials': serialized_ciphertext
-            }
-            encrypted_dataset.append(encrypted_row)
-        else:
-            print(f"Encryption failed for Record ID: {row['Record ID']}")
+    layout = request.args.get('layout', ROW_LAYOUT)
+    if layout not in LAYOUTS:
+        return jsonify({"error": f"Unknown layout '{layout}'."}), 400
+
+    encryption_obj = request_context()
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    if layout == ROW_LAYOUT:
+        return encrypt_rows(encryption_obj)
 
-    # Save the entire encrypted dataset using Pickle and Gzip
+    # Each CSV chunk fills the n/2 slots of one ciphertext per column
+    frames = (
+        frame.drop(columns=grouping_columns)
+        for frame in read_csv_chunks(data_path, data_schema, chunk_size=slot_count(encryption_obj))
+    )
+
+    # Save the encrypted dataset as one file of raw ciphertext frames per column
     try:
-        save_path = os.path.join(os.path.dirname(__file__), '..', 'data/encrypted_financial_data.pkl.gz')
-        with gzip.open(save_path, 'wb') as file:
-            pickle.dump(encrypted_dataset, file)
+        save_path = encrypted_data_paths[layout]
+        save_packed(save_path, encryption_obj, pack_frames(encryption_obj, frames))
         print(f"Encrypted data saved to {save_path}")
         return jsonify({"message": "All data encrypted and saved to a new binary file."}), 200
+    except ValueError as e:
+        print(f"An error occurred while encrypting data: {e}")
+        return jsonify({"error": "Failed to encrypt data."}), 500
+    except Exception as e:
+        print(f"An error occurred while saving encrypted data: {e}")
+        return jsonify({"error": "Failed to save encrypted data."}), 500
+
+def encrypt_rows(encryption_obj):
+    """
+    Encrypts each row of the dataset into its own ciphertext (row layout) on a process pool.
+    The CSV is streamed a chunk at a time, so memory stays flat however large it is.
+    The ?workers= query parameter sets the number of worker processes (defaults to the CPU count)
+    and ?backend= writes to the binary record file ('file', default) or the SQLite store ('sqlite').
+    ?resume=true continues an interrupted ingest from its checkpoint instead of starting over.
+    Responds 503 with Retry-After while another ingest is writing to the store.
+    """
+    workers = request.args.get('workers', type=int)
+    backend = request.args.get('backend', 'file')
+    resume = request.args.get('resume', 'false').lower() == 'true'
+    if backend not in BACKENDS:
+        return jsonify({"error": f"Unknown backend '{backend}'."}), 400
+    save_path = sqlite_data_path if backend == 'sqlite' else encrypted_data_paths[ROW_LAYOUT]
+    lock = acquire_store(save_path)
+    if lock is None:
+        return store_busy()
+    try:
+        if backend == 'sqlite':
+            stats = stream_encrypt(data_path, save_path, encryption_obj, workers=workers,
+                                   backend=sqlite_store, resume=resume)
+        else:
+            stats = stream_encrypt(data_path, save_path, encryption_obj, workers=workers, resume=resume)
+        print(f"Encrypted data saved to {save_path}")
+        target = "SQLite database" if backend == 'sqlite' else "binary file"
+        return jsonify({"message": f"All data encrypted and saved to a new {target}.", "stats": stats}), 200
     except Exception as e:
         print(f"An error occurred while saving encrypted data: {e}")
         return jsonify({"error": "Failed to save encrypted data."}), 500
+    finally:
+        lock.release()
+
+def acquire_store(path):
+    '''
+    Takes the ingest_lock of a store, so it is never recreated, appended to or deleted
+    from by two requests at once, waiting up to BULK_LOCK_TIMEOUT seconds for it.
+
+    Returns:
+        The held lock, or None if another ingest still holds it
+    '''
+    lock = ingest_lock(path)
+    return lock if lock.acquire(timeout=current_app.config['BULK_LOCK_TIMEOUT']) else None
+
+def store_busy():
+    '''
+    Answers 503 with Retry-After when acquire_store() timed out.
+    '''
+    response = jsonify({"error": "Another ingest is writing to the store."})
+    response.headers['Retry-After'] = str(current_app.config['BULK_RETRY_AFTER'])
+    return response, 503
 
 @main.route('/decrypt_all', methods=['GET'])
 def decrypt_all():
     """
     Decrypts all encrypted financial data in the dataset.
-    Verifies data integrity by decrypting and displaying the raw data.
+    Records are decrypted in batches into NumPy arrays and streamed back as they are
+    decrypted, so memory stays flat however large the store is.
+    The ?format= query parameter selects 'csv' (default), 'npy' (a structured NumPy
+    array with the Record ID and one float64 field per column) or 'summary', which
+    only returns the decrypted column totals.
     """
-    load_secret(encryption_obj)
-    total_revenue, total_expenses, total_savings, total_investments, total_loans = 0.0, 0.0, 0.0, 0.0, 0.0
+    output_format = request.args.get('format', 'csv')
+    if output_format not in DECRYPT_FORMATS:
+        return jsonify({"error": f"Unknown format '{output_format}'."}), 400
 
-    # Path to the encrypted data binary file
-    encrypted_data_path = os.path.join(os.path.dirname(__file__), '..', 'data/encrypted_financial_data.pkl.gz')
+    encryption_obj = request_context(secret=True)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
 
-    # Load the encrypted dataset
+    # Path to the encrypted record store
+    encrypted_data_path = encrypted_data_paths[ROW_LAYOUT]
+
+    # Check the store exists and was encrypted under the current context
     try:
-        with gzip.open(encrypted_data_path, 'rb') as file:
-            encrypted_dataset = pickle.load(file)
+        check_fingerprint(encrypted_data_path, encryption_obj)
     except FileNotFoundError:
         print("Encrypted data file not found.")
         return jsonify({"error": "Encrypted data file not found."}), 404
@@ -86,99 +273,778 @@ def decrypt_all():
         print(f"An error occurred while loading encrypted data: {e}")
         return jsonify({"error": "Failed to load encrypted data."}), 500
 
-    decrypted_dataset = []
+    # Column totals are accumulated with vectorized sums for cross checking purposes
+    # The NPY header gives the row count up front, so a record that fails must fail the response
+    totals = np.zeros(len(financial_columns))
+    batches = decrypt_batches(encrypted_data_path, encryption_obj, len(financial_columns),
+                              strict=output_format == 'npy')
 
-    # Iterate over all rows and decrypt the financial fields
-    for row in encrypted_dataset:
-        try:
-            serialized_ciphertext = row['Encrypted Financials']
-            ciphertext = deserialised(serialized_ciphertext, encryption_obj)
-            if ciphertext is not None:
-                decrypted_values = decrypt_value(encryption_obj, ciphertext)
-                decrypted_row = {
-                    'Decrypted Revenue': f"{decrypted_values[0]:.2f}",
-                    'Decrypted Expenses': f"{decrypted_values[1]:.2f}",
-                    'Decrypted Savings': f"{decrypted_values[2]:.2f}",
-                    'Decrypted Investments': f"{decrypted_values[3]:.2f}",
-                    'Decrypted Loans': f"{decrypted_values[4]:.2f}"
-                }
-                decrypted_dataset.append(decrypted_row)
-                # Accumulate the decrypted sums for cross checking purposes
-                total_revenue += decrypted_values[0]
-                total_expenses += decrypted_values[1]
-                total_savings += decrypted_values[2]
-                total_investments += decrypted_values[3]
-                total_loans += decrypted_values[4]
-            else:
-                print(f"Deserialization failed for Record ID: {row['Record ID']}")
-        except Exception as e:
-            print(f"An error occurred while decrypting Record ID {row['Record ID']}: {e}")
-
-    # Create a new DataFrame from the decrypted dataset
-    decrypted_df = pd.DataFrame(decrypted_dataset)
-
-    # Display the decrypted data in a readable format (optional)
-    print(tabulate(decrypted_df, headers='keys', tablefmt='pretty'))
-
-    # Display sums
-    total_sums = {
-        'Total Revenue': f"{total_revenue:.2f}",
-        'Total Expenses': f"{total_expenses:.2f}",
-        'Total Savings': f"{total_savings:.2f}",
-        'Total Investments': f"{total_investments:.2f}",
-        'Total Loans': f"{total_loans:.2f}"
-    }
-    print("\nSummed Financials:")
-    json_string = json.dumps(total_sums, indent=4)
-    print(json_string)
+    if output_format == 'summary':
+        for _, values in batches:
+            totals += values.sum(axis=0)
+        total_sums = {column: round(float(total), 2) for column, total in zip(financial_columns, totals)}
+        return jsonify({"message": "All data decrypted.", "totals": total_sums}), 200
+
+    if output_format == 'npy':
+        n_rows = live_record_count(encrypted_data_path)
+        chunks = npy_chunks(batches, financial_columns, n_rows, totals)
+        mimetype, filename = 'application/octet-stream', 'decrypted_financial_data.npy'
+    else:
+        chunks = csv_chunks(batches, financial_columns, totals)
+        mimetype, filename = 'text/csv', 'decrypted_financial_data.csv'
 
-    return jsonify({"message": "All data decrypted and displayed."}), 200
+    def stream():
+        yield from chunks
+        print("\nSummed Financials:")
+        print(json.dumps({column: f"{total:.2f}" for column, total in zip(financial_columns, totals)},
+                         indent=4, ensure_ascii=False))
+
+    return Response(stream_with_context(stream()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @main.route('/aggregation', methods=['GET'])
 def aggregation():
     '''
     Homomorphically sums all the encrypted financial columns (Revenue, Expenses, etc.) before decrypting.
+    The ?layout= query parameter selects which stored layout to aggregate and
+    ?workers= caps the number of worker processes used for the row layout.
+    Row-layout sums are served from the incrementally maintained aggregate cache;
+    ?refresh=true forces a full rescan. See ciphertext_response for the response format.
+    ?columns= projects the result onto some columns (repeat it or separate names with commas).
+    The column layout then only reads those columns; the row layout masks the other slots.
     '''
-    load_secret(encryption_obj)
-    encrypted_data_path = os.path.join(os.path.dirname(__file__), '..', 'data/encrypted_financial_data.pkl.gz')
+    layout = request.args.get('layout', ROW_LAYOUT)
+    if layout not in LAYOUTS:
+        return jsonify({"error": f"Unknown layout '{layout}'."}), 400
+    columns = requested_columns()
+    if columns is None:
+        return jsonify({"error": "Unknown column requested.", "columns": financial_columns}), 400
 
-    # Load the encrypted dataset
+    encryption_obj = request_context(secret=True, rotate=layout == COLUMN_LAYOUT)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+    encrypted_data_path = encrypted_data_paths[layout]
+
+    if layout == COLUMN_LAYOUT:
+        if encryption_obj.is_rotate_key_empty():
+            return jsonify({"error": "Rotation keys were not generated for the column layout."}), 409
+        return aggregate_packed(encrypted_data_path, encryption_obj, columns)
+
+    # Cached running sum, caught up with appended records or rescanned on worker processes
+    workers = request.args.get('workers', type=int)
+    refresh = request.args.get('refresh', 'false').lower() == 'true'
     try:
-        with gzip.open(encrypted_data_path, 'rb') as file:
-            encrypted_dataset = pickle.load(file)
+        total, watermark = cached_aggregate(encrypted_data_path, encryption_obj, workers=workers, refresh=refresh)
     except FileNotFoundError:
         print("Encrypted data file not found.")
         return jsonify({"error": "Encrypted data file not found."}), 404
     except Exception as e:
         print(f"An error occurred while loading encrypted data: {e}")
         return jsonify({"error": "Failed to load encrypted data."}), 500
-    
-    total = 0.0
-    for row in encrypted_dataset:
-        try:
-            serialised_ciphertext = row['Encrypted Financials']
-            ciphertext = deserialised(serialised_ciphertext, encryption_obj)
-            if ciphertext is not None:
-                total += ciphertext
-            else:
-                print(f"Deserialization failed for Record ID: {row['Record ID']}")
-        except Exception as e:
-            print(f"An error occurred while processing encrypted Record ID: {e}")
+    if total is None:
+        return jsonify({"error": "No encrypted records to aggregate."}), 404
+
+    total, slots = project_columns(encryption_obj, total, columns)
+    print_summed_financials(encryption_obj, total, columns)
+
+    return ciphertext_response(encryption_obj, total, watermark=watermark, slots=slots)
+
+@main.route('/sharded_aggregation', methods=['GET'])
+def sharded_aggregation():
+    '''
+    Coordinator side of sharded aggregation: fetches one partial aggregate from every
+    worker node in SHARD_URLS in parallel, sums the partials and decrypts once.
+    ?columns= is forwarded to the workers, which project their partials before sending.
+    If any worker fails the request fails with 502 rather than returning a partial sum.
+    Returns the ciphertext in the same form as /aggregation.
+    '''
+    urls = current_app.config['SHARD_URLS']
+    if not urls:
+        return jsonify({"error": "No shard workers configured."}), 409
+    columns = requested_columns()
+    if columns is None:
+        return jsonify({"error": "Unknown column requested.", "columns": financial_columns}), 400
+
+    encryption_obj = request_context(secret=True)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    query = {'columns': columns} if len(columns) < len(financial_columns) else None
+    total, records, errors = sharded_aggregate(urls, encryption_obj, query, current_app.config['SHARD_TIMEOUT'])
+    if errors:
+        return jsonify({"error": "Failed to aggregate every shard.", "shards": errors}), 502
+    if total is None:
+        return jsonify({"error": "No encrypted records to aggregate."}), 404
+
+    slots = [financial_columns.index(column) for column in columns]
+    print_summed_financials(encryption_obj, total, columns)
+
+    return ciphertext_response(encryption_obj, total, records=sum(records.values()), shards=len(urls), slots=slots)
+
+@main.route('/shard/aggregate', methods=['GET'])
+def shard_aggregate():
+    '''
+    Worker side of sharded aggregation: sums the local shard (SHARD_DATA_PATH, or the
+    row-layout store) through the aggregate cache with the public context only, and
+    returns the partial at the lowest mod level that still holds AGGREGATE_VALUE_BITS
+    in the serialised_encrypted format, with its record count and the fingerprint of
+    the context. ?columns= masks the other slots before the partial is sent.
+    '''
+    columns = requested_columns()
+    if columns is None:
+        return jsonify({"error": "Unknown column requested.", "columns": financial_columns}), 400
+
+    encryption_obj = request_context()
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    shard_path = current_app.config['SHARD_DATA_PATH'] or encrypted_data_paths[ROW_LAYOUT]
+    try:
+        total, _ = cached_aggregate(shard_path, encryption_obj)
+        n_records = live_record_count(shard_path)
+    except FileNotFoundError:
+        print("Encrypted data file not found.")
+        return jsonify({"error": "Encrypted data file not found."}), 404
+    except Exception as e:
+        print(f"An error occurred while loading encrypted data: {e}")
+        return jsonify({"error": "Failed to load encrypted data."}), 500
+
+    partial = {"data": None, "mod_level": None}
+    if total is not None:
+        total, _ = project_columns(encryption_obj, total, columns)
+        partial = serialise_result(encryption_obj, total)
+    return jsonify({"message": "Partial aggregate", "records": n_records,
+                    "fingerprint": context_fingerprint(encryption_obj).hex(), **partial}), 200
+
+@main.route('/range_aggregation', methods=['GET'])
+def range_aggregation():
+    '''
+    Homomorphically sums the row-layout records with ?first_id= <= Record ID <= ?last_id=
+    using the encrypted Fenwick index, which is brought up to date with appended records first.
+    Returns the ciphertext in the same form as /aggregation and accepts the same ?columns=.
+    '''
+    first_id = request.args.get('first_id', type=int)
+    last_id = request.args.get('last_id', type=int)
+    if first_id is None or last_id is None or first_id > last_id:
+        return jsonify({"error": "first_id and last_id must be integers with first_id <= last_id."}), 400
+    columns = requested_columns()
+    if columns is None:
+        return jsonify({"error": "Unknown column requested.", "columns": financial_columns}), 400
 
+    encryption_obj = request_context(secret=True)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    try:
+        total, n_records = range_sum(encrypted_data_paths[ROW_LAYOUT], encryption_obj, first_id, last_id)
+    except FileNotFoundError:
+        print("Encrypted data file not found.")
+        return jsonify({"error": "Encrypted data file not found."}), 404
+    except ValueError as e:
+        print(f"Range aggregation unavailable: {e}")
+        return jsonify({"error": str(e)}), 409
+    if total is None:
+        return jsonify({"error": "No encrypted records in range."}), 404
+
+    total, slots = project_columns(encryption_obj, total, columns)
+    print_summed_financials(encryption_obj, total, columns)
+
+    return ciphertext_response(encryption_obj, total, records=n_records, slots=slots)
+
+@main.route('/group_aggregation', methods=['GET'])
+def group_aggregation():
+    '''
+    Homomorphically sums the row-layout records per group of the plaintext dimensions
+    named by ?by= (repeat it to group by several, e.g. ?by=Region&by=Month) in one pass.
+    Groups are hash-partitioned over up to ?workers= worker processes.
+    Returns one serialised ciphertext and one record count per group; the keys of
+    multi-dimension groups are the dimension values joined with '|'.
+    '''
+    dimensions = [dimension for dimension in request.args.getlist('by') if dimension]
+    if not dimensions:
+        return jsonify({"error": "At least one ?by= dimension is required."}), 400
+
+    encryption_obj = request_context(secret=True)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    workers = request.args.get('workers', type=int)
+    try:
+        totals, counts = group_aggregate(encrypted_data_paths[ROW_LAYOUT], encryption_obj,
+                                         dimensions, workers=workers)
+    except FileNotFoundError:
+        print("Encrypted data file not found.")
+        return jsonify({"error": "Encrypted data file not found."}), 404
+    except Exception as e:
+        print(f"An error occurred while aggregating groups: {e}")
+        return jsonify({"error": "Failed to aggregate groups."}), 500
+    if not totals:
+        return jsonify({"error": f"No encrypted records have the dimensions {dimensions}."}), 404
+
+    for key, total in totals.items():
+        print(f"\nGroup {key} ({counts[key]} records):", end='')
+        print_summed_financials(encryption_obj, total)
+
+    data = {key: serialise_result(encryption_obj, total) for key, total in totals.items()}
+    return jsonify({"message": "Aggregation succesfull", "dimensions": dimensions,
+                    "data": data, "counts": counts}), 200
+
+@main.route('/filtered_aggregation', methods=['GET'])
+def filtered_aggregation():
+    '''
+    Homomorphically sums the records of the SQLite store selected through its indexes:
+    an optional inclusive ?first_id= / ?last_id= Record ID range and any number of
+    ?filter=<dimension>:<value> predicates (values of the same dimension are ORed,
+    different dimensions are ANDed). Matching rows are streamed through a cursor.
+    Returns the ciphertext in the same form as /aggregation.
+    '''
+    first_id = request.args.get('first_id', type=int)
+    last_id = request.args.get('last_id', type=int)
+    if first_id is not None and last_id is not None and first_id > last_id:
+        return jsonify({"error": "first_id must not be greater than last_id."}), 400
+    where = {}
+    for predicate in request.args.getlist('filter'):
+        dimension, separator, value = predicate.partition(':')
+        if not separator or not dimension:
+            return jsonify({"error": f"Filter '{predicate}' is not of the form <dimension>:<value>."}), 400
+        where.setdefault(dimension, []).append(value)
+    columns = requested_columns()
+    if columns is None:
+        return jsonify({"error": "Unknown column requested.", "columns": financial_columns}), 400
+
+    encryption_obj = request_context(secret=True)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    try:
+        total, n_records = sqlite_store.filtered_aggregate(sqlite_data_path, encryption_obj,
+                                                           first_id, last_id, where)
+    except FileNotFoundError:
+        print("Encrypted database not found.")
+        return jsonify({"error": "Encrypted database not found."}), 404
+    except Exception as e:
+        print(f"An error occurred while loading encrypted data: {e}")
+        return jsonify({"error": "Failed to load encrypted data."}), 500
+    if total is None:
+        return jsonify({"error": "No encrypted records match the filter."}), 404
+
+    total, slots = project_columns(encryption_obj, total, columns)
+    print_summed_financials(encryption_obj, total, columns)
+
+    return ciphertext_response(encryption_obj, total, records=n_records, slots=slots)
+
+@main.route('/statistics', methods=['GET', 'POST'])
+def statistics():
+    '''
+    Computes the count, sum, mean and sum of squares of every financial column of the
+    row-layout store in one homomorphic pass, plus one weighted sum per weight vector.
+    Weight vectors are POSTed as JSON: {"weights": {"<name>": {"<Record ID>": <weight>}}};
+    records missing from a vector have weight 0. ?workers= caps the worker processes.
+    The count is plaintext and the other statistics are returned as serialised ciphertexts
+    with their mod levels. The variance is E[x^2] - E[x]^2 of the decrypted moments.
+    '''
+    body = request.get_json(silent=True) or {}
+    try:
+        weights = {
+            str(name): {int(record_id): float(weight) for record_id, weight in vector.items()}
+            for name, vector in body.get('weights', {}).items()
+        }
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "weights must map names to {Record ID: weight} objects."}), 400
+
+    encryption_obj = request_context(secret=True)
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    workers = request.args.get('workers', type=int)
+    try:
+        moments = parallel_statistics(encrypted_data_paths[ROW_LAYOUT], encryption_obj,
+                                      weights=weights, workers=workers)
+    except FileNotFoundError:
+        print("Encrypted data file not found.")
+        return jsonify({"error": "Encrypted data file not found."}), 404
+    except DepthExhaustedError:
+        raise
+    except Exception as e:
+        print(f"An error occurred while computing statistics: {e}")
+        return jsonify({"error": "Failed to compute statistics."}), 500
+    if moments['count'] == 0:
+        return jsonify({"error": "No encrypted records to aggregate."}), 404
+
+    # Decrypt for cross checking purposes
+    decrypted = decrypt_statistics(encryption_obj, moments, len(financial_columns))
+    print("\nStatistics:")
+    print(json.dumps({
+        statistic: dict(zip(financial_columns, (f"{value:.2f}" for value in decrypted[statistic])))
+        for statistic in ('sum', 'mean', 'sum_of_squares', 'variance')
+    }, indent=4, ensure_ascii=False))
+
+    data = {
+        statistic: serialise_result(encryption_obj, moments[statistic])
+        for statistic in ('sum', 'mean', 'sum_of_squares')
+    }
+    data['weighted_sums'] = {
+        name: serialise_result(encryption_obj, total) for name, total in moments['weighted_sums'].items()
+    }
+    return jsonify({"message": "Statistics succesfull", "count": moments['count'], "data": data}), 200
+
+def serialise_result(encryption_obj, ciphertext):
+    '''
+    Serialises one of several result ciphertexts at the lowest mod level that still
+    holds AGGREGATE_VALUE_BITS. Returns None for a result no record contributed to.
+    '''
+    if ciphertext is None:
+        return None
+    ciphertext = wire_ciphertext(encryption_obj, ciphertext)
+    return {
+        "data": serialised_encrypted(ciphertext, current_app.config['CIPHERTEXT_COMPRESSION']),
+        "mod_level": ciphertext.mod_level,
+    }
+
+def wire_ciphertext(encryption_obj, ciphertext):
+    '''
+    Returns a copy of a ciphertext switched down to the lowest mod level that still
+    holds the configured AGGREGATE_VALUE_BITS, ready to be sent to a client.
+    '''
+    mod_level = lowest_mod_level(encryption_obj, value_bits=current_app.config['AGGREGATE_VALUE_BITS'])
+    return mod_switch_to_level(encryption_obj, ciphertext, mod_level)
+
+def ciphertext_response(encryption_obj, ciphertext, **fields):
+    '''
+    Returns an aggregate ciphertext switched down to the lowest mod level that still
+    holds AGGREGATE_VALUE_BITS, serialised with the configured CIPHERTEXT_COMPRESSION.
+    Clients sending 'Accept: application/octet-stream' get the raw bytes with the mod
+    level and fields as X- headers; everyone else gets base64 inside the JSON body.
+    Either way the client must set the mod level on the ciphertext after loading it.
+    '''
+    ciphertext = wire_ciphertext(encryption_obj, ciphertext)
+    data = ciphertext_bytes(ciphertext, current_app.config['CIPHERTEXT_COMPRESSION'])
+    return encoded_response(data, ciphertext.mod_level, **fields)
+
+def encoded_response(data, mod_level, **fields):
+    '''
+    Sends serialised ciphertext bytes in the format negotiated by ciphertext_response.
+    '''
+    binary = request.accept_mimetypes.best_match(['application/json', 'application/octet-stream'])
+    if binary == 'application/octet-stream':
+        headers = {f"X-{name.replace('_', '-').title()}": str(value) for name, value in fields.items()}
+        headers['X-Mod-Level'] = str(mod_level)
+        return Response(data, mimetype='application/octet-stream', headers=headers)
+
+    return jsonify({"message": "Aggregation succesfull", "data": base64.b64encode(data).decode('utf-8'),
+                    "mod_level": mod_level, **fields}), 200
+
+def requested_columns():
+    '''
+    Returns the columns named by the ?columns= query parameter in CSV header order,
+    every financial column if it is absent, or None if an unknown column is named.
+    '''
+    names = [name.strip() for value in request.args.getlist('columns') for name in value.split(',')]
+    names = [name for name in names if name]
+    if not names:
+        return list(financial_columns)
+    if any(name not in financial_columns for name in names):
+        return None
+    return [column for column in financial_columns if column in names]
+
+def project_columns(encryption_obj, total, columns):
+    '''
+    Masks a row-layout aggregate down to the requested columns.
+    The ciphertext is returned unchanged when every column is requested.
+
+    Returns:
+        Tuple: (PyCtxt, slot index of each requested column)
+    '''
+    slots = [financial_columns.index(column) for column in columns]
+    if len(slots) < len(financial_columns):
+        total = project_slots(encryption_obj, total, slots)
+    return total, slots
+
+def print_summed_financials(encryption_obj, total, columns=None):
+    '''
+    Decrypts an aggregate ciphertext and prints the summed columns for cross checking.
+    '''
+    columns = financial_columns if columns is None else columns
     # Prepare the result dict with the summed columns
     decrypted_value = decrypt_value(encryption_obj, total)
     summed_result = {
-        'Total Revenue': f"{decrypted_value[0]:.2f}",
-        'Total Expenses': f"{decrypted_value[1]:.2f}",
-        'Total Savings': f"{decrypted_value[2]:.2f}",
-        'Total Investments': f"{decrypted_value[3]:.2f}",
-        'Total Loans': f"{decrypted_value[4]:.2f}",
+        f"Total {column}": f"{decrypted_value[financial_columns.index(column)]:.2f}" for column in columns
     }
 
     print("\nSummed Financials:")
-    json_string = json.dumps(summed_result, indent=4)
+    json_string = json.dumps(summed_result, indent=4, ensure_ascii=False)
+    print(json_string)
+
+def aggregate_packed(encrypted_data_path, encryption_obj, columns=None):
+    '''
+    Aggregates a column-packed dataset by summing slots with the rotation keys.
+    Only the files of the requested columns are read. The column totals are gathered
+    into one ciphertext with each total in its row-layout slot, and sent like a
+    row-layout aggregate (see ciphertext_response).
+    '''
+    # Load the encrypted dataset
+    try:
+        encrypted_dataset = load_packed(encrypted_data_path, encryption_obj, columns)
+    except FileNotFoundError:
+        print("Encrypted data file not found.")
+        return jsonify({"error": "Encrypted data file not found."}), 404
+    except Exception as e:
+        print(f"An error occurred while loading encrypted data: {e}")
+        return jsonify({"error": "Failed to load encrypted data."}), 500
+
+    column_totals = aggregate_columns(encryption_obj, encrypted_dataset)
+    if not column_totals:
+        return jsonify({"error": "No encrypted records to aggregate."}), 404
+    decrypted_totals = decrypt_column_totals(encryption_obj, column_totals)
+    summed_result = {f"Total {column}": f"{value:.2f}" for column, value in decrypted_totals.items()}
+
+    print("\nSummed Financials:")
+    json_string = json.dumps(summed_result, indent=4, ensure_ascii=False)
     print(json_string)
 
-    serialised_ciphertext = serialised_encrypted(total)
+    slots = {column: financial_columns.index(column) for column in column_totals}
+    total = combine_column_totals(encryption_obj, column_totals, slots)
+    return ciphertext_response(encryption_obj, total, slots=sorted(slots.values()))
+
+@main.route('/records/<int:record_id>', methods=['DELETE'])
+def delete_record(record_id):
+    '''
+    Deletes a record from the row-layout store and subtracts it from the cached aggregate.
+    ?backend=sqlite deletes it from the SQLite store instead.
+    Responds 503 with Retry-After while an ingest is writing to the store.
+    '''
+    backend = request.args.get('backend', 'file')
+    if backend not in BACKENDS:
+        return jsonify({"error": f"Unknown backend '{backend}'."}), 400
+    encryption_obj = request_context()
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+    save_path = sqlite_data_path if backend == 'sqlite' else encrypted_data_paths[ROW_LAYOUT]
+    lock = acquire_store(save_path)
+    if lock is None:
+        return store_busy()
+    try:
+        if backend == 'sqlite':
+            deleted = sqlite_store.delete_record(save_path, record_id)
+        else:
+            deleted = remove_record(save_path, encryption_obj, record_id)
+    except FileNotFoundError:
+        return jsonify({"error": "Encrypted data file not found."}), 404
+    finally:
+        lock.release()
+    if not deleted:
+        return jsonify({"error": f"Record ID {record_id} not found."}), 404
+    return jsonify({"message": f"Record ID {record_id} deleted."}), 200
+
+@main.route('/records/bulk', methods=['POST'])
+def bulk_ingest():
+    '''
+    Appends records the client encrypted itself to the row-layout store, so the server
+    never sees their plaintext. The body is a binary batch streamed in the app.bulk
+    framing (Content-Type: application/octet-stream), written by app.bulk.write_batch
+    with the context and keys from GET /context, at the store_mod_level it reports.
+    ?mode=replace recreates the store first instead of appending.
+    Records are validated against the context as they are read and appended in batches
+    of BULK_BATCH_SIZE; if one is invalid the ingest stops with 400 and the records
+    appended before it stay in the store.
+    '''
+    mode = request.args.get('mode', 'append')
+    if mode not in BULK_MODES:
+        return jsonify({"error": f"Unknown mode '{mode}'."}), 400
+    encryption_obj = request_context()
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+
+    save_path = encrypted_data_paths[ROW_LAYOUT]
+    lock = acquire_store(save_path)
+    if lock is None:
+        return store_busy()
+    try:
+        try:
+            fingerprint, batch_level = read_batch_header(request.stream)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if fingerprint != context_fingerprint(encryption_obj):
+            return jsonify({"error": "Batch was encrypted under a different context or public key."}), 409
+        # A replacing batch is checked against the new store's level before the old store is dropped
+        store_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+        if mode == 'append' or batch_level == store_level:
+            try:
+                store_level = prepare_store(save_path, encryption_obj, store_level, replace=mode == 'replace')
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 409
+        if batch_level != store_level:
+            return jsonify({"error": f"Batch is at mod level {batch_level}, the store keeps records "
+                                     f"at mod level {store_level}."}), 409
+        try:
+            stats = ingest_records(save_path, encryption_obj, request.stream, store_level,
+                                   batch_size=current_app.config['BULK_BATCH_SIZE'])
+        except ValueError as e:
+            print(f"Bulk ingest stopped: {e}")
+            return jsonify({"error": str(e)}), 400
+    finally:
+        lock.release()
+    print(f"Ingested {stats['records']} records into {save_path}")
+    return jsonify({"message": f"{stats['records']} records appended.", "stats": stats}), 200
+
+@main.route('/context', methods=['GET'])
+def context_manifest():
+    '''
+    Describes the public context clients encrypt bulk batches under: its fingerprint,
+    parameters, the mod level the row store keeps records at and the ETag of every
+    public key file, each downloadable from GET /context/<part>.
+    The manifest carries an ETag of its own, so an unchanged context costs a 304.
+    '''
+    encryption_obj = request_context()
+    if encryption_obj is None:
+        return jsonify({"error": "Encryption keys unavailable."}), 500
+    try:
+        store_mod_level = read_header(encrypted_data_paths[ROW_LAYOUT]).mod_level
+    except (FileNotFoundError, ValueError):
+        store_mod_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+    parts = {}
+    for part in PUBLIC_KEY_FILES:
+        path = public_key_file(part)
+        if path is not None:
+            parts[part] = {"etag": key_file_digest(path), "bytes": os.path.getsize(path)}
+    manifest = {
+        "fingerprint": context_fingerprint(encryption_obj).hex(),
+        "n": encryption_obj.n,
+        "scale_bits": int(np.log2(encryption_obj.scale)),
+        "store_mod_level": store_mod_level,
+        "batch_magic": BATCH_MAGIC.decode('ascii'),
+        "batch_version": BATCH_VERSION,
+        "parts": parts,
+    }
+    response = jsonify(manifest)
+    response.set_etag(manifest['fingerprint'] + ''.join(part['etag'] for part in parts.values())
+                      + str(store_mod_level))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@main.route('/context/<part>', methods=['GET'])
+def context_part(part):
+    '''
+    Downloads one public key file: context, public_key, relin_key or rotate_key.
+    The ETag is the file's SHA-256, so clients revalidate with If-None-Match and only
+    download keys again after they were regenerated.
+    '''
+    path = public_key_file(part)
+    if path is None:
+        return jsonify({"error": f"Unknown or missing key file '{part}'."}), 404
+    response = send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=PUBLIC_KEY_FILES[part], etag=key_file_digest(path),
+                         conditional=True, max_age=None)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@main.route('/generate_keys', methods=['POST'])
+def regenerate_keys():
+    '''
+    Explicitly generates a new set of CKKS keys, replacing the ones on disk.
+    Data encrypted under the previous keys can no longer be decrypted afterwards.
+    The ?layout= query parameter picks the rotation key profile ('column' by default,
+    'row' skips rotation keys entirely).
+    ?tune=true sizes n, the modulus chain and the scale for the dataset with app.tuning
+    instead of using the defaults: ?depth= is the number of multiplications queries
+    need (0 for sums only, 1 for /statistics), ?precision= the largest acceptable
+    absolute error and ?expected_records= the records one aggregate will cover
+    (defaults to the dataset size). The chosen profile is saved with the keys.
+    '''
+    layout = request.args.get('layout', COLUMN_LAYOUT)
+    if layout not in LAYOUTS:
+        return jsonify({"error": f"Unknown layout '{layout}'."}), 400
+    if request.args.get('tune', 'false').lower() != 'true':
+        if not ensure_keys(regenerate=True, layout=layout):
+            return jsonify({"error": "Failed to generate keys."}), 500
+        current_app.config['AGGREGATE_VALUE_BITS'] = AGGREGATE_VALUE_BITS
+        return jsonify({"message": "New keys generated."}), 200
 
-    return jsonify({"message": "Aggregation succesfull", "data": serialised_ciphertext}), 200
\ No newline at end of file
+    depth = request.args.get('depth', 0, type=int)
+    precision = request.args.get('precision', DEFAULT_PRECISION, type=float)
+    expected_records = request.args.get('expected_records', type=int)
+    if depth < 0 or precision <= 0 or (expected_records is not None and expected_records < 1):
+        return jsonify({"error": "depth must be >= 0, precision > 0 and expected_records >= 1."}), 400
+
+    sample, max_abs, n_rows = sample_frames(read_csv_chunks(data_path, data_schema), financial_columns)
+    profile = tune_parameters(sample, expected_records or n_rows, depth, precision, max_abs=max_abs)
+    if profile is None:
+        return jsonify({"error": "No secure CKKS parameters meet the requested precision."}), 422
+    if not ensure_keys(regenerate=True, layout=layout, n_value=profile['n_value'],
+                       scale_bits=profile['scale_bits'], qi_sizes=profile['qi_sizes']):
+        return jsonify({"error": "Failed to generate keys."}), 500
+    save_profile(profile)
+    # Returned aggregates can be switched down as far as the tuned value bits allow
+    current_app.config['AGGREGATE_VALUE_BITS'] = profile['value_bits']
+    return jsonify({"message": "New keys generated.", "profile": profile}), 200
+
+@main.route('/jobs', methods=['POST'])
+def submit():
+    '''
+    Submits a long-running scan as a background job and returns its ID straight away.
+    ?kind= selects 'encrypt' (row layout, takes ?backend=, ?workers= and ?resume=), 'aggregate'
+    (row layout, takes ?columns=, ?refresh= and ?workers=) or 'decrypt' (takes ?format=),
+    with the same meaning as on the synchronous routes. Submitting a job identical to
+    one that is still queued or running returns the pending job instead of a new one.
+    Responds 503 when the job queue is full.
+    '''
+    kind = request.args.get('kind')
+    if kind not in JOB_KINDS:
+        return jsonify({"error": f"Unknown job kind '{kind}'.", "kinds": list(JOB_KINDS)}), 400
+    workers = request.args.get('workers', type=int)
+    app = current_app._get_current_object()
+
+    if kind == 'encrypt':
+        backend = request.args.get('backend', 'file')
+        if backend not in BACKENDS:
+            return jsonify({"error": f"Unknown backend '{backend}'."}), 400
+        resume = request.args.get('resume', 'false').lower() == 'true'
+        params = {'backend': backend, 'workers': workers, 'resume': resume}
+        runner = encrypt_job(app, backend, workers, resume)
+    elif kind == 'aggregate':
+        columns = requested_columns()
+        if columns is None:
+            return jsonify({"error": "Unknown column requested.", "columns": financial_columns}), 400
+        refresh = request.args.get('refresh', 'false').lower() == 'true'
+        params = {'columns': columns, 'refresh': refresh, 'workers': workers}
+        runner = aggregate_job(app, columns, refresh, workers)
+    else:
+        output_format = request.args.get('format', 'csv')
+        if output_format not in DECRYPT_FORMATS:
+            return jsonify({"error": f"Unknown format '{output_format}'."}), 400
+        params = {'format': output_format}
+        runner = decrypt_job(app, output_format)
+
+    job_id, coalesced = submit_job(kind, params, runner)
+    if job_id is None:
+        return jsonify({"error": "Job queue is full, try again later."}), 503
+    return jsonify({"message": "Job submitted.", "job_id": job_id, "coalesced": coalesced}), 202
+
+@main.route('/jobs/<job_id>', methods=['GET'])
+def job(job_id):
+    '''
+    Reports the status of a job: rows processed out of the total, elapsed seconds and an ETA.
+    '''
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({"error": f"Job {job_id} not found."}), 404
+    return jsonify(status), 200
+
+@main.route('/jobs/<job_id>/result', methods=['GET'])
+def job_output(job_id):
+    '''
+    Returns the result of a finished job in the same form as the matching synchronous
+    route, 202 with the job status while it is still pending and 500 if it failed.
+    '''
+    output = job_result(job_id)
+    if output is None:
+        return jsonify({"error": f"Job {job_id} not found."}), 404
+    status, result = output
+    if status['status'] == FAILED:
+        return jsonify({"error": "Job failed.", "job": status}), 500
+    if status['status'] != DONE or result is None:
+        return jsonify({"message": "Job not finished.", "job": status}), 202
+
+    if 'ciphertext' in result:
+        return encoded_response(result['ciphertext'], result['mod_level'], **result['fields'])
+    if 'path' in result:
+        # The file is deleted when the job expires; an open file stays readable after that
+        try:
+            return send_file(result['path'], mimetype=result['mimetype'], as_attachment=True,
+                             download_name=result['filename'])
+        except FileNotFoundError:
+            return jsonify({"error": f"Result of job {job_id} has expired."}), 404
+    return jsonify(result['json']), 200
+
+def encrypt_job(app, backend, workers, resume=False):
+    '''
+    Returns a job runner that streams the dataset into the row-layout store of a backend.
+    The job waits for any ingest already writing to the store to finish first.
+    '''
+    def run(report):
+        save_path = sqlite_data_path if backend == 'sqlite' else encrypted_data_paths[ROW_LAYOUT]
+        with app.app_context(), pooled_context(timeout=app.config['CONTEXT_CHECKOUT_TIMEOUT']) as encryption_obj, \
+                ingest_lock(save_path):
+            if encryption_obj is None:
+                raise RuntimeError("Encryption keys unavailable.")
+            report(0)
+            if backend == 'sqlite':
+                stats = stream_encrypt(data_path, save_path, encryption_obj, workers=workers,
+                                       backend=sqlite_store, resume=resume, progress=report)
+            else:
+                stats = stream_encrypt(data_path, save_path, encryption_obj, workers=workers,
+                                       resume=resume, progress=report)
+        return {'json': {"message": "All data encrypted.", "stats": stats}}
+    return run
+
+def aggregate_job(app, columns, refresh, workers):
+    '''
+    Returns a job runner that sums the row-layout store through the aggregate cache.
+    A full scan reports its progress as it goes; a cache hit goes straight to all records.
+    '''
+    def run(report):
+        encrypted_data_path = encrypted_data_paths[ROW_LAYOUT]
+        with app.app_context(), pooled_context(secret=True, timeout=app.config['CONTEXT_CHECKOUT_TIMEOUT']) \
+                as encryption_obj:
+            if encryption_obj is None:
+                raise RuntimeError("Encryption keys unavailable.")
+            n_records = record_count(encrypted_data_path)
+            report(0, n_records)
+            total, watermark = cached_aggregate(encrypted_data_path, encryption_obj, workers=workers,
+                                                refresh=refresh, progress=report)
+            if total is None:
+                raise ValueError("No encrypted records to aggregate.")
+            total, slots = project_columns(encryption_obj, total, columns)
+            print_summed_financials(encryption_obj, total, columns)
+            total = wire_ciphertext(encryption_obj, total)
+            data = ciphertext_bytes(total, app.config['CIPHERTEXT_COMPRESSION'])
+            report(n_records)
+        return {'ciphertext': data, 'mod_level': total.mod_level,
+                'fields': {'watermark': watermark, 'slots': slots}}
+    return run
+
+def decrypt_job(app, output_format):
+    '''
+    Returns a job runner that decrypts the row-layout store into a CSV or NPY file,
+    or into the column totals for the 'summary' format.
+    '''
+    def run(report):
+        encrypted_data_path = encrypted_data_paths[ROW_LAYOUT]
+        with pooled_context(secret=True, timeout=app.config['CONTEXT_CHECKOUT_TIMEOUT']) as encryption_obj:
+            if encryption_obj is None:
+                raise RuntimeError("Encryption keys unavailable.")
+            check_fingerprint(encrypted_data_path, encryption_obj)
+            n_rows = live_record_count(encrypted_data_path)
+            report(0, n_rows)
+
+            def batches():
+                processed = 0
+                for record_ids, values in decrypt_batches(encrypted_data_path, encryption_obj,
+                                                          len(financial_columns), strict=output_format == 'npy'):
+                    processed += len(record_ids)
+                    report(processed)
+                    yield record_ids, values
+
+            totals = np.zeros(len(financial_columns))
+            if output_format == 'summary':
+                for _, values in batches():
+                    totals += values.sum(axis=0)
+                total_sums = {column: round(float(total), 2) for column, total in zip(financial_columns, totals)}
+                return {'json': {"message": "All data decrypted.", "totals": total_sums}}
+            # The export is written to a file chunk by chunk rather than held in memory
+            if output_format == 'npy':
+                chunks = npy_chunks(batches(), financial_columns, n_rows, totals)
+                mimetype, filename = 'application/octet-stream', 'decrypted_financial_data.npy'
+            else:
+                chunks = csv_chunks(batches(), financial_columns, totals)
+                mimetype, filename = 'text/csv', 'decrypted_financial_data.csv'
+            path = result_file(os.path.splitext(filename)[1])
+            try:
+                with open(path, 'wb') as file:
+                    for chunk in chunks:
+                        file.write(chunk)
+            except Exception:
+                os.remove(path)
+                raise
+            return {'path': path, 'mimetype': mimetype, 'filename': filename}
+    return run
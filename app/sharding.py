@@ -0,0 +1,98 @@
+'''Sharded Aggregation Module
+
+Spreads the row-layout records over several nodes that share one public context.
+Each worker node holds a shard in its own record store and serves GET /shard/aggregate,
+which sums the shard into a single partial ciphertext at the lowest mod level that
+still holds the aggregate, in the serialised_encrypted wire format. The coordinator
+fetches the partials of every worker in parallel, checks they were encrypted under its
+context and reduces them, so one ciphertext per node crosses the network and only the
+coordinator holds the secret key and decrypts.
+'''
+import json
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from app.encryption import context_fingerprint, deserialised
+from app.aggregate import tree_sum
+
+# Seconds the coordinator waits for a worker's partial
+DEFAULT_SHARD_TIMEOUT = 60
+
+
+def split_shards(financial_data, n_shards, id_column='Record ID'):
+    '''
+    Splits a DataFrame into n_shards disjoint DataFrames by Record ID modulo n_shards.
+    '''
+    shard_ids = financial_data[id_column] % n_shards
+    return [financial_data[shard_ids == shard] for shard in range(n_shards)]
+
+def shard_url(url, query=None):
+    '''
+    Returns the partial aggregate URL of a worker node, with an optional query dict.
+    '''
+    shard = url.rstrip('/') + '/shard/aggregate'
+    if query:
+        shard += '?' + urllib.parse.urlencode(query, doseq=True)
+    return shard
+
+def fetch_partial(url, query=None, timeout=DEFAULT_SHARD_TIMEOUT):
+    '''
+    Fetches the partial aggregate of one worker node.
+    Raises urllib.error.URLError (or HTTPError) if the worker cannot be reached or fails.
+
+    Returns:
+        Dict: the worker's JSON response
+    '''
+    request = urllib.request.Request(shard_url(url, query), headers={'Accept': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def sharded_aggregate(urls, encryption_obj, query=None, timeout=DEFAULT_SHARD_TIMEOUT):
+    '''
+    Fetches the partial aggregates of every worker node in parallel and sums them.
+
+    Args:
+        urls: base URLs of the worker nodes
+        encryption_obj: Pyfhel object with the public context the workers encrypted under
+        query: dict of query parameters forwarded to every worker (e.g. columns)
+        timeout: seconds to wait for each worker
+
+    Returns:
+        Tuple: (PyCtxt sum or None if every shard is empty, dict of URL -> records summed,
+        dict of URL -> error message for the workers that failed)
+    '''
+    fingerprint = context_fingerprint(encryption_obj).hex()
+    partials = []
+    records = {}
+    errors = {}
+
+    def fetch(url):
+        try:
+            return url, fetch_partial(url, query, timeout), None
+        except urllib.error.HTTPError as e:
+            return url, None, f"HTTP {e.code}: {e.read().decode('utf-8', 'replace')[:200]}"
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            return url, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as executor:
+        for url, partial, error in executor.map(fetch, urls):
+            if error is not None:
+                print(f"Shard {url} failed: {error}")
+                errors[url] = error
+            elif partial.get('fingerprint') != fingerprint:
+                errors[url] = "Shard was encrypted under a different context"
+            else:
+                records[url] = partial['records']
+                if partial['data'] is not None:
+                    partials.append((url, partial))
+
+    ciphertexts = []
+    for url, partial in partials:
+        ciphertext = deserialised(partial['data'], encryption_obj, partial['mod_level'])
+        if ciphertext is None:
+            errors[url] = "Partial aggregate could not be deserialised"
+            records.pop(url, None)
+            continue
+        ciphertexts.append(ciphertext)
+    return tree_sum(ciphertexts), records, errors
@@ -0,0 +1,259 @@
+'''SQLite Ciphertext Store Module
+
+An alternative to the binary record store that keeps ciphertext BLOBs in a SQLite
+database in WAL mode, so readers never block the writer and records can be added
+incrementally without rewriting anything. It exposes the same create_store /
+append_records / store_id / record_count interface as app.store, so app.ingest can
+write to either.
+
+    store_info:   key -> value (context fingerprint, store id, mod level)
+    records:      position | Record ID | deleted | ciphertext BLOB, indexed on Record ID
+    record_keys:  position | dimension | value, indexed on (dimension, value)
+
+Queries filter on the indexes (a Record ID range and/or plaintext dimension values)
+and stream the matching ciphertexts through a cursor one batch at a time.
+'''
+import os
+import sqlite3
+from app.encryption import context_fingerprint, deserialised_bytes, mod_switch_to_level
+from app.aggregate import tree_sum
+from app.store import record_bytes
+from app.metrics import stage
+
+# Records inserted per transaction and fetched per cursor round trip
+INSERT_BATCH_SIZE = 512
+FETCH_BATCH_SIZE = 64
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS records (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    record_id INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    ciphertext BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_record_id ON records (record_id);
+CREATE TABLE IF NOT EXISTS record_keys (
+    position INTEGER NOT NULL REFERENCES records (position),
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS record_keys_dimension ON record_keys (dimension, value, position);
+'''
+
+
+def connect(path):
+    '''
+    Opens a connection to the store with WAL journaling enabled.
+    Raises FileNotFoundError if the database does not exist.
+    '''
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+def create_store(path, encryption_obj, mod_level=0):
+    '''
+    Creates an empty store (overwriting any existing one) stamped with the
+    fingerprint of the Pyfhel context and the mod level its records are kept at.
+    '''
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(SCHEMA)
+        with connection:
+            connection.executemany('INSERT INTO store_info (key, value) VALUES (?, ?)', [
+                ('fingerprint', context_fingerprint(encryption_obj)),
+                ('store_id', os.urandom(16)),
+                ('mod_level', mod_level),
+            ])
+    finally:
+        connection.close()
+
+def store_info(connection):
+    '''
+    Returns the store_info table as a dict.
+    '''
+    return dict(connection.execute('SELECT key, value FROM store_info'))
+
+def check_fingerprint(connection, encryption_obj):
+    '''
+    Raises ValueError if the store was written under a different context or public key.
+
+    Returns:
+        Dict: the store_info table
+    '''
+    info = store_info(connection)
+    if info.get('fingerprint') != context_fingerprint(encryption_obj):
+        raise ValueError("The SQLite store was encrypted under a different context")
+    return info
+
+def store_id(path, encryption_obj):
+    '''
+    Returns the random ID the store was created with, after checking its fingerprint.
+    '''
+    connection = connect(path)
+    try:
+        return bytes(check_fingerprint(connection, encryption_obj)['store_id'])
+    finally:
+        connection.close()
+
+def record_count(path):
+    '''
+    Returns the number of record positions in the store, including deleted ones.
+    '''
+    connection = connect(path)
+    try:
+        return connection.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+    finally:
+        connection.close()
+
+def append_records(path, encryption_obj, records, batch_size=INSERT_BATCH_SIZE):
+    '''
+    Inserts ciphertexts into the store, committing one transaction per batch.
+
+    Args:
+        path: store created with create_store
+        encryption_obj: Pyfhel object the ciphertexts were encrypted with
+        records: iterable of (Record ID, PyCtxt or to_bytes() output), optionally
+            followed by a dict of plaintext keys for the record
+        batch_size: number of records per transaction
+
+    Returns:
+        int: number of records appended
+    '''
+    connection = connect(path)
+    try:
+        mod_level = check_fingerprint(connection, encryption_obj)['mod_level']
+        n_records = 0
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                n_records += _insert_batch(connection, encryption_obj, mod_level, batch)
+                batch = []
+        if batch:
+            n_records += _insert_batch(connection, encryption_obj, mod_level, batch)
+        return n_records
+    finally:
+        connection.close()
+
+def _insert_batch(connection, encryption_obj, mod_level, batch):
+    '''
+    Inserts one batch of records and their plaintext keys in a single transaction.
+    '''
+    with connection:
+        for record_id, ciphertext, *keys in batch:
+            payload = ciphertext if isinstance(ciphertext, bytes) else \
+                record_bytes(mod_switch_to_level(encryption_obj, ciphertext, mod_level))
+            cursor = connection.execute('INSERT INTO records (record_id, ciphertext) VALUES (?, ?)',
+                                        (int(record_id), payload))
+            if keys and keys[0]:
+                connection.executemany(
+                    'INSERT INTO record_keys (position, dimension, value) VALUES (?, ?, ?)',
+                    [(cursor.lastrowid, dimension, str(value)) for dimension, value in keys[0].items()],
+                )
+    return len(batch)
+
+def delete_record(path, record_id):
+    '''
+    Marks every live record with the given Record ID as deleted.
+
+    Returns:
+        int: number of records deleted
+    '''
+    connection = connect(path)
+    try:
+        with connection:
+            cursor = connection.execute('UPDATE records SET deleted = 1 WHERE record_id = ? AND deleted = 0',
+                                        (int(record_id),))
+        return cursor.rowcount
+    finally:
+        connection.close()
+
+def build_filter(first_id=None, last_id=None, where=None):
+    '''
+    Builds the WHERE clause selecting live records in an inclusive Record ID range
+    whose plaintext keys match every dimension in where.
+
+    Args:
+        first_id, last_id: inclusive Record ID bounds (None leaves the side open)
+        where: dict of dimension -> value or list of accepted values
+
+    Returns:
+        Tuple: (SQL condition, parameters)
+    '''
+    conditions = ['deleted = 0']
+    parameters = []
+    if first_id is not None:
+        conditions.append('record_id >= ?')
+        parameters.append(int(first_id))
+    if last_id is not None:
+        conditions.append('record_id <= ?')
+        parameters.append(int(last_id))
+    for dimension, values in (where or {}).items():
+        values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+        placeholders = ', '.join('?' * len(values))
+        conditions.append('position IN (SELECT position FROM record_keys '
+                          f'WHERE dimension = ? AND value IN ({placeholders}))')
+        parameters.extend([dimension, *(str(value) for value in values)])
+    return ' AND '.join(conditions), parameters
+
+def iter_records(path, encryption_obj, first_id=None, last_id=None, where=None):
+    '''
+    Streams (Record ID, PyCtxt) pairs for the live records matching the filter in
+    insertion order, fetching FETCH_BATCH_SIZE rows per cursor round trip.
+    Raises ValueError if the store does not match the Pyfhel context.
+    '''
+    connection = connect(path)
+    try:
+        mod_level = check_fingerprint(connection, encryption_obj)['mod_level']
+        condition, parameters = build_filter(first_id, last_id, where)
+        cursor = connection.execute(
+            f'SELECT record_id, ciphertext FROM records WHERE {condition} ORDER BY position', parameters)
+        while True:
+            with stage('store_read'):
+                rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            for record_id, payload in rows:
+                ciphertext = deserialised_bytes(payload, encryption_obj, mod_level)
+                if ciphertext is None:
+                    print(f"Deserialization failed for Record ID: {record_id}")
+                    continue
+                yield record_id, ciphertext
+    finally:
+        connection.close()
+
+def count_records(path, first_id=None, last_id=None, where=None):
+    '''
+    Returns the number of live records matching the filter, using only the indexes.
+    '''
+    connection = connect(path)
+    try:
+        condition, parameters = build_filter(first_id, last_id, where)
+        return connection.execute(f'SELECT COUNT(*) FROM records WHERE {condition}', parameters).fetchone()[0]
+    finally:
+        connection.close()
+
+def filtered_aggregate(path, encryption_obj, first_id=None, last_id=None, where=None):
+    '''
+    Homomorphically sums the live records matching the filter, streaming them
+    through a cursor into a tree reduction.
+
+    Returns:
+        Tuple: (PyCtxt sum or None if nothing matched, number of records summed)
+    '''
+    n_records = 0
+    def ciphertexts():
+        nonlocal n_records
+        for _, ciphertext in iter_records(path, encryption_obj, first_id, last_id, where):
+            n_records += 1
+            yield ciphertext
+    total = tree_sum(ciphertexts())
+    return total, n_records
@@ -0,0 +1,233 @@
+'''Homomorphic Statistics Module
+
+Computes the count, sum, sum of squares and weighted sums of a row-layout record
+store in a single streaming pass. Each record is squared once with multiply_encrypted
+(all financial columns at the same time, one per slot) and the square feeds both the
+sum of squares and the variance. Weights and constants are plaintext, so they are
+encoded once per value and mod level and reused for every record that shares them.
+The mean is computed homomorphically from the sum and the plaintext count; the
+variance needs another multiplicative level the context does not have, so it is
+derived from the decrypted moments by decrypt_statistics.
+'''
+import os
+import numpy as np
+from app.encryption import (
+    add_encrypted,
+    multiply_encrypted,
+    decrypt_value,
+    deserialised_bytes,
+)
+from app.aggregate import MIN_PARTITION_SIZE, partition
+from app.keys import get_context, worker_pool
+from app import metrics
+from app.store import STORE_COMPRESSION, record_count, iter_records
+
+# Plaintexts kept per encodings cache; weights are usually shared by many records, so a
+# small least-recently-used cache catches the repeats without holding one plaintext per record
+MAX_ENCODINGS = 64
+
+# Public Pyfhel context owned by each worker process
+_worker_encryption_obj = None
+
+
+def _init_worker():
+    '''
+    Loads the public context once per worker process.
+    '''
+    global _worker_encryption_obj
+    _worker_encryption_obj = get_context()
+
+def encode_constant(encryption_obj, value, mod_level, encodings):
+    '''
+    Returns a plaintext holding value in every slot at the given mod level.
+    The encodings cache keeps the MAX_ENCODINGS most recently used (value, mod level) pairs.
+
+    Args:
+        encryption_obj: Pyfhel object
+        value: float to encode
+        mod_level: mod level of the ciphertexts the plaintext will multiply
+        encodings: dict used as the cache, least recently used entry first
+
+    Returns:
+        PyPtxt: the encoded constant
+    '''
+    key = (float(value), mod_level)
+    plaintext = encodings.pop(key, None)
+    if plaintext is None:
+        plaintext = encryption_obj.encode(float(value))
+        for _ in range(mod_level):
+            encryption_obj.mod_switch_to_next(plaintext)
+        if len(encodings) >= MAX_ENCODINGS:
+            del encodings[next(iter(encodings))]
+    encodings[key] = plaintext
+    return plaintext
+
+def empty_moments(weights=None):
+    '''
+    Returns the moments of an empty set of records.
+    '''
+    return {
+        'count': 0,
+        'sum': None,
+        'sum_of_squares': None,
+        'weighted_sums': {name: None for name in (weights or {})},
+    }
+
+def _add(total, ciphertext):
+    '''
+    Adds a ciphertext to a running total that may still be None.
+    '''
+    return ciphertext if total is None else add_encrypted(total, ciphertext)
+
+def accumulate_moments(encryption_obj, records, weights=None):
+    '''
+    Accumulates the moments of a stream of records in one pass.
+
+    Args:
+        encryption_obj: Pyfhel object with the public and relinearization keys loaded
+        records: iterable of (Record ID, PyCtxt)
+        weights: dict of weight vector name -> dict of Record ID -> plaintext weight.
+            Records missing from a weight vector have weight 0.
+
+    Returns:
+        Dict: count, sum, sum_of_squares and weighted_sums (name -> PyCtxt or None)
+    '''
+    weights = weights or {}
+    moments = empty_moments(weights)
+    encodings = {}
+    for record_id, ciphertext in records:
+        moments['count'] += 1
+        moments['sum'] = _add(moments['sum'], ciphertext)
+        square = multiply_encrypted(encryption_obj, ciphertext, ciphertext)
+        moments['sum_of_squares'] = _add(moments['sum_of_squares'], square)
+        for name, vector in weights.items():
+            weight = vector.get(record_id, 0.0)
+            if weight == 0:
+                continue
+            plaintext = encode_constant(encryption_obj, weight, ciphertext.mod_level, encodings)
+            product = multiply_encrypted(encryption_obj, ciphertext, plaintext)
+            moments['weighted_sums'][name] = _add(moments['weighted_sums'][name], product)
+    return moments
+
+def merge_moments(moments_1, moments_2):
+    '''
+    Combines the moments of two disjoint sets of records.
+    '''
+    return {
+        'count': moments_1['count'] + moments_2['count'],
+        'sum': _merge(moments_1['sum'], moments_2['sum']),
+        'sum_of_squares': _merge(moments_1['sum_of_squares'], moments_2['sum_of_squares']),
+        'weighted_sums': {
+            name: _merge(total, moments_2['weighted_sums'][name])
+            for name, total in moments_1['weighted_sums'].items()
+        },
+    }
+
+def _merge(total_1, total_2):
+    '''
+    Adds two running totals, either of which may be None.
+    '''
+    return total_2 if total_1 is None else _add(total_2, total_1)
+
+def _serialise_moments(moments):
+    '''
+    Converts moments to picklable (bytes, mod level) pairs for the trip back from a worker.
+    SEAL does not serialize the mod level, so it travels next to the bytes.
+    '''
+    def pack(ciphertext):
+        return None if ciphertext is None else (ciphertext.to_bytes(STORE_COMPRESSION), ciphertext.mod_level)
+    return {
+        'count': moments['count'],
+        'sum': pack(moments['sum']),
+        'sum_of_squares': pack(moments['sum_of_squares']),
+        'weighted_sums': {name: pack(total) for name, total in moments['weighted_sums'].items()},
+    }
+
+def _deserialise_moments(encryption_obj, moments):
+    '''
+    Reverses _serialise_moments.
+    '''
+    def unpack(packed):
+        return None if packed is None else deserialised_bytes(packed[0], encryption_obj, packed[1])
+    return {
+        'count': moments['count'],
+        'sum': unpack(moments['sum']),
+        'sum_of_squares': unpack(moments['sum_of_squares']),
+        'weighted_sums': {name: unpack(packed) for name, packed in moments['weighted_sums'].items()},
+    }
+
+def _partition_moments(path, start, stop, weights):
+    '''
+    Accumulates the moments of records [start, stop) inside a worker process.
+    '''
+    records = iter_records(path, _worker_encryption_obj, start, stop)
+    return _serialise_moments(accumulate_moments(_worker_encryption_obj, records, weights))
+
+def parallel_statistics(path, encryption_obj, weights=None, workers=None):
+    '''
+    Computes the statistics of every live record in a row-layout store.
+    The store is split into contiguous partitions whose moments are accumulated on
+    worker processes and merged; small stores are processed in-process.
+
+    Args:
+        path: record store written by app.store
+        encryption_obj: Pyfhel object with the public and relinearization keys loaded
+        weights: dict of weight vector name -> dict of Record ID -> plaintext weight
+        workers: maximum number of worker processes (defaults to the CPU count)
+
+    Returns:
+        Dict: count (plaintext), sum, sum_of_squares, mean and weighted_sums as PyCtxt,
+        or None for the ciphertexts when the store has no live records
+    '''
+    workers = workers or os.cpu_count() or 1
+    n_records = record_count(path)
+    n_partitions = min(workers, -(-n_records // MIN_PARTITION_SIZE))
+    if n_partitions <= 1:
+        moments = accumulate_moments(encryption_obj, iter_records(path, encryption_obj), weights)
+    else:
+        starts, stops = zip(*partition(n_records, n_partitions))
+        moments = empty_moments(weights)
+        with worker_pool(n_partitions, _init_worker) as executor:
+            partials = executor.map(metrics.measured(_partition_moments), [path] * n_partitions, starts, stops,
+                                    [weights] * n_partitions)
+            for partial in metrics.merged(partials):
+                moments = merge_moments(moments, _deserialise_moments(encryption_obj, partial))
+
+    moments['mean'] = None
+    if moments['count']:
+        inverse_count = encode_constant(encryption_obj, 1.0 / moments['count'], moments['sum'].mod_level, {})
+        moments['mean'] = multiply_encrypted(encryption_obj, moments['sum'], inverse_count)
+    return moments
+
+def decrypt_statistics(encryption_obj, moments, n_columns):
+    '''
+    Decrypts the output of parallel_statistics and derives the population variance
+    as E[x^2] - E[x]^2 from the decrypted sum and sum of squares.
+
+    Args:
+        encryption_obj: Pyfhel object with the secret key loaded
+        moments: dict returned by parallel_statistics
+        n_columns: number of financial columns (slots) per record
+
+    Returns:
+        Dict: count and one NumPy array of n_columns values per statistic,
+        with weighted_sums as a dict of name -> array
+    '''
+    def decrypt(ciphertext):
+        if ciphertext is None:
+            return np.zeros(n_columns)
+        return np.asarray(decrypt_value(encryption_obj, ciphertext)[:n_columns], dtype=np.float64)
+
+    count = moments['count']
+    total = decrypt(moments['sum'])
+    sum_of_squares = decrypt(moments['sum_of_squares'])
+    mean = total / count if count else np.zeros(n_columns)
+    variance = sum_of_squares / count - mean ** 2 if count else np.zeros(n_columns)
+    return {
+        'count': count,
+        'sum': total,
+        'mean': decrypt(moments['mean']),
+        'sum_of_squares': sum_of_squares,
+        'variance': variance,
+        'weighted_sums': {name: decrypt(weighted) for name, weighted in moments['weighted_sums'].items()},
+    }
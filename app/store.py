@@ -0,0 +1,283 @@
+'''Binary Ciphertext Store Module
+
+Records are kept in an append-only file of length-prefixed ciphertexts:
+
+    header:  MAGIC (8 bytes) | version (uint16) | context fingerprint (32 bytes) | store id (16 bytes)
+             | mod level (uint16)
+    record:  Record ID (int64) | keys length (uint32) | payload length (uint32)
+             | plaintext keys (UTF-8 JSON object, may be empty) | payload (to_bytes() output)
+
+The plaintext keys hold the grouping dimensions of a record (region, month, ...) so
+group-by queries can route records without decrypting anything.
+
+A sidecar '<path>.idx' file holds one (Record ID, offset) entry per record so
+readers can seek straight to any record, and '<path>.del' lists the positions of
+deleted records. All three files are only ever appended to, and the data file is
+read through mmap so memory use stays flat as it grows. The random store id
+changes every time the store is recreated, so caches can detect a rewrite.
+Every record is mod-switched to the level in the header before it is written; SEAL
+does not serialize that level, so readers restore it on each deserialized ciphertext.
+'''
+import os
+import json
+import mmap
+import struct
+from collections import namedtuple
+import numpy as np
+from app.encryption import COMPRESSION_MODES, context_fingerprint, ciphertext_bytes, deserialised_bytes, mod_switch_to_level
+from app.metrics import stage
+
+MAGIC = b'PHESTORE'
+VERSION = 4
+HEADER = struct.Struct('<8sH32s16sH')
+RECORD_HEADER = struct.Struct('<qII')
+INDEX_ENTRY = struct.Struct('<qQ')
+TOMBSTONE = struct.Struct('<Q')
+INDEX_DTYPE = np.dtype([('record_id', '<i8'), ('offset', '<u8')])
+
+# Native Pyfhel compression of internal partial sums, and the default for stored records
+STORE_COMPRESSION = 'zstd'
+
+# Compression of records written to a store, set from the app's STORE_COMPRESSION config
+_store_compression = STORE_COMPRESSION
+
+StoreHeader = namedtuple('StoreHeader', ['version', 'fingerprint', 'store_id', 'mod_level'])
+
+
+def configure_compression(compression):
+    '''
+    Sets the compression of records written from now on, one of COMPRESSION_MODES.
+    Stores may mix modes: readers detect the mode of every record.
+    '''
+    global _store_compression
+    if compression not in COMPRESSION_MODES:
+        raise ValueError(f"Unknown compression mode '{compression}'")
+    _store_compression = compression
+
+def store_compression():
+    '''
+    Returns the compression records are written with.
+    '''
+    return _store_compression
+
+def record_bytes(ciphertext, compression=None):
+    '''
+    Serializes a ciphertext for a store with the configured compression (or the given one).
+    '''
+    return ciphertext_bytes(ciphertext, compression or _store_compression)
+
+def index_path(path):
+    '''
+    Returns the path of the offset index that accompanies a store file.
+    '''
+    return f"{path}.idx"
+
+def tombstone_path(path):
+    '''
+    Returns the path of the deleted-record list that accompanies a store file.
+    '''
+    return f"{path}.del"
+
+def create_store(path, encryption_obj, mod_level=0):
+    '''
+    Creates an empty store (overwriting any existing one) stamped with the
+    fingerprint of the Pyfhel context and the mod level its records are kept at.
+    '''
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, context_fingerprint(encryption_obj), os.urandom(16), mod_level))
+    for sidecar in (index_path(path), tombstone_path(path)):
+        with open(sidecar, 'wb'):
+            pass
+
+def read_header(path):
+    '''
+    Reads and validates the store header.
+
+    Returns:
+        StoreHeader: (version, context fingerprint, store id, mod level)
+    '''
+    with open(path, 'rb') as file:
+        try:
+            magic, version, fingerprint, store_id, mod_level = HEADER.unpack(file.read(HEADER.size))
+        except struct.error:
+            raise ValueError(f"{path} is not a version {VERSION} encrypted record store")
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} encrypted record store")
+    return StoreHeader(version, fingerprint, store_id, mod_level)
+
+def check_fingerprint(path, encryption_obj):
+    '''
+    Raises ValueError if the store was written under a different context or public key.
+
+    Returns:
+        StoreHeader: the validated header
+    '''
+    header = read_header(path)
+    if header.fingerprint != context_fingerprint(encryption_obj):
+        raise ValueError(f"{path} was encrypted under a different context")
+    return header
+
+def store_id(path, encryption_obj):
+    '''
+    Returns the random ID the store was created with, after checking its fingerprint.
+    '''
+    return check_fingerprint(path, encryption_obj).store_id
+
+def append_records(path, encryption_obj, records):
+    '''
+    Appends ciphertexts to the store. The data is flushed before the index so an
+    interrupted write never leaves an index entry pointing past the end of the data.
+    PyCtxt records are switched down to the store's mod level; bytes are written as
+    given and must already be at that level.
+
+    Args:
+        path: store file created with create_store
+        encryption_obj: Pyfhel object the ciphertexts were encrypted with
+        records: iterable of (Record ID, PyCtxt or to_bytes() output), optionally
+            followed by a dict of plaintext keys for the record
+
+    Returns:
+        int: number of records appended
+    '''
+    mod_level = check_fingerprint(path, encryption_obj).mod_level
+    index_entries = []
+    with open(path, 'ab') as file:
+        offset = file.tell()
+        for record_id, ciphertext, *keys in records:
+            payload = ciphertext if isinstance(ciphertext, bytes) else \
+                record_bytes(mod_switch_to_level(encryption_obj, ciphertext, mod_level))
+            key_bytes = json.dumps(keys[0], ensure_ascii=False).encode('utf-8') if keys and keys[0] else b''
+            file.write(RECORD_HEADER.pack(int(record_id), len(key_bytes), len(payload)))
+            file.write(key_bytes)
+            file.write(payload)
+            index_entries.append(INDEX_ENTRY.pack(int(record_id), offset))
+            offset += RECORD_HEADER.size + len(key_bytes) + len(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    with open(index_path(path), 'ab') as file:
+        file.write(b''.join(index_entries))
+    return len(index_entries)
+
+def record_count(path):
+    '''
+    Returns the number of record positions in the store, including deleted ones.
+    '''
+    return os.path.getsize(index_path(path)) // INDEX_ENTRY.size
+
+def deleted_positions(path):
+    '''
+    Returns the set of deleted record positions.
+    '''
+    try:
+        with open(tombstone_path(path), 'rb') as file:
+            return {position for (position,) in TOMBSTONE.iter_unpack(file.read())}
+    except FileNotFoundError:
+        return set()
+
+def find_record(path, record_id):
+    '''
+    Returns the position of the first live record with the given Record ID, or None.
+    '''
+    deleted = deleted_positions(path)
+    with open(index_path(path), 'rb') as index_file:
+        index = index_file.read()
+    for position, (indexed_id, _) in enumerate(INDEX_ENTRY.iter_unpack(index)):
+        if indexed_id == record_id and position not in deleted:
+            return position
+    return None
+
+def delete_record(path, position):
+    '''
+    Marks the record at a position as deleted. Readers skip deleted records.
+    '''
+    with open(tombstone_path(path), 'ab') as file:
+        file.write(TOMBSTONE.pack(position))
+
+def iter_raw_records(path, start=0, stop=None):
+    '''
+    Streams (Record ID, payload bytes) pairs for live records at positions [start, stop)
+    through mmap. Only the requested record is copied out of the mapping, so memory stays flat.
+    '''
+    count = record_count(path)
+    stop = count if stop is None else min(stop, count)
+    if start >= stop:
+        return
+    deleted = deleted_positions(path)
+    with open(index_path(path), 'rb') as index_file:
+        index_file.seek(start * INDEX_ENTRY.size)
+        index = index_file.read((stop - start) * INDEX_ENTRY.size)
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for position, (_, offset) in enumerate(INDEX_ENTRY.iter_unpack(index), start):
+            if position in deleted:
+                continue
+            with stage('store_read'):
+                record_id, key_length, length = RECORD_HEADER.unpack_from(mapped, offset)
+                payload_start = offset + RECORD_HEADER.size + key_length
+                payload = mapped[payload_start:payload_start + length]
+            yield record_id, payload
+
+def iter_record_keys(path):
+    '''
+    Streams (position, Record ID, plaintext keys dict) for every live record without
+    touching the ciphertext payloads.
+    '''
+    count = record_count(path)
+    if count == 0:
+        return
+    deleted = deleted_positions(path)
+    with open(index_path(path), 'rb') as index_file:
+        index = index_file.read(count * INDEX_ENTRY.size)
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for position, (_, offset) in enumerate(INDEX_ENTRY.iter_unpack(index)):
+            if position in deleted:
+                continue
+            record_id, key_length, _ = RECORD_HEADER.unpack_from(mapped, offset)
+            key_start = offset + RECORD_HEADER.size
+            keys = json.loads(mapped[key_start:key_start + key_length]) if key_length else {}
+            yield position, record_id, keys
+
+def read_records(path, encryption_obj, positions):
+    '''
+    Reads the records at the given positions (deleted or not) through a single mmap.
+
+    Returns:
+        List: PyCtxt objects in the order of positions
+    '''
+    mod_level = check_fingerprint(path, encryption_obj).mod_level
+    ciphertexts = []
+    with open(index_path(path), 'rb') as index_file, open(path, 'rb') as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for position in positions:
+            with stage('store_read'):
+                index_file.seek(position * INDEX_ENTRY.size)
+                _, offset = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+                _, key_length, length = RECORD_HEADER.unpack_from(mapped, offset)
+                payload_start = offset + RECORD_HEADER.size + key_length
+                payload = mapped[payload_start:payload_start + length]
+            ciphertexts.append(deserialised_bytes(payload, encryption_obj, mod_level))
+    return ciphertexts
+
+def record_ids(path):
+    '''
+    Returns the Record IDs of every record position as a NumPy int64 array.
+    '''
+    with open(index_path(path), 'rb') as index_file:
+        index = index_file.read()
+    return np.frombuffer(index, dtype=INDEX_DTYPE)['record_id'].copy()
+
+def iter_records(path, encryption_obj, start=0, stop=None, strict=False):
+    '''
+    Streams (Record ID, PyCtxt) pairs for live records at positions [start, stop),
+    one ciphertext at a time. Records that fail to deserialize are skipped, or raise
+    ValueError when strict is True.
+    Raises ValueError if the store does not match the Pyfhel context.
+    '''
+    mod_level = check_fingerprint(path, encryption_obj).mod_level
+    for record_id, payload in iter_raw_records(path, start, stop):
+        ciphertext = deserialised_bytes(payload, encryption_obj, mod_level)
+        if ciphertext is None:
+            if strict:
+                raise ValueError(f"Deserialization failed for Record ID: {record_id}")
+            print(f"Deserialization failed for Record ID: {record_id}")
+            continue
+        yield record_id, ciphertext
@@ -0,0 +1,270 @@
+'''CKKS Parameter Tuning Module
+
+Chooses the smallest secure CKKS parameters for a workload instead of the fixed
+n = 2^14, qi_sizes = [60, 30, 30, 30, 60], scale = 2^30 defaults:
+
+    value bits   log2 of the largest aggregate: max |value| x expected records,
+                 with max |value| squared when the queries multiply (depth > 0)
+    scale bits   enough for the requested absolute precision above the estimated
+                 CKKS noise, which grows with sqrt(n) and sqrt(records)
+    modulus      base primes holding scale + value bits + MOD_SWITCH_MARGIN_BITS,
+                 one scale-sized prime per multiplication (at least STORE_DEPTH, since
+                 column projections multiply stored records by a mask) and a special
+                 prime for key switching at least as large as every other prime
+    n            the smallest ring whose 128-bit security budget (HE standard) fits
+                 the modulus and whose n/2 slots fit the columns
+
+The choice is then checked by encrypting a sample of the data with a throwaway
+context; if a check fails the scale is raised and the choice is made again.
+The chosen profile is saved next to the keys as PROFILE_FILE.
+'''
+import json
+import math
+import os
+import numpy as np
+from Pyfhel import Pyfhel
+from app.encryption import (
+    KEY_DIR,
+    PROFILE_FILE,
+    MOD_SWITCH_MARGIN_BITS,
+    encrypt_value,
+    decrypt_value,
+    add_encrypted,
+    multiply_encrypted,
+    lowest_mod_level,
+    mod_switch_to_level,
+)
+from app.ingest import STORE_DEPTH
+from app.packing import project_slots
+
+# Maximum total coefficient modulus bits for 128-bit classical security per n
+SECURITY_BITS = {2**12: 109, 2**13: 218, 2**14: 438, 2**15: 881}
+
+# SEAL primes must be congruent to 1 mod 2n, so they cannot be too small, and at most 60 bits
+MIN_PRIME_BITS = 20
+MAX_PRIME_BITS = 60
+
+# log2 of the noise of a fresh ciphertext, on top of log2(n) / 2
+NOISE_BITS = 8
+
+# Scale bits added after every failed sample check, and how many times to try
+SCALE_STEP_BITS = 4
+MAX_ATTEMPTS = 4
+
+# Rows of the dataset encrypted to check a profile
+SAMPLE_SIZE = 64
+
+DEFAULT_PRECISION = 0.01
+
+# Relative error allowed on the largest aggregate, whose absolute error is bounded by
+# float64 rather than CKKS noise; an overflowing modulus gives errors of order 1
+BOUND_TOLERANCE = 1e-9
+
+
+def value_bits(max_abs, expected_records, depth=0):
+    '''
+    Returns the bits needed for the largest aggregate of expected_records values of
+    magnitude up to max_abs. A query that multiplies sums products of two values.
+    '''
+    largest = max(float(max_abs), 1.0)
+    if depth > 0:
+        largest = largest ** 2
+    return math.ceil(math.log2(largest * max(int(expected_records), 1)))
+
+def scale_bits(n_value, expected_records, precision, depth=0):
+    '''
+    Returns the scale bits needed for an absolute error of at most precision after
+    summing expected_records ciphertexts, with two more noise bits per multiplication.
+    '''
+    noise_bits = NOISE_BITS + math.log2(n_value) / 2 + math.log2(max(int(expected_records), 1)) / 2 + 2 * depth
+    return max(MIN_PRIME_BITS, math.ceil(noise_bits + math.log2(1 / precision)))
+
+def split_primes(n_bits):
+    '''
+    Splits n_bits into as few primes of at most MAX_PRIME_BITS as possible, of nearly equal size.
+    '''
+    n_primes = max(1, math.ceil(n_bits / MAX_PRIME_BITS))
+    size = max(MIN_PRIME_BITS, math.ceil(n_bits / n_primes))
+    return [size] * n_primes
+
+def modulus_chain(scale, values, depth=0):
+    '''
+    Returns qi_sizes: the base primes, one scale-sized prime per multiplication,
+    then the special prime.
+    '''
+    data_primes = split_primes(scale + values + MOD_SWITCH_MARGIN_BITS) + [scale] * depth
+    return data_primes + [max(data_primes)]
+
+def rescale_depth(depth):
+    '''
+    Returns the multiplications the modulus chain must allow for queries of the given
+    depth. Records are stored with STORE_DEPTH levels left, which ?columns= projections
+    use even for addition-only workloads.
+    '''
+    return max(int(depth), STORE_DEPTH)
+
+def choose_parameters(max_abs, expected_records, n_columns, depth=0, precision=DEFAULT_PRECISION,
+                      extra_scale_bits=0):
+    '''
+    Returns the smallest secure (n, scale bits, qi_sizes) for a workload, or None if
+    even the largest n cannot hold it.
+    '''
+    values = value_bits(max_abs, expected_records, depth)
+    levels = rescale_depth(depth)
+    for n_value, max_bits in sorted(SECURITY_BITS.items()):
+        if n_value // 2 < n_columns:
+            continue
+        scale = scale_bits(n_value, expected_records, precision, levels) + extra_scale_bits
+        if scale > MAX_PRIME_BITS:
+            return None
+        qi_sizes = modulus_chain(scale, values, levels)
+        if sum(qi_sizes) <= max_bits:
+            return n_value, scale, qi_sizes
+    return None
+
+def check_profile(profile, values):
+    '''
+    Checks a profile on a sample of the data with a throwaway context: the sample sum
+    (and with depth > 0 the sum of squares) must decrypt within the precision, the sum
+    must survive a column projection from the level records are stored at, and the
+    largest expected aggregate must survive being switched down to the level results
+    are returned at. Errors on squares are compared with the precision times max |value|,
+    and the error on the largest aggregate with BOUND_TOLERANCE of its size.
+
+    Args:
+        profile: dict returned by tune_parameters
+        values: 2-D float array with one row per record
+
+    Returns:
+        float: the largest error relative to its allowance (<= 1 passes)
+    '''
+    encryption_obj = Pyfhel()
+    encryption_obj.contextGen(scheme='CKKS', n=profile['n_value'], scale=2**profile['scale_bits'],
+                              qi_sizes=profile['qi_sizes'])
+    encryption_obj.keyGen()
+    encryption_obj.relinKeyGen()
+
+    sample = values[:SAMPLE_SIZE]
+    n_columns = sample.shape[1]
+    precision = profile['precision']
+    ratios = []
+
+    total = squares = None
+    for row in sample:
+        ciphertext = encrypt_value(encryption_obj, row)
+        total = ciphertext if total is None else add_encrypted(total, ciphertext)
+        if profile['depth'] > 0:
+            square = multiply_encrypted(encryption_obj, ciphertext, ciphertext)
+            squares = square if squares is None else add_encrypted(squares, square)
+    error = np.abs(np.asarray(decrypt_value(encryption_obj, total)[:n_columns]) - sample.sum(axis=0)).max()
+    ratios.append(error / precision)
+    stored = mod_switch_to_level(encryption_obj, total, lowest_mod_level(encryption_obj, depth=STORE_DEPTH))
+    projected = np.asarray(decrypt_value(encryption_obj, project_slots(encryption_obj, stored, [0]))[:n_columns])
+    expected = np.zeros(n_columns)
+    expected[0] = sample[:, 0].sum()
+    ratios.append(np.abs(projected - expected).max() / precision)
+    if squares is not None:
+        expected = (sample ** 2).sum(axis=0)
+        error = np.abs(np.asarray(decrypt_value(encryption_obj, squares)[:n_columns]) - expected).max()
+        ratios.append(error / (precision * max(profile['max_abs'], 1.0)))
+
+    bound = np.full(n_columns, 2.0 ** profile['value_bits'] - 1)
+    level = lowest_mod_level(encryption_obj, value_bits=profile['value_bits'])
+    ciphertext = mod_switch_to_level(encryption_obj, encrypt_value(encryption_obj, bound), level)
+    error = np.abs(np.asarray(decrypt_value(encryption_obj, ciphertext)[:n_columns]) - bound).max()
+    ratios.append(error / max(precision, bound[0] * BOUND_TOLERANCE))
+    return float(max(ratios))
+
+def sample_frames(frames, columns):
+    '''
+    Streams the DataFrames of a dataset (e.g. from read_csv_chunks) and keeps only what
+    tune_parameters needs, so the dataset is never held in memory at once.
+
+    Args:
+        frames: iterable of DataFrames
+        columns: financial columns to sample
+
+    Returns:
+        Tuple: (the first SAMPLE_SIZE rows as a 2-D float array, max |value|, number of rows)
+    '''
+    sample = np.empty((0, len(columns)))
+    max_abs = 0.0
+    n_rows = 0
+    for frame in frames:
+        values = frame[columns].to_numpy(dtype=np.float64)
+        if len(sample) < SAMPLE_SIZE:
+            sample = np.vstack((sample, values[:SAMPLE_SIZE - len(sample)]))
+        if values.size:
+            max_abs = max(max_abs, float(np.abs(values).max()))
+        n_rows += len(values)
+    return sample, max_abs, n_rows
+
+def tune_parameters(values, expected_records=None, depth=0, precision=DEFAULT_PRECISION, max_abs=None):
+    '''
+    Chooses and checks CKKS parameters for a dataset.
+
+    Args:
+        values: 2-D float array of the financial columns, one row per record
+            (or a sample of them, see sample_frames)
+        expected_records: records a single aggregate will cover (defaults to the rows of values)
+        depth: multiplications queries apply before summing (0 for sums only,
+            1 for statistics and weighted sums via multiply_encrypted)
+        precision: largest acceptable absolute error of an aggregate
+        max_abs: largest |value| of the dataset when values is only a sample of it
+            (defaults to the largest of values)
+
+    Returns:
+        Dict: the profile (n_value, scale_bits, qi_sizes, value_bits and the inputs),
+        or None if no secure parameters pass the check
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    expected_records = int(expected_records or len(values))
+    if max_abs is None:
+        max_abs = float(np.abs(values).max()) if values.size else 0.0
+    for attempt in range(MAX_ATTEMPTS):
+        parameters = choose_parameters(max_abs, expected_records, values.shape[1], depth, precision,
+                                       extra_scale_bits=attempt * SCALE_STEP_BITS)
+        if parameters is None:
+            break
+        n_value, scale, qi_sizes = parameters
+        profile = {
+            'n_value': n_value,
+            'scale_bits': scale,
+            'qi_sizes': qi_sizes,
+            'value_bits': value_bits(max_abs, expected_records, depth),
+            'depth': depth,
+            'precision': precision,
+            'expected_records': expected_records,
+            'max_abs': max_abs,
+        }
+        error_ratio = check_profile(profile, values)
+        if error_ratio <= 1:
+            profile['checked_error_ratio'] = round(error_ratio, 6)
+            return profile
+        print(f"Parameters n={n_value}, scale=2^{scale}, qi_sizes={qi_sizes} missed the precision "
+              f"by {error_ratio:.1f}x on the sample, raising the scale")
+    print("No secure CKKS parameters meet the requested precision")
+    return None
+
+def profile_path():
+    '''
+    Returns the path the tuning profile is saved to, next to the keys it was generated for.
+    '''
+    return os.path.join(KEY_DIR, PROFILE_FILE)
+
+def save_profile(profile):
+    '''
+    Saves a tuning profile next to the keys.
+    '''
+    with open(profile_path(), 'w', encoding='utf-8') as file:
+        json.dump(profile, file, indent=2)
+
+def load_profile():
+    '''
+    Returns the profile the current keys were generated from, or None for untuned keys.
+    '''
+    try:
+        with open(profile_path(), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
@@ -0,0 +1,77 @@
+'''
+Ciphertext serialisation benchmark.
+
+Prints the bytes per record and encode/decode time of every compression mode at the
+full modulus level, the level records are stored at and the level aggregates are
+returned at. Base64 is included for the JSON wire format.
+
+    python -m benchmarks.serialisation [--records 20]
+'''
+import argparse
+import base64
+import time
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+from app.encryption import (
+    COMPRESSION_MODES,
+    encrypt_value,
+    ciphertext_bytes,
+    deserialised_bytes,
+    lowest_mod_level,
+    mod_switch_to_level,
+)
+from app.ingest import STORE_DEPTH
+from app.keys import get_context
+
+
+def benchmark_mode(encryption_obj, ciphertexts, compression, mod_level):
+    '''
+    Serialises and deserialises ciphertexts at a mod level with one compression mode.
+
+    Returns:
+        Dict: mean bytes per record, base64 bytes per record and encode/decode milliseconds
+    '''
+    switched = [mod_switch_to_level(encryption_obj, ciphertext, mod_level) for ciphertext in ciphertexts]
+
+    start_time = time.perf_counter()
+    payloads = [ciphertext_bytes(ciphertext, compression) for ciphertext in switched]
+    encode_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for payload in payloads:
+        deserialised_bytes(payload, encryption_obj, mod_level)
+    decode_seconds = time.perf_counter() - start_time
+
+    n_records = len(payloads)
+    return {
+        'mode': compression,
+        'mod level': mod_level,
+        'bytes/record': sum(len(payload) for payload in payloads) // n_records,
+        'base64 bytes/record': sum(len(base64.b64encode(payload)) for payload in payloads) // n_records,
+        'encode ms': round(encode_seconds / n_records * 1000, 2),
+        'decode ms': round(decode_seconds / n_records * 1000, 2),
+    }
+
+def main():
+    '''Runs the benchmark on the first rows of the sample dataset'''
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20, help='number of records to encrypt')
+    parser.add_argument('--data', default='data/financial_data.csv', help='CSV file with a Record ID column')
+    args = parser.parse_args()
+
+    encryption_obj = get_context()
+    financial_data = pd.read_csv(args.data).head(args.records)
+    values = financial_data.drop(columns=['Record ID']).to_numpy(dtype=np.float64)
+    ciphertexts = [encrypt_value(encryption_obj, row) for row in values]
+
+    levels = sorted({0, lowest_mod_level(encryption_obj, depth=STORE_DEPTH), lowest_mod_level(encryption_obj)})
+    results = [
+        benchmark_mode(encryption_obj, ciphertexts, compression, mod_level)
+        for mod_level in levels
+        for compression in COMPRESSION_MODES
+    ]
+    print(tabulate(results, headers='keys', tablefmt='pretty'))
+
+if __name__ == '__main__':
+    main()
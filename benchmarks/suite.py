@@ -0,0 +1,354 @@
+'''
+Benchmark suite for the encryption and aggregation hot paths.
+
+Every point of a grid of CKKS parameters (n_value, scale_bits, qi_sizes) runs in its
+own subprocess with scratch keys (PHE_KEY_DIR), so peak RSS is measured per point and
+keys/ is never touched. A point measures:
+
+    generate_keys, load_context_public       --repeats calls each
+    encrypt_value, decrypt_value,
+    serialised_encrypted, deserialised       one call per row of --samples synthetic rows
+    ingest                                   parallel_encrypt of each --rows dataset
+    aggregation                              GET /aggregation?refresh=true on that dataset
+
+and reports throughput (calls or rows per second), p50/p99 latency and bytes per
+ciphertext. ru_maxrss only ever grows within a process, so peak RSS is reported once
+per point, as a 'peak_rss' result recorded after every benchmark has run. Keys are
+generated with the rotation profile of the column layout, as the app generates them.
+Results are written as JSON; --baseline compares them with an earlier run. The suite exits with status 1 if any point failed, if any metric got worse
+by more than --threshold or if a baseline result is missing from the run.
+
+    python -m benchmarks.suite [--grid quick|full] [--rows 100 1000] [--output results.json]
+    python -m benchmarks.suite --grid full --rows 100 10000 1000000
+    python -m benchmarks.suite --baseline results.json --threshold 0.2
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+from Pyfhel import __version__ as pyfhel_version
+from app import create_app, routes
+from app.encryption import (
+    KEY_DIR,
+    DEFAULT_COMPRESSION,
+    generate_keys,
+    load_context_public,
+    load_secret,
+    encrypt_value,
+    decrypt_value,
+    ciphertext_bytes,
+    serialised_encrypted,
+    deserialised,
+)
+from app.ingest import parallel_encrypt
+from app.packing import ROW_LAYOUT, COLUMN_LAYOUT, rotation_profile
+
+# CKKS parameter grids; the quick grid is the parameter set the app ships with
+GRIDS = {
+    'quick': [
+        {'n_value': 2**14, 'scale_bits': 30, 'qi_sizes': [60, 30, 30, 30, 60]},
+    ],
+    'full': [
+        {'n_value': 2**13, 'scale_bits': 30, 'qi_sizes': [60, 30, 30, 60]},
+        {'n_value': 2**14, 'scale_bits': 30, 'qi_sizes': [60, 30, 30, 30, 60]},
+        {'n_value': 2**14, 'scale_bits': 40, 'qi_sizes': [60, 40, 40, 40, 60]},
+        {'n_value': 2**15, 'scale_bits': 40, 'qi_sizes': [60, 40, 40, 40, 40, 60]},
+    ],
+}
+
+# Metrics checked for regressions, mapped to True where higher is better
+REGRESSION_METRICS = {
+    'throughput': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False,
+    'bytes_per_ciphertext': False,
+}
+
+
+def latency_summary(seconds, items_per_call=1):
+    '''
+    Summarises timed calls.
+
+    Args:
+        seconds: duration of each call
+        items_per_call: rows handled by each call, for the throughput
+
+    Returns:
+        Dict: calls, throughput (items per second) and p50/p99 latency in milliseconds
+    '''
+    seconds = np.asarray(seconds, dtype=np.float64)
+    total = seconds.sum()
+    return {
+        'calls': len(seconds),
+        'throughput': items_per_call * len(seconds) / total if total > 0 else 0.0,
+        'p50_ms': float(np.percentile(seconds, 50) * 1000),
+        'p99_ms': float(np.percentile(seconds, 99) * 1000),
+    }
+
+def peak_rss():
+    '''
+    Returns the peak resident set size in MiB of this process and of its largest
+    finished child process (worker pools), which ru_maxrss tracks separately.
+    Both are high-water marks since the process started, so they cover everything
+    run before the call.
+    '''
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return {'peak_rss_mb': round(own / 2**20, 1), 'peak_child_rss_mb': round(children / 2**20, 1)}
+
+def timed_calls(function, arguments):
+    '''
+    Calls function once per argument.
+
+    Returns:
+        Tuple: (list of results, list of seconds per call)
+    '''
+    results = []
+    seconds = []
+    for argument in arguments:
+        start_time = time.perf_counter()
+        results.append(function(argument))
+        seconds.append(time.perf_counter() - start_time)
+    return results, seconds
+
+def synthetic_data(n_rows, columns, seed=0):
+    '''
+    Returns a DataFrame of n_rows random financial records with the given columns.
+    '''
+    rng = np.random.default_rng(seed)
+    financial_data = pd.DataFrame(np.round(rng.uniform(0, 100000, (n_rows, len(columns))), 2), columns=columns)
+    financial_data.insert(0, 'Record ID', np.arange(1, n_rows + 1))
+    return financial_data
+
+def run_point(point, rows, samples, repeats, scratch, workers=None):
+    '''
+    Runs every benchmark for one set of CKKS parameters. Keys are generated into
+    KEY_DIR, which main() points at a scratch directory through PHE_KEY_DIR.
+
+    Returns:
+        List: one result dict per benchmark and dataset size, then the point's peak RSS
+    '''
+    results = []
+    def record(benchmark, summary, n_rows=None, **fields):
+        results.append({'benchmark': benchmark, **point, 'rows': n_rows, **summary, **fields})
+
+    keygen_params = {
+        'n_value': point['n_value'],
+        'scale_bits': point['scale_bits'],
+        'qi_sizes': point['qi_sizes'],
+        'rotation_steps': rotation_profile(COLUMN_LAYOUT, point['n_value']),
+    }
+    generated, seconds = timed_calls(lambda _: generate_keys(**keygen_params), range(repeats))
+    if not all(generated):
+        raise RuntimeError(f"Key generation failed for {point}")
+    key_bytes = sum(os.path.getsize(os.path.join(KEY_DIR, file)) for file in os.listdir(KEY_DIR))
+    record('generate_keys', latency_summary(seconds), key_bytes=key_bytes)
+
+    _, seconds = timed_calls(lambda _: load_context_public(), range(repeats))
+    record('load_context_public', latency_summary(seconds))
+    encryption_obj = load_secret(load_context_public())
+
+    columns = routes.financial_columns
+    values = synthetic_data(samples, columns).drop(columns=['Record ID']).to_numpy(dtype=np.float64)
+    ciphertexts, seconds = timed_calls(lambda row: encrypt_value(encryption_obj, row), values)
+    raw_bytes = np.mean([len(ciphertext_bytes(ciphertext, DEFAULT_COMPRESSION)) for ciphertext in ciphertexts])
+    record('encrypt_value', latency_summary(seconds), bytes_per_ciphertext=float(raw_bytes))
+
+    _, seconds = timed_calls(lambda ciphertext: decrypt_value(encryption_obj, ciphertext), ciphertexts)
+    record('decrypt_value', latency_summary(seconds))
+
+    payloads, seconds = timed_calls(lambda ciphertext: serialised_encrypted(ciphertext), ciphertexts)
+    record('serialised_encrypted', latency_summary(seconds),
+           bytes_per_ciphertext=float(np.mean([len(payload) for payload in payloads])))
+
+    _, seconds = timed_calls(lambda payload: deserialised(payload, encryption_obj), payloads)
+    record('deserialised', latency_summary(seconds))
+
+    store_path = os.path.join(scratch, 'encrypted_financial_data.bin')
+    routes.encrypted_data_paths[ROW_LAYOUT] = store_path
+    client = create_app().test_client()
+    for n_rows in rows:
+        stats = parallel_encrypt(synthetic_data(n_rows, columns), store_path, encryption_obj, workers=workers)
+        record('ingest', {'calls': 1, 'throughput': stats['rows_per_sec'], 'p50_ms': None, 'p99_ms': None},
+               n_rows, bytes_per_ciphertext=os.path.getsize(store_path) / n_rows)
+
+        query = '/aggregation?refresh=true' + (f'&workers={workers}' if workers else '')
+        responses, seconds = timed_calls(
+            lambda _: client.get(query, headers={'Accept': 'application/octet-stream'}), range(repeats))
+        if any(response.status_code != 200 for response in responses):
+            raise RuntimeError(f"/aggregation failed with status {responses[-1].status_code}")
+        record('aggregation', latency_summary(seconds, n_rows), n_rows,
+               bytes_per_ciphertext=float(len(responses[-1].data)))
+    record('peak_rss', {}, **peak_rss())
+    return results
+
+def result_key(result):
+    '''
+    Identifies a benchmark result across runs.
+    '''
+    return (result['benchmark'], result['n_value'], result['scale_bits'],
+            tuple(result['qi_sizes']), result['rows'])
+
+def compare_results(baseline, current, threshold):
+    '''
+    Finds metrics that got worse than in a baseline run by more than threshold.
+    A baseline result missing from the current run (a benchmark or grid point that
+    failed or was dropped) is a regression of its own; new results are skipped.
+
+    Args:
+        baseline, current: lists of result dicts
+        threshold: allowed relative change, e.g. 0.2 for 20%
+
+    Returns:
+        List: dicts describing each regression
+    '''
+    previous = {result_key(result): result for result in baseline}
+    regressions = []
+    current_keys = {result_key(result) for result in current}
+    for key, old in previous.items():
+        if key not in current_keys:
+            regressions.append({
+                'benchmark': old['benchmark'],
+                'n_value': old['n_value'],
+                'qi_sizes': old['qi_sizes'],
+                'rows': old['rows'],
+                'metric': 'missing',
+                'baseline': None,
+                'current': None,
+                'change': None,
+            })
+    for result in current:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        for metric, higher_is_better in REGRESSION_METRICS.items():
+            before, after = old.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append({
+                    'benchmark': result['benchmark'],
+                    'n_value': result['n_value'],
+                    'qi_sizes': result['qi_sizes'],
+                    'rows': result['rows'],
+                    'metric': metric,
+                    'baseline': before,
+                    'current': after,
+                    'change': f"{change:+.1%}",
+                })
+    return regressions
+
+def run_grid(points, args):
+    '''
+    Runs each grid point in a subprocess with its own scratch key directory.
+
+    Returns:
+        Tuple: (results of every point that completed, list of the points that failed)
+    '''
+    results = []
+    failed = []
+    for point in points:
+        with tempfile.TemporaryDirectory() as scratch:
+            output = os.path.join(scratch, 'results.json')
+            command = [
+                sys.executable, '-m', 'benchmarks.suite',
+                '--point', json.dumps(point), '--point-output', output, '--scratch', scratch,
+                '--rows', *(str(n_rows) for n_rows in args.rows),
+                '--samples', str(args.samples), '--repeats', str(args.repeats),
+            ]
+            if args.workers:
+                command += ['--workers', str(args.workers)]
+            env = dict(os.environ, PHE_KEY_DIR=os.path.join(scratch, 'keys'))
+            print(f"Benchmarking {point}")
+            completed = subprocess.run(command, env=env, check=False,
+                                       stdout=None if args.verbose else subprocess.DEVNULL)
+            if completed.returncode != 0:
+                print(f"Benchmark failed for {point} with exit status {completed.returncode}")
+                failed.append(point)
+                continue
+            with open(output, 'r', encoding='utf-8') as file:
+                results.extend(json.load(file))
+    return results, failed
+
+def main():
+    '''Runs the grid, writes the JSON report and checks it against a baseline'''
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='quick', help='CKKS parameter grid')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000],
+                        help='synthetic dataset sizes for ingest and aggregation (up to 10^6)')
+    parser.add_argument('--samples', type=int, default=100, help='rows timed by the per-call benchmarks')
+    parser.add_argument('--repeats', type=int, default=3, help='calls of key generation, loading and /aggregation')
+    parser.add_argument('--workers', type=int, help='worker processes for ingest and aggregation')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON report to write')
+    parser.add_argument('--baseline', help='earlier JSON report to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the app')
+    parser.add_argument('--point', help=argparse.SUPPRESS)
+    parser.add_argument('--point-output', help=argparse.SUPPRESS)
+    parser.add_argument('--scratch', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.point:
+        results = run_point(json.loads(args.point), args.rows, args.samples, args.repeats,
+                            args.scratch, args.workers)
+        with open(args.point_output, 'w', encoding='utf-8') as file:
+            json.dump(results, file)
+        return
+
+    results, failed = run_grid(GRIDS[args.grid], args)
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'pyfhel': pyfhel_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'grid': args.grid,
+            'rows': args.rows,
+            'samples': args.samples,
+            'repeats': args.repeats,
+            'workers': args.workers,
+        },
+        'results': results,
+        'failed': failed,
+    }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+
+    columns = ['benchmark', 'n_value', 'scale_bits', 'rows', 'throughput', 'p50_ms', 'p99_ms',
+               'peak_rss_mb', 'bytes_per_ciphertext']
+    table = [[round(value, 2) if isinstance(value, float) else value
+              for value in (result.get(column) for column in columns)] for result in results]
+    print(tabulate(table, headers=columns, tablefmt='pretty'))
+    print(f"Results written to {args.output}")
+
+    status = 0
+    if failed:
+        print(f"{len(failed)} of {len(GRIDS[args.grid])} grid points failed")
+        status = 1
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+        regressions = compare_results(baseline, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.threshold:.0%}:")
+            print(tabulate(regressions, headers='keys', tablefmt='pretty'))
+            status = 1
+        else:
+            print(f"No regressions beyond {args.threshold:.0%}")
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
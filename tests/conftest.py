@@ -0,0 +1,8 @@
+'''Shared test fixtures'''
+import pytest
+from app.keys import ensure_keys
+
+@pytest.fixture(scope='session', autouse=True)
+def keys():
+    '''Generate keys once per session if none exist yet'''
+    assert ensure_keys()
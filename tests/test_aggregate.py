@@ -0,0 +1,55 @@
+'''Module to test tree-reduction and multi-core aggregation'''
+import numpy as np
+from app.encryption import (
+    load_context_public,
+    load_secret,
+    encrypt_value,
+    decrypt_value,
+)
+from app.aggregate import tree_sum, partition, parallel_aggregate
+from app.store import create_store, append_records
+
+def test_partition():
+    '''Ensure partitions are contiguous, near-equal and cover every item'''
+    assert partition(10, 3) == [(0, 4), (4, 7), (7, 10)]
+    assert partition(2, 5) == [(0, 1), (1, 2)]
+
+def test_tree_sum():
+    '''Ensure a tree reduction of an odd number of ciphertexts gives the plaintext sum'''
+    encryption_obj = load_secret(load_context_public())
+
+    data = np.array([10.5, -10.5, 42.42, 12345.678, -7.0], dtype=np.float64)
+    total = tree_sum(encrypt_value(encryption_obj, number) for number in data)
+
+    assert abs(decrypt_value(encryption_obj, total)[0] - data.sum()) < 1e-3
+    assert tree_sum([]) is None
+
+def test_parallel_aggregate(monkeypatch, tmp_path):
+    '''Ensure partial sums computed on worker processes combine into the plaintext sum'''
+    monkeypatch.setattr('app.aggregate.MIN_PARTITION_SIZE', 2)
+    encryption_obj = load_secret(load_context_public())
+
+    data = np.arange(1, 10, dtype=np.float64).reshape(9, 1) * [1.5, -2.0]
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   ((record_id, encrypt_value(encryption_obj, row)) for record_id, row in enumerate(data)))
+    progress = []
+    total = parallel_aggregate(store_path, encryption_obj, workers=3, progress=progress.append)
+
+    assert np.allclose(decrypt_value(encryption_obj, total)[:2], data.sum(axis=0), atol=1e-3)
+    assert progress == [3, 6, 9]
+
+def test_aggregate_progress_in_process(monkeypatch, tmp_path):
+    '''Ensure an in-process sum reports its progress every MIN_PARTITION_SIZE records'''
+    monkeypatch.setattr('app.aggregate.MIN_PARTITION_SIZE', 2)
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   ((record_id, encrypt_value(encryption_obj, float(record_id))) for record_id in range(1, 6)))
+
+    progress = []
+    total = parallel_aggregate(store_path, encryption_obj, workers=1, progress=progress.append)
+    assert abs(decrypt_value(encryption_obj, total)[0] - 15.0) < 1e-3
+    assert progress == [2, 4, 5]
@@ -0,0 +1,48 @@
+'''Module to test the benchmark suite helpers'''
+from benchmarks.suite import latency_summary, compare_results
+
+def result(benchmark, **metrics):
+    '''Build a result dict for the default parameter set'''
+    return {'benchmark': benchmark, 'n_value': 2**14, 'scale_bits': 30,
+            'qi_sizes': [60, 30, 30, 30, 60], 'rows': 100, **metrics}
+
+def test_latency_summary():
+    '''Ensure throughput counts the rows of every call and percentiles are in milliseconds'''
+    summary = latency_summary([0.1, 0.1, 0.2, 0.2], items_per_call=100)
+    assert summary['calls'] == 4
+    assert abs(summary['throughput'] - 400 / 0.6) < 1e-9
+    assert abs(summary['p50_ms'] - 150) < 1e-9
+    assert summary['p99_ms'] <= 200
+
+def test_compare_results():
+    '''Ensure only metrics that got worse beyond the threshold are reported'''
+    baseline = [
+        result('aggregation', throughput=100.0, p50_ms=10.0, bytes_per_ciphertext=1000.0),
+        result('encrypt_value', throughput=50.0, p50_ms=None),
+    ]
+    current = [
+        result('aggregation', throughput=70.0, p50_ms=9.0, bytes_per_ciphertext=1100.0),
+        result('encrypt_value', throughput=45.0, p50_ms=20.0),
+        result('decrypt_value', throughput=1.0),
+    ]
+    regressions = compare_results(baseline, current, threshold=0.2)
+    assert [(regression['benchmark'], regression['metric']) for regression in regressions] == \
+        [('aggregation', 'throughput')]
+    assert regressions[0]['change'] == '-30.0%'
+    assert len(compare_results(baseline, current, threshold=0.05)) == 3
+
+def test_compare_results_missing():
+    '''Ensure a baseline result missing from the run is a regression and a new one is not'''
+    baseline = [result('aggregation', throughput=100.0), result('ingest', throughput=10.0)]
+    current = [result('aggregation', throughput=100.0), result('decrypt_value', throughput=1.0)]
+    regressions = compare_results(baseline, current, threshold=0.2)
+    assert [(regression['benchmark'], regression['metric']) for regression in regressions] == \
+        [('ingest', 'missing')]
+
+def test_compare_results_peak_rss():
+    '''Ensure peak RSS is only compared between the once-per-point peak_rss results'''
+    baseline = [result('encrypt_value', throughput=50.0), result('peak_rss', peak_rss_mb=100.0)]
+    current = [result('encrypt_value', throughput=50.0), result('peak_rss', peak_rss_mb=150.0)]
+    regressions = compare_results(baseline, current, threshold=0.2)
+    assert [(regression['benchmark'], regression['metric']) for regression in regressions] == \
+        [('peak_rss', 'peak_rss_mb')]
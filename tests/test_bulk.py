@@ -0,0 +1,87 @@
+'''Module to test the binary bulk ingest of client-side encrypted records'''
+import io
+import numpy as np
+import pytest
+from app import create_app, routes
+from app.bulk import batch_header, batch_record, write_batch, read_batch_header, prepare_store, ingest_records
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value, lowest_mod_level
+from app.ingest import STORE_DEPTH
+from app.packing import ROW_LAYOUT
+from app.store import iter_records, iter_record_keys
+
+def encrypted_batch(encryption_obj, values, mod_level):
+    '''Write a batch of one ciphertext per row, with the row index as a plaintext key'''
+    stream = io.BytesIO()
+    records = [(index + 1, encrypt_value(encryption_obj, row), {'Row': str(index)})
+               for index, row in enumerate(values)]
+    write_batch(stream, encryption_obj, records, mod_level)
+    stream.seek(0)
+    return stream
+
+def test_ingest_records(tmp_path):
+    '''Ensure a streamed batch is appended unchanged in several appends and sums correctly'''
+    encryption_obj = load_secret(load_context_public())
+    mod_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+    path = str(tmp_path / 'bulk.bin')
+    values = np.round(np.random.default_rng(0).uniform(0, 1000, (5, 3)), 2)
+
+    stream = encrypted_batch(encryption_obj, values, mod_level)
+    assert read_batch_header(stream)[1] == mod_level
+    store_level = prepare_store(path, encryption_obj, mod_level)
+    stats = ingest_records(path, encryption_obj, stream, store_level, batch_size=2)
+    assert stats['records'] == 5
+
+    records = list(iter_records(path, encryption_obj))
+    assert [record_id for record_id, _ in records] == [1, 2, 3, 4, 5]
+    assert [keys['Row'] for _, _, keys in iter_record_keys(path)] == ['0', '1', '2', '3', '4']
+    total = records[0][1]
+    for _, ciphertext in records[1:]:
+        total = total + ciphertext
+    np.testing.assert_allclose(decrypt_value(encryption_obj, total)[:3], values.sum(axis=0), rtol=1e-5)
+
+def test_ingest_rejects_invalid_records(tmp_path):
+    '''Ensure records at the wrong level or of the wrong format stop the ingest after the appended batches'''
+    encryption_obj = load_context_public()
+    mod_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+    path = str(tmp_path / 'bulk.bin')
+    store_level = prepare_store(path, encryption_obj, mod_level)
+
+    stream = encrypted_batch(encryption_obj, np.ones((3, 2)), mod_level)
+    read_batch_header(stream)
+    fresh = encrypt_value(encryption_obj, 1.0).to_bytes('zstd')
+    stream = io.BytesIO(stream.read() + batch_record(4, fresh))
+    with pytest.raises(ValueError, match=r'Record ID 4 is not at mod level .* \(2 records appended\)'):
+        ingest_records(path, encryption_obj, stream, store_level, batch_size=2)
+
+    with pytest.raises(ValueError, match='Record ID 5 is not a valid ciphertext'):
+        ingest_records(path, encryption_obj, io.BytesIO(batch_record(5, b'\x00' * 64)), store_level)
+    with pytest.raises(ValueError, match='truncated'):
+        ingest_records(path, encryption_obj, io.BytesIO(batch_record(6, fresh)[:-1]), store_level)
+    with pytest.raises(ValueError, match='Not a record batch'):
+        read_batch_header(io.BytesIO(b'\x00' * 64))
+
+def test_bulk_routes(tmp_path, monkeypatch):
+    '''Ensure the context downloads revalidate by ETag and a batch from them is ingested'''
+    monkeypatch.setitem(routes.encrypted_data_paths, ROW_LAYOUT, str(tmp_path / 'bulk.bin'))
+    client = create_app().test_client()
+
+    manifest = client.get('/context')
+    assert manifest.status_code == 200
+    assert 'secret_key' not in manifest.json['parts']
+    assert client.get('/context', headers={'If-None-Match': manifest.headers['ETag']}).status_code == 304
+    assert client.get('/context/secret_key').status_code == 404
+
+    part = client.get('/context/public_key')
+    assert part.status_code == 200
+    assert part.headers['ETag'].strip('"') == manifest.json['parts']['public_key']['etag']
+    assert client.get('/context/public_key', headers={'If-None-Match': part.headers['ETag']}).status_code == 304
+
+    encryption_obj = load_context_public()
+    stream = encrypted_batch(encryption_obj, np.ones((4, 2)), manifest.json['store_mod_level'])
+    response = client.post('/records/bulk', data=stream.read(), content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert response.json['stats']['records'] == 4
+
+    wrong_level = batch_header(encryption_obj, manifest.json['store_mod_level'] + 1)
+    response = client.post('/records/bulk', data=wrong_level, content_type='application/octet-stream')
+    assert response.status_code == 409
@@ -0,0 +1,123 @@
+'''Module to test the incrementally maintained aggregate cache'''
+import numpy as np
+import pytest
+from Pyfhel import Pyfhel
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value
+from app.store import create_store, append_records
+from app import cache
+from app.cache import cached_aggregate, remove_record
+
+def decrypted_total(encryption_obj, total):
+    '''Decrypts the first slot of an aggregate'''
+    return decrypt_value(encryption_obj, total)[0]
+
+def test_cached_aggregate(tmp_path, monkeypatch):
+    '''Ensure appends and deletions update the cached sum without rescanning'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   [(i, encrypt_value(encryption_obj, float(i))) for i in range(1, 5)])
+
+    total, watermark = cached_aggregate(store_path, encryption_obj, workers=1)
+    assert watermark == 4
+    assert abs(decrypted_total(encryption_obj, total) - 10.0) < 1e-3
+
+    # Any further full scan is a failure from here on
+    def no_rescan(*args, **kwargs):
+        raise AssertionError("unexpected full rescan")
+    monkeypatch.setattr(cache, 'parallel_aggregate', no_rescan)
+
+    assert cached_aggregate(store_path, encryption_obj)[0] is total
+
+    # Appended records are caught up lazily
+    append_records(store_path, encryption_obj, [(5, encrypt_value(encryption_obj, 5.0))])
+    total, watermark = cached_aggregate(store_path, encryption_obj)
+    assert watermark == 5
+    assert abs(decrypted_total(encryption_obj, total) - 15.0) < 1e-3
+
+    append_records(store_path, encryption_obj, [(6, encrypt_value(encryption_obj, 6.0))])
+    total, watermark = cached_aggregate(store_path, encryption_obj)
+    assert watermark == 6
+    assert abs(decrypted_total(encryption_obj, total) - 21.0) < 1e-3
+
+    # Deletions are subtracted
+    assert remove_record(store_path, encryption_obj, 2)
+    assert not remove_record(store_path, encryption_obj, 2)
+    total, _ = cached_aggregate(store_path, encryption_obj)
+    assert abs(decrypted_total(encryption_obj, total) - 19.0) < 1e-3
+
+def test_cache_survives_restart_and_detects_rewrite(tmp_path):
+    '''Ensure the persisted sum is reused and a recreated store is rescanned'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj, [(1, encrypt_value(encryption_obj, 1.5))])
+    cached_aggregate(store_path, encryption_obj, workers=1)
+
+    # Simulate a new process: only the persisted state is left
+    cache._aggregates.clear()
+    total, watermark = cached_aggregate(store_path, encryption_obj, workers=1)
+    assert watermark == 1
+    assert abs(decrypted_total(encryption_obj, total) - 1.5) < 1e-3
+
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj, [(1, encrypt_value(encryption_obj, 4.0))])
+    total, _ = cached_aggregate(store_path, encryption_obj, workers=1)
+    assert abs(decrypted_total(encryption_obj, total) - 4.0) < 1e-3
+
+    cache._aggregates.clear()
+    assert cached_aggregate(store_path, encryption_obj, workers=1, refresh=True)[1] == 1
+
+def test_delete_last_record(tmp_path):
+    '''Ensure deleting every record leaves an empty aggregate'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj, [(1, encrypt_value(encryption_obj, np.array([2.0])))])
+    cached_aggregate(store_path, encryption_obj, workers=1)
+
+    assert remove_record(store_path, encryption_obj, 1)
+    assert cached_aggregate(store_path, encryption_obj) == (None, 1)
+
+def test_delete_during_rescan(tmp_path, monkeypatch):
+    '''Ensure a rescan does not block deletions and is repeated when one lands during it'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   [(i, encrypt_value(encryption_obj, float(i))) for i in range(1, 5)])
+
+    scans = []
+    parallel_aggregate = cache.parallel_aggregate
+    def scan_and_delete(*args, **kwargs):
+        scans.append(1)
+        if len(scans) == 1:
+            assert remove_record(store_path, encryption_obj, 3)
+        return parallel_aggregate(*args, **kwargs)
+    monkeypatch.setattr(cache, 'parallel_aggregate', scan_and_delete)
+
+    total, _ = cached_aggregate(store_path, encryption_obj, workers=1)
+    assert len(scans) == 2
+    assert abs(decrypted_total(encryption_obj, total) - 7.0) < 1e-3
+
+def test_cache_rejects_other_keys(tmp_path):
+    '''Ensure a store or persisted sum from other keys is never returned as the aggregate'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj, [(1, encrypt_value(encryption_obj, 1.5))])
+    cached_aggregate(store_path, encryption_obj, workers=1)
+
+    other_obj = Pyfhel()
+    other_obj.contextGen(scheme='CKKS', n=2**13, scale=2**30, qi_sizes=[60, 30, 30, 60])
+    other_obj.keyGen()
+    with pytest.raises(ValueError):
+        cached_aggregate(store_path, other_obj)
+    assert cache._load_state(store_path, other_obj) is None
+
+    # The store is re-encrypted under the new keys: the old sum is rebuilt, not returned
+    create_store(store_path, other_obj)
+    append_records(store_path, other_obj, [(1, other_obj.encrypt(np.array([4.0])))])
+    total, _ = cached_aggregate(store_path, other_obj, workers=1)
+    assert abs(other_obj.decrypt(total)[0] - 4.0) < 1e-3
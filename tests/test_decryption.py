@@ -0,0 +1,70 @@
+'''Module to test bulk decryption and streamed exports'''
+import io
+import numpy as np
+import pytest
+from app.encryption import load_context_public, load_secret, encrypt_value
+from app.decryption import decrypt_batches, decrypt_store, csv_chunks, npy_chunks, live_record_count
+from app.store import create_store, append_records, delete_record
+
+def _store(tmp_path, encryption_obj, data):
+    '''Creates a store holding one record per row of data, with Record IDs from 1'''
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   ((record_id, encrypt_value(encryption_obj, row)) for record_id, row in enumerate(data, 1)))
+    return store_path
+
+def test_decrypt_batches(tmp_path):
+    '''Ensure batches cover every live record and the store decrypts into one array'''
+    encryption_obj = load_secret(load_context_public())
+    data = np.arange(1, 11, dtype=np.float64).reshape(5, 2) * [100.25, -3.5]
+    store_path = _store(tmp_path, encryption_obj, data)
+    delete_record(store_path, 1)
+
+    batches = [(ids.copy(), values.copy()) for ids, values in decrypt_batches(store_path, encryption_obj, 2, 2)]
+    assert [len(ids) for ids, _ in batches] == [2, 2]
+    assert live_record_count(store_path) == 4
+
+    record_ids, values = decrypt_store(store_path, encryption_obj, 2, batch_size=3)
+    assert record_ids.tolist() == [1, 3, 4, 5]
+    assert np.allclose(values, np.delete(data, 1, axis=0), atol=1e-3)
+
+def test_csv_and_npy_chunks(tmp_path):
+    '''Ensure the CSV and NPY exports hold the decrypted rows and accumulate column totals'''
+    encryption_obj = load_secret(load_context_public())
+    data = np.array([[1200.5, 30.0], [850.25, 12.5], [40.0, 7.75]])
+    store_path = _store(tmp_path, encryption_obj, data)
+    columns = ['Revenue', 'Loans']
+
+    totals = np.zeros(2)
+    csv_text = b''.join(csv_chunks(decrypt_batches(store_path, encryption_obj, 2, 2), columns, totals))
+    lines = csv_text.decode('utf-8').splitlines()
+    assert lines[0] == 'Record ID,Revenue,Loans'
+    assert lines[1:] == ['1,1200.50,30.00', '2,850.25,12.50', '3,40.00,7.75']
+    assert np.allclose(totals, data.sum(axis=0), atol=1e-3)
+
+    npy_bytes = b''.join(npy_chunks(decrypt_batches(store_path, encryption_obj, 2, 2), columns, 3))
+    rows = np.load(io.BytesIO(npy_bytes))
+    assert rows['Record ID'].tolist() == [1, 2, 3]
+    assert np.allclose(rows['Loans'], data[:, 1], atol=1e-3)
+
+def test_csv_header_is_quoted(tmp_path):
+    '''Ensure column names holding commas or quotes are quoted in the CSV header'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = _store(tmp_path, encryption_obj, np.array([[1.0, 2.0]]))
+    columns = ['Revenue, net', 'Loans "short"']
+
+    csv_text = b''.join(csv_chunks(decrypt_batches(store_path, encryption_obj, 2), columns)).decode('utf-8')
+    assert csv_text.splitlines()[0] == 'Record ID,"Revenue, net","Loans ""short"""'
+
+def test_npy_chunks_fail_on_failed_record(tmp_path):
+    '''Ensure the NPY export fails on a record it cannot decrypt instead of writing a short file'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = _store(tmp_path, encryption_obj, np.array([[1.0, 2.0], [3.0, 4.0]]))
+    append_records(store_path, encryption_obj, [(3, b'\x00' * 64)])
+    columns = ['Revenue', 'Loans']
+
+    with pytest.raises(ValueError, match='Record ID: 3'):
+        b''.join(npy_chunks(decrypt_batches(store_path, encryption_obj, 2, strict=True), columns, 3))
+    with pytest.raises(ValueError, match='2 of the 3 rows'):
+        b''.join(npy_chunks(decrypt_batches(store_path, encryption_obj, 2), columns, 3))
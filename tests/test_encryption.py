@@ -11,7 +11,13 @@ from app.encryption import (
     decrypt_value,
     add_encrypted,
     sub_encrypted,
-    multiply_encrypted
+    multiply_encrypted,
+    COMPRESSION_MODES,
+    serialised_encrypted,
+    deserialised,
+    lowest_mod_level,
+    mod_switch_to_level,
+    context_fingerprint,
 )
 
 def test_generate_keys():
@@ -33,6 +39,20 @@ def test_generate_keys():
     assert os.path.getsize(os.path.join(KEY_DIR, 'relin_key.pkl')) > 0
     assert os.path.getsize(os.path.join(KEY_DIR, 'rotate_key.pkl')) > 0
 
+def test_generate_keys_rotation_steps(monkeypatch, tmp_path):
+    '''Ensure only the requested rotation keys are generated and stale ones are removed'''
+    monkeypatch.setattr('app.encryption.KEY_DIR', str(tmp_path))
+    (tmp_path / 'rotate_key.pkl').write_bytes(b'stale')
+
+    assert generate_keys(n_value=2**13, rotation_steps=[]) is True
+    assert not os.path.exists(tmp_path / 'rotate_key.pkl')
+    encryption_obj = load_context_public()
+    assert encryption_obj is not None
+    assert encryption_obj.is_rotate_key_empty()
+
+    assert generate_keys(n_value=2**13, rotation_steps=[1, 2, 4]) is True
+    assert not load_context_public().is_rotate_key_empty()
+
 def test_load_context_public():
     '''Ensure load public key & context function works'''
     encryption_obj = load_context_public()
@@ -170,3 +190,32 @@ def clear_keys():
         if os.path.isfile(file_path):
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.truncate(0)
+
+def test_serialisation_modes():
+    '''Ensure every compression mode round trips and mod-switched ciphertexts still add up'''
+    encryption_obj = load_secret(load_context_public())
+
+    data = np.array([10.5, -10.5, 0.0, 42.42, 12345.678], dtype=np.float64)
+    ciphertext = encrypt_value(encryption_obj, data)
+    mod_level = lowest_mod_level(encryption_obj)
+    assert 0 < mod_level < len(encryption_obj.qi_sizes) - 1
+    assert lowest_mod_level(encryption_obj, depth=1) < mod_level
+
+    switched = mod_switch_to_level(encryption_obj, ciphertext, mod_level)
+    assert switched.mod_level == mod_level and ciphertext.mod_level == 0
+    for compression in COMPRESSION_MODES:
+        loaded = deserialised(serialised_encrypted(switched, compression), encryption_obj, mod_level)
+        assert loaded.mod_level == mod_level
+        # Adding a fresh top-level ciphertext only works if the mod level was restored
+        total = add_encrypted(loaded, ciphertext)
+        assert np.allclose(decrypt_value(encryption_obj, total)[:5], data * 2, atol=1e-2)
+
+def test_context_fingerprint_memoized(monkeypatch):
+    '''Ensure a loaded context is only serialised for its fingerprint once'''
+    encryption_obj = load_context_public()
+    fingerprint = context_fingerprint(encryption_obj)
+    monkeypatch.setattr(type(encryption_obj), 'to_bytes_context',
+                        lambda self, *args: (_ for _ in ()).throw(AssertionError("context serialised again")))
+    assert context_fingerprint(encryption_obj) == fingerprint
+    monkeypatch.undo()
+    assert context_fingerprint(load_context_public()) == fingerprint
@@ -0,0 +1,48 @@
+'''Module to test group-by aggregation over plaintext dimensions'''
+import numpy as np
+import pandas as pd
+import pytest
+from app.encryption import load_context_public, load_secret, decrypt_value
+from app.groupby import group_key, group_positions, hash_partition, group_aggregate
+from app.ingest import parallel_encrypt
+from app.store import find_record, delete_record, iter_record_keys
+
+def test_group_key():
+    '''Ensure group keys join the dimension values and skip records missing one'''
+    assert group_key({'Region': 'North', 'Month': '2024-01'}, ['Region', 'Month']) == 'North|2024-01'
+    assert group_key({'Region': 'North'}, ['Month']) is None
+
+def test_hash_partition():
+    '''Ensure every group lands in exactly one stable partition'''
+    groups = {f"group {index}": [index] for index in range(20)}
+    partitions = hash_partition(groups, 3)
+    assert sorted(key for partition in partitions for key in partition) == sorted(groups)
+    assert hash_partition(groups, 3) == partitions
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_group_aggregate(monkeypatch, tmp_path, workers):
+    '''Ensure one pass gives the plaintext sum of every group'''
+    monkeypatch.setattr('app.groupby.MIN_PARTITION_SIZE', 2)
+    encryption_obj = load_secret(load_context_public())
+    financial_data = pd.DataFrame({
+        'Record ID': np.arange(1, 10),
+        'Region': ['North', 'South', 'East', 'North', 'South', 'East', 'North', 'West', 'North'],
+        'Month': ['Jan', 'Jan', 'Feb', 'Feb', 'Jan', 'Feb', 'Jan', 'Jan', 'Feb'],
+        'Revenue': np.arange(1, 10) * 100.5,
+        'Loans': np.arange(1, 10) * -2.25,
+    })
+    store_path = str(tmp_path / 'encrypted.bin')
+    parallel_encrypt(financial_data, store_path, encryption_obj, workers=2, chunk_size=4)
+    delete_record(store_path, find_record(store_path, 9))
+    assert next(iter_record_keys(store_path))[2] == {'Region': 'North', 'Month': 'Jan'}
+
+    live_data = financial_data[financial_data['Record ID'] != 9]
+    totals, counts = group_aggregate(store_path, encryption_obj, ['Region'], workers=workers)
+    assert counts == live_data.groupby('Region').size().to_dict()
+    for region, expected in live_data.groupby('Region')[['Revenue', 'Loans']].sum().iterrows():
+        assert np.allclose(decrypt_value(encryption_obj, totals[region])[:2], expected, atol=1e-2)
+
+    totals, counts = group_aggregate(store_path, encryption_obj, ['Region', 'Month'], workers=workers)
+    assert counts['North|Jan'] == 2
+    assert np.allclose(decrypt_value(encryption_obj, totals['North|Jan'])[:2], [804.0, -18.0], atol=1e-2)
+    assert group_positions(store_path, ['Branch']) == {}
@@ -0,0 +1,110 @@
+'''Module to test the parallel encryption pipeline'''
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from app import sqlite_store, store
+from app.encryption import load_context_public, load_secret, decrypt_value
+from app.ingest import (
+    split_chunks,
+    dimension_columns,
+    parallel_encrypt,
+    csv_schema,
+    stream_encrypt,
+    checkpoint_path,
+)
+from app.store import iter_records
+
+def make_financial_data(n_records):
+    '''Builds a small synthetic financial dataset'''
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'Record ID': np.arange(1, n_records + 1),
+        'Revenue': rng.uniform(0, 1000, n_records).round(2),
+        'Expenses': rng.uniform(0, 1000, n_records).round(2),
+    })
+
+def test_split_chunks():
+    '''Ensure chunks cover every row in order'''
+    chunks = list(split_chunks(make_financial_data(10), chunk_size=4))
+    assert [len(record_ids) for record_ids, _, _ in chunks] == [4, 4, 2]
+    assert chunks[2][0].tolist() == [9, 10]
+    assert chunks[0][1].shape == (4, 2)
+    assert chunks[0][2] == [{}] * 4
+
+def test_split_chunks_dimensions():
+    '''Ensure non-numeric columns become plaintext keys instead of encrypted values'''
+    financial_data = make_financial_data(3)
+    financial_data['Region'] = ['North', 'South', 'North']
+    assert dimension_columns(financial_data) == ['Region']
+
+    (record_ids, values, keys), = split_chunks(financial_data, chunk_size=4)
+    assert values.shape == (3, 2)
+    assert keys == [{'Region': 'North'}, {'Region': 'South'}, {'Region': 'North'}]
+
+def test_parallel_encrypt(tmp_path):
+    '''Ensure rows encrypted on a process pool are written in order and decrypt correctly'''
+    financial_data = make_financial_data(9)
+    save_path = str(tmp_path / 'encrypted.bin')
+    encryption_obj = load_secret(load_context_public())
+
+    stats = parallel_encrypt(financial_data, save_path, encryption_obj, workers=2, chunk_size=4)
+    assert stats['rows'] == 9
+    assert stats['rows_per_sec'] > 0
+
+    encrypted_dataset = list(iter_records(save_path, encryption_obj))
+    assert [record_id for record_id, _ in encrypted_dataset] == list(range(1, 10))
+
+    for (_, ciphertext), expected in zip(encrypted_dataset, financial_data[['Revenue', 'Expenses']].to_numpy()):
+        decrypted = decrypt_value(encryption_obj, ciphertext)[:2]
+        assert np.allclose(decrypted, expected, atol=1e-3)
+
+def test_csv_schema(tmp_path):
+    '''Ensure the schema encrypts numeric columns as float64 and keeps the rest as plaintext keys'''
+    financial_data = make_financial_data(3)
+    financial_data['Region'] = ['North', 'South', 'North']
+    csv_path = tmp_path / 'financial_data.csv'
+    financial_data.to_csv(csv_path, index=False)
+    assert csv_schema(csv_path) == {'Record ID': 'int64', 'Revenue': 'float64', 'Expenses': 'float64', 'Region': str}
+
+@pytest.mark.parametrize('backend', [store, sqlite_store])
+def test_stream_encrypt_resume(tmp_path, backend):
+    '''Ensure an interrupted streaming ingest resumes from its checkpoint without gaps or duplicates'''
+    financial_data = make_financial_data(10)
+    financial_data['Region'] = ['North', 'South'] * 5
+    csv_path = tmp_path / 'financial_data.csv'
+    financial_data.to_csv(csv_path, index=False)
+    save_path = str(tmp_path / 'encrypted.bin')
+    encryption_obj = load_secret(load_context_public())
+
+    def crash(rows, total):
+        assert total == 10
+        if rows == 6:
+            raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        stream_encrypt(csv_path, save_path, encryption_obj, workers=1, chunk_size=3, backend=backend,
+                       progress=crash)
+
+    # Lose the last checkpoint save, as if the process died between the append and the save
+    with open(checkpoint_path(save_path), encoding='utf-8') as file:
+        checkpoint = json.load(file)
+    assert (checkpoint['rows'], checkpoint['records']) == (6, 6)
+    checkpoint.update(rows=3, records=3)
+    with open(checkpoint_path(save_path), 'w', encoding='utf-8') as file:
+        json.dump(checkpoint, file)
+
+    stats = stream_encrypt(csv_path, save_path, encryption_obj, workers=2, chunk_size=3, backend=backend,
+                           resume=True)
+    assert (stats['skipped_rows'], stats['rows']) == (6, 4)
+    assert not os.path.exists(checkpoint_path(save_path))
+
+    encrypted_dataset = list(backend.iter_records(save_path, encryption_obj))
+    assert [record_id for record_id, _ in encrypted_dataset] == list(range(1, 11))
+    for (_, ciphertext), expected in zip(encrypted_dataset, financial_data[['Revenue', 'Expenses']].to_numpy()):
+        assert np.allclose(decrypt_value(encryption_obj, ciphertext)[:2], expected, atol=1e-3)
+
+    # Without a checkpoint, resuming starts over
+    stats = stream_encrypt(csv_path, save_path, encryption_obj, workers=1, chunk_size=3, backend=backend,
+                           resume=True)
+    assert (stats['skipped_rows'], stats['rows']) == (0, 10)
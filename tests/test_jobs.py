@@ -0,0 +1,97 @@
+'''Module to test the background job pool'''
+import os
+import threading
+import time
+import pytest
+from app.jobs import DONE, FAILED, configure_jobs, submit_job, job_status, job_result, result_file
+
+@pytest.fixture(autouse=True)
+def job_pool():
+    '''Give every test a fresh pool with one thread and one queue slot'''
+    configure_jobs(workers=1, queue_depth=1)
+    yield
+    configure_jobs()
+
+def wait_for(job_id, timeout=5):
+    '''Poll a job until it finishes'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = job_status(job_id)
+        if status['status'] in (DONE, FAILED):
+            return status
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+def test_coalescing_and_queue_depth():
+    '''Ensure identical pending jobs are coalesced and the queue depth is enforced'''
+    release = threading.Event()
+    runs = []
+    def runner(report):
+        runs.append(1)
+        report(1, 4)
+        release.wait(5)
+        report(4)
+        return {'json': {'value': 42}}
+
+    job_id, coalesced = submit_job('aggregate', {'columns': ['Revenue']}, runner)
+    assert not coalesced
+    assert submit_job('aggregate', {'columns': ['Revenue']}, runner) == (job_id, True)
+    queued_id, _ = submit_job('aggregate', {'columns': ['Loans']}, runner)
+    assert queued_id is not None
+    assert submit_job('decrypt', {'format': 'csv'}, runner) == (None, False)
+
+    assert job_result(job_id)[1] is None
+    release.set()
+    assert wait_for(job_id)['processed'] == 4
+    wait_for(queued_id)
+    status, result = job_result(job_id)
+    assert status['eta'] == 0.0 and result == {'json': {'value': 42}}
+    assert len(runs) == 2
+
+    new_id, coalesced = submit_job('aggregate', {'columns': ['Revenue']}, runner)
+    assert new_id != job_id and not coalesced
+    wait_for(new_id)
+
+def test_progress_and_failure():
+    '''Ensure progress yields an ETA and a failing runner is reported'''
+    halfway = threading.Event()
+    release = threading.Event()
+    def runner(report):
+        report(5, 10)
+        halfway.set()
+        release.wait(5)
+        return None
+
+    job_id, _ = submit_job('encrypt', {}, runner)
+    assert halfway.wait(5)
+    status = job_status(job_id)
+    assert status['processed'] == 5 and status['total'] == 10 and status['eta'] is not None
+    release.set()
+    wait_for(job_id)
+
+    def failing(report):
+        raise ValueError("No encrypted records to aggregate.")
+    failed_id, _ = submit_job('aggregate', {}, failing)
+    status = wait_for(failed_id)
+    assert status['status'] == FAILED and 'No encrypted records' in status['error']
+    assert job_status('unknown') is None and job_result('unknown') is None
+
+def test_result_files_are_deleted_on_expiry(monkeypatch):
+    '''Ensure a result written to a file is kept until its job expires'''
+    monkeypatch.setattr('app.jobs.MAX_FINISHED_JOBS', 1)
+    def runner(report):
+        path = result_file('.csv')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('Record ID\n')
+        return {'path': path}
+
+    job_id, _ = submit_job('decrypt', {'format': 'csv'}, runner)
+    wait_for(job_id)
+    path = job_result(job_id)[1]['path']
+    assert os.path.exists(path)
+
+    next_id, _ = submit_job('decrypt', {'format': 'npy'}, runner)
+    wait_for(next_id)
+    assert job_status(job_id) is None
+    assert not os.path.exists(path)
+    os.remove(job_result(next_id)[1]['path'])
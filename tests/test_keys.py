@@ -0,0 +1,128 @@
+'''Module to test lazy key management'''
+import os
+from app.encryption import KEY_DIR
+from concurrent.futures import ThreadPoolExecutor
+from app import create_app
+from app.jobs import DEFAULT_JOB_WORKERS, DEFAULT_QUEUE_DEPTH, configure_jobs
+from app.keys import (
+    keys_exist,
+    ensure_keys,
+    get_context,
+    clear_cache,
+    configure_pool,
+    acquire_context,
+    release_context,
+    pooled_context,
+    public_key_file,
+    DEFAULT_POOL_SIZE,
+)
+
+def test_keys_exist():
+    '''Ensure existing keys are detected'''
+    assert keys_exist()
+
+def test_ensure_keys_does_not_regenerate():
+    '''Ensure existing keys are left untouched'''
+    context_path = os.path.join(KEY_DIR, 'context.pkl')
+    modified = os.path.getmtime(context_path)
+    assert ensure_keys() is True
+    assert os.path.getmtime(context_path) == modified
+
+def test_get_context_is_cached():
+    '''Ensure the loaded context is reused across calls'''
+    clear_cache()
+    encryption_obj = get_context()
+    assert encryption_obj is not None
+    assert get_context() is encryption_obj
+    assert encryption_obj.is_secret_key_empty()
+
+def test_get_context_skips_rotation_keys():
+    '''Ensure worker contexts leave the rotation keys out unless they are asked for'''
+    clear_cache()
+    assert get_context().is_rotate_key_empty()
+    rotating = get_context(rotate=True)
+    assert rotating is not get_context()
+    if os.path.exists(os.path.join(KEY_DIR, 'rotate_key.pkl')):
+        assert not rotating.is_rotate_key_empty()
+
+def test_get_secret_context():
+    '''Ensure the secret context holds the secret key and is cached separately'''
+    clear_cache()
+    encryption_obj = get_context(secret=True)
+    assert not encryption_obj.is_secret_key_empty()
+    assert get_context(secret=True) is encryption_obj
+    assert get_context() is not encryption_obj
+
+def test_context_pool():
+    '''Ensure checked-out contexts are exclusive, reused after release and bounded by the pool size'''
+    clear_cache()
+    configure_pool(2)
+    try:
+        first = acquire_context()
+        second = acquire_context()
+        assert first is not None and second is not None and first is not second
+        # The pool is exhausted until a context is released
+        assert acquire_context(timeout=0.1) is None
+        release_context(second)
+        assert acquire_context(timeout=0.1) is second
+        release_context(second)
+        release_context(first)
+
+        with pooled_context(secret=True) as secret_obj:
+            assert not secret_obj.is_secret_key_empty()
+            assert secret_obj not in (first, second)
+        with pooled_context() as public_obj:
+            assert public_obj.is_secret_key_empty()
+    finally:
+        configure_pool(DEFAULT_POOL_SIZE)
+
+def test_context_pool_threads():
+    '''Ensure concurrent threads never hold the same context and stale contexts are dropped'''
+    clear_cache()
+    configure_pool(2)
+    try:
+        def checkout(_):
+            with pooled_context() as encryption_obj:
+                return id(encryption_obj), encryption_obj.encrypt(1.0) is not None
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(checkout, range(8)))
+        assert all(encrypted for _, encrypted in results)
+        assert len({context_id for context_id, _ in results}) <= 2
+
+        stale = acquire_context()
+        clear_cache()
+        release_context(stale)
+        with pooled_context() as encryption_obj:
+            assert encryption_obj is not stale
+    finally:
+        configure_pool(DEFAULT_POOL_SIZE)
+
+def test_rotation_pool():
+    '''Ensure only contexts checked out to rotate hold the rotation keys, in a pool of their own'''
+    clear_cache()
+    configure_pool(2, rotation_size=1)
+    try:
+        with pooled_context() as public_obj:
+            assert public_obj.is_rotate_key_empty()
+        with pooled_context(rotate=True) as rotating_obj:
+            assert rotating_obj is not public_obj
+            assert rotating_obj.is_rotate_key_empty() == (public_key_file('rotate_key') is None)
+            assert acquire_context(rotate=True, timeout=0.1) is None
+    finally:
+        configure_pool(DEFAULT_POOL_SIZE)
+
+def test_create_app_config(monkeypatch):
+    '''Ensure settings applied at startup can be overridden from the config mapping and environment'''
+    clear_cache()
+    try:
+        app = create_app({'CONTEXT_POOL_SIZE': 1, 'JOB_WORKERS': 1})
+        assert app.config['CONTEXT_POOL_SIZE'] == 1
+        first = acquire_context()
+        assert acquire_context(timeout=0.1) is None
+        release_context(first)
+
+        monkeypatch.setenv('PHE_JOB_QUEUE_DEPTH', '3')
+        assert create_app().config['JOB_QUEUE_DEPTH'] == 3
+    finally:
+        configure_pool(DEFAULT_POOL_SIZE)
+        configure_jobs(DEFAULT_JOB_WORKERS, DEFAULT_QUEUE_DEPTH)
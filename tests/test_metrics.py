@@ -0,0 +1,82 @@
+'''Module to test the hot-path metrics'''
+import pytest
+from app import metrics
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value, add_encrypted, \
+    serialised_encrypted, deserialised
+from app.aggregate import parallel_aggregate
+from app.store import create_store, append_records
+
+@pytest.fixture(autouse=True)
+def clean_registry():
+    '''Start every test from an empty, enabled registry'''
+    metrics.reset()
+    metrics.set_enabled(True)
+    yield
+    metrics.set_enabled(True)
+
+def test_stage_timers_and_gauges():
+    '''Ensure the encryption hot paths record their stages and the ciphertext gauges'''
+    encryption_obj = load_secret(load_context_public())
+    ciphertext = encrypt_value(encryption_obj, [1.5, 2.5])
+    metrics.start_trace()
+    total = add_encrypted(ciphertext, ciphertext)
+    restored = deserialised(serialised_encrypted(total), encryption_obj)
+    decrypt_value(encryption_obj, restored)
+    trace = metrics.finish_trace()
+    assert set(trace) == {'add', 'serialize', 'base64', 'deserialize', 'decrypt'}
+    assert trace['base64']['calls'] == 2
+
+    text = metrics.render()
+    assert 'phe_stage_seconds_count{stage="encrypt"} 1' in text
+    assert 'phe_stage_seconds_bucket{stage="decrypt",le="+Inf"} 1' in text
+    assert '# TYPE phe_ciphertext_bytes gauge' in text
+    assert 'phe_ciphertext_scale_bits{compression="zstd"} 30.0' in text
+    assert metrics.finish_trace() == {}
+
+def test_errors_histogram_and_disable():
+    '''Ensure errors are counted, buckets are cumulative and disabling stops recording'''
+    with pytest.raises(ValueError):
+        with metrics.stage('encrypt'):
+            raise ValueError("bad input")
+    metrics.observe('phe_request_seconds', 0.003, endpoint='main.aggregation')
+    metrics.observe('phe_request_seconds', 20.0, endpoint='main.aggregation')
+    text = metrics.render()
+    assert 'phe_stage_errors_total{stage="encrypt"} 1' in text
+    assert 'phe_request_seconds_bucket{endpoint="main.aggregation",le="0.0025"} 0' in text
+    assert 'phe_request_seconds_bucket{endpoint="main.aggregation",le="0.005"} 1' in text
+    assert 'phe_request_seconds_bucket{endpoint="main.aggregation",le="10.0"} 1' in text
+    assert 'phe_request_seconds_count{endpoint="main.aggregation"} 2' in text
+
+    metrics.set_enabled(False)
+    with metrics.stage('add'):
+        pass
+    assert 'stage="add"' not in metrics.render()
+
+def test_collect_and_merge():
+    '''Ensure a collected delta empties the registry and merging it twice doubles the totals'''
+    with metrics.stage('encrypt'):
+        pass
+    metrics.increment('phe_stage_errors_total', stage='encrypt')
+    delta = metrics.collect()
+    assert metrics.render() == '\n'
+
+    metrics.start_trace()
+    metrics.merge(delta)
+    metrics.merge(delta)
+    assert metrics.finish_trace()['encrypt']['calls'] == 2
+    text = metrics.render()
+    assert 'phe_stage_seconds_count{stage="encrypt"} 2' in text
+    assert 'phe_stage_errors_total{stage="encrypt"} 2' in text
+
+def test_worker_metrics_are_merged(monkeypatch, tmp_path):
+    '''Ensure stages timed inside the worker processes of a parallel scan reach the parent registry'''
+    monkeypatch.setattr('app.aggregate.MIN_PARTITION_SIZE', 2)
+    encryption_obj = load_context_public()
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   ((record_id, encrypt_value(encryption_obj, [1.0])) for record_id in range(6)))
+
+    metrics.reset()
+    parallel_aggregate(store_path, encryption_obj, workers=3)
+    assert 'phe_stage_seconds_count{stage="store_read"} 6' in metrics.render()
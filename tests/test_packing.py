@@ -0,0 +1,129 @@
+'''Module to test column-major slot packing'''
+import os
+import numpy as np
+import pytest
+import pandas as pd
+from Pyfhel import Pyfhel
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value
+from app.packing import (
+    ROW_LAYOUT,
+    COLUMN_LAYOUT,
+    rotation_steps,
+    rotation_profile,
+    slot_count,
+    pack_columns,
+    pack_frames,
+    save_packed,
+    load_packed,
+    packed_columns,
+    project_slots,
+    sum_slots,
+    aggregate_columns,
+    combine_column_totals,
+    decrypt_column_totals,
+)
+
+def test_rotation_steps():
+    '''Ensure the rotation steps are the powers of two below the slot count'''
+    assert rotation_steps(8) == [1, 2, 4]
+    assert rotation_steps(1) == []
+
+def test_rotation_profile():
+    '''Ensure only the column layout needs rotation keys'''
+    assert rotation_profile(ROW_LAYOUT, 2**14) == []
+    assert rotation_profile(COLUMN_LAYOUT, 16) == [1, 2, 4]
+
+def test_sum_slots():
+    '''Ensure rotate-and-add sums every slot of a ciphertext'''
+    encryption_obj = load_secret(load_context_public())
+
+    data = np.array([10.5, -10.5, 42.42, 12345.678, 7.0], dtype=np.float64)
+    ciphertext = encrypt_value(encryption_obj, data)
+    decrypted = decrypt_value(encryption_obj, sum_slots(encryption_obj, ciphertext))
+
+    assert abs(decrypted[0] - data.sum()) < 1e-2
+    assert abs(decrypted[-1] - data.sum()) < 1e-2
+
+def test_pack_and_aggregate_columns():
+    '''Ensure a column-packed dataset aggregates to the plaintext column sums'''
+    encryption_obj = load_secret(load_context_public())
+
+    n_records = slot_count(encryption_obj) + 3  # Forces a second chunk per column
+    rng = np.random.default_rng(0)
+    financial_data = pd.DataFrame({
+        'Record ID': np.arange(1, n_records + 1),
+        'Revenue': rng.uniform(0, 1000, n_records).round(2),
+        'Loans': rng.uniform(0, 1000, n_records).round(2),
+    })
+
+    packed_dataset = pack_columns(encryption_obj, financial_data)
+    assert len(packed_dataset) == 4
+    assert packed_dataset[1]['Record IDs'] == [n_records - 2, n_records - 1, n_records]
+
+    totals = decrypt_column_totals(encryption_obj, aggregate_columns(encryption_obj, packed_dataset))
+    for column in ('Revenue', 'Loans'):
+        expected = financial_data[column].sum()
+        assert abs(totals[column] - expected) / expected < 1e-4
+
+def test_combine_column_totals():
+    '''Ensure column totals are gathered into their row-layout slots'''
+    encryption_obj = load_secret(load_context_public())
+    column_totals = {
+        'Revenue': sum_slots(encryption_obj, encrypt_value(encryption_obj, np.array([1.5, 2.5]))),
+        'Loans': sum_slots(encryption_obj, encrypt_value(encryption_obj, np.array([10.0, 20.0]))),
+    }
+    combined = combine_column_totals(encryption_obj, column_totals, {'Revenue': 0, 'Loans': 3})
+    np.testing.assert_allclose(decrypt_value(encryption_obj, combined)[:5], [4.0, 0, 0, 30.0, 0], atol=1e-2)
+
+def test_save_and_load_packed_columns(tmp_path):
+    '''Ensure a projection only loads the requested columns'''
+    encryption_obj = load_secret(load_context_public())
+    financial_data = pd.DataFrame({
+        'Record ID': [1, 2, 3],
+        'Revenue': [100.5, 200.25, 300.0],
+        'Loans': [10.0, 20.0, 30.0],
+    })
+    directory = str(tmp_path / 'packed')
+    save_packed(directory, encryption_obj, pack_columns(encryption_obj, financial_data))
+    assert packed_columns(directory) == ['Revenue', 'Loans']
+    assert len(os.listdir(directory)) == 3
+
+    packed_dataset = load_packed(directory, encryption_obj, ['Loans'])
+    assert [chunk['Column'] for chunk in packed_dataset] == ['Loans']
+    assert len(load_packed(directory, encryption_obj)) == 2
+    with pytest.raises(ValueError):
+        load_packed(directory, encryption_obj, ['Savings'])
+
+    other_obj = Pyfhel()
+    other_obj.contextGen(scheme='CKKS', n=2**13, scale=2**30, qi_sizes=[60, 30, 30, 60])
+    other_obj.keyGen()
+    with pytest.raises(ValueError):
+        load_packed(directory, other_obj)
+
+def test_save_packed_frames(tmp_path):
+    '''Ensure frames streamed through pack_frames are saved in slot order, one file per column'''
+    encryption_obj = load_secret(load_context_public())
+    financial_data = pd.DataFrame({
+        'Record ID': [1, 2, 3, 4, 5],
+        'Revenue': [100.5, 200.25, 300.0, 400.0, 500.0],
+        'Loans': [10.0, 20.0, 30.0, 40.0, 50.0],
+    })
+    directory = str(tmp_path / 'packed')
+    frames = (financial_data[start:start + 2] for start in range(0, 5, 2))
+    save_packed(directory, encryption_obj, pack_frames(encryption_obj, frames))
+    assert packed_columns(directory) == ['Revenue', 'Loans']
+
+    packed_dataset = load_packed(directory, encryption_obj, ['Loans'])
+    assert [chunk['Record IDs'] for chunk in packed_dataset] == [[1, 2], [3, 4], [5]]
+    totals = decrypt_column_totals(encryption_obj, aggregate_columns(encryption_obj, packed_dataset))
+    assert abs(totals['Loans'] - 150.0) < 1e-2
+
+def test_project_slots():
+    '''Ensure a masked multiplication keeps only the projected slots'''
+    encryption_obj = load_secret(load_context_public())
+    data = np.array([10.5, -20.25, 30.0, 40.75, 50.0])
+    ciphertext = encrypt_value(encryption_obj, data)
+
+    projected = project_slots(encryption_obj, ciphertext, [1, 4])
+    assert projected.mod_level == ciphertext.mod_level + 1
+    assert np.allclose(decrypt_value(encryption_obj, projected)[:5], [0.0, -20.25, 0.0, 0.0, 50.0], atol=1e-3)
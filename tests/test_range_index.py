@@ -0,0 +1,62 @@
+'''Module to test the encrypted Fenwick range index'''
+import numpy as np
+import pytest
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value
+from app.store import create_store, append_records, find_record, delete_record, record_count
+from app.range_index import (
+    prefix_positions,
+    child_positions,
+    update_index,
+    range_sum,
+    index_store_path,
+)
+
+def test_fenwick_positions():
+    '''Ensure prefix and child node positions follow the Fenwick layout'''
+    assert prefix_positions(7) == [6, 5, 3]
+    assert prefix_positions(8) == [7]
+    assert child_positions(8) == [6, 5, 3]
+    assert child_positions(5) == []
+
+def test_range_sum(tmp_path):
+    '''Ensure range sums match plaintext sums as records are appended and deleted'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    values = {record_id: float(record_id) * 1.5 for record_id in range(10, 20)}
+
+    def append(record_ids):
+        append_records(store_path, encryption_obj,
+                       [(record_id, encrypt_value(encryption_obj, values[record_id])) for record_id in record_ids])
+
+    def check(first_id, last_id, expected_ids):
+        total, n_records = range_sum(store_path, encryption_obj, first_id, last_id)
+        assert n_records == len(expected_ids)
+        expected = sum(values[record_id] for record_id in expected_ids)
+        assert abs(decrypt_value(encryption_obj, total)[0] - expected) < 1e-3
+
+    append(range(10, 17))
+    check(10, 16, range(10, 17))
+    check(12, 14, range(12, 15))
+    check(0, 11, [10, 11])
+
+    # New records extend the index without rebuilding it
+    append(range(17, 20))
+    assert update_index(store_path, encryption_obj) == 10
+    assert record_count(index_store_path(store_path)) == 10
+    check(15, 100, range(15, 20))
+
+    delete_record(store_path, find_record(store_path, 16))
+    check(15, 17, [15, 17])
+    assert range_sum(store_path, encryption_obj, 16, 16) == (None, 0)
+    assert range_sum(store_path, encryption_obj, 100, 200) == (None, 0)
+
+def test_range_sum_requires_ascending_ids(tmp_path):
+    '''Ensure out-of-order Record IDs are rejected'''
+    encryption_obj = load_context_public()
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    append_records(store_path, encryption_obj,
+                   [(record_id, encrypt_value(encryption_obj, np.array([1.0]))) for record_id in (2, 1)])
+    with pytest.raises(ValueError):
+        range_sum(store_path, encryption_obj, 1, 2)
@@ -0,0 +1,250 @@
+'''Module to test the Flask routes'''
+import io
+import os
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from app import create_app, routes, sqlite_store
+from app.encryption import (
+    load_context_public, load_secret, encrypt_value, decrypt_value, deserialised, lowest_mod_level,
+)
+from app.bulk import ingest_lock
+from app.ingest import STORE_DEPTH
+from app.jobs import DONE, FAILED, job_result
+from app.packing import ROW_LAYOUT
+from app.keys import DEFAULT_POOL_SIZE, clear_cache, configure_pool, ensure_keys
+from app.store import create_store, append_records
+
+# Plaintext dimension of each dataset record in the stores written by the stores fixture
+REGIONS = ['North', 'South', 'North', 'East', 'South']
+
+@pytest.fixture
+def client():
+    '''Test client of an app with a small context pool'''
+    app = create_app({'CONTEXT_POOL_SIZE': 1, 'ROTATION_POOL_SIZE': 1})
+    yield app.test_client()
+    configure_pool(DEFAULT_POOL_SIZE)
+
+@pytest.fixture
+def key_dir(tmp_path, monkeypatch):
+    '''Point every module at scratch keys and drop the pooled contexts around the test'''
+    for module in ('app.encryption', 'app.keys', 'app.tuning'):
+        monkeypatch.setattr(f'{module}.KEY_DIR', str(tmp_path / 'keys'))
+    clear_cache()
+    yield tmp_path / 'keys'
+    clear_cache()
+
+def encrypt_store(path, n_records=4):
+    '''Write a row-layout store of the first records of the dataset under the current keys'''
+    encryption_obj = load_context_public()
+    create_store(path, encryption_obj, lowest_mod_level(encryption_obj, depth=STORE_DEPTH))
+    values = pd.read_csv(routes.data_path)[routes.financial_columns].to_numpy(dtype=np.float64)[:n_records]
+    append_records(path, encryption_obj,
+                   ((record_id, encrypt_value(encryption_obj, row)) for record_id, row in enumerate(values, 1)))
+    return values
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    '''Write the dataset to a row-layout store and a SQLite store and point the routes at them'''
+    encryption_obj = load_secret(load_context_public())
+    mod_level = lowest_mod_level(encryption_obj, depth=STORE_DEPTH)
+    values = pd.read_csv(routes.data_path)[routes.financial_columns].to_numpy(dtype=np.float64)
+    records = [(record_id, encrypt_value(encryption_obj, row), {'Region': region})
+               for record_id, (row, region) in enumerate(zip(values, REGIONS), 1)]
+
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj, mod_level)
+    append_records(store_path, encryption_obj, records)
+    database_path = str(tmp_path / 'encrypted.db')
+    sqlite_store.create_store(database_path, encryption_obj, mod_level)
+    sqlite_store.append_records(database_path, encryption_obj, records)
+
+    monkeypatch.setitem(routes.encrypted_data_paths, ROW_LAYOUT, store_path)
+    monkeypatch.setattr(routes, 'sqlite_data_path', database_path)
+    return encryption_obj, values
+
+def decrypted(encryption_obj, result):
+    '''Decrypt a serialised ciphertext of a JSON response'''
+    return decrypt_value(encryption_obj, deserialised(result['data'], encryption_obj, result['mod_level']))
+
+def test_aggregation_columns(client, stores):
+    '''Ensure ?columns= keeps the requested slots, masks the rest and rejects unknown names'''
+    encryption_obj, values = stores
+    columns = routes.financial_columns
+    response = client.get('/aggregation', query_string={'columns': f'{columns[4]},{columns[0]}'})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['slots'] == [0, 4]
+    sums = decrypted(encryption_obj, body)[:len(columns)]
+    np.testing.assert_allclose(sums[[0, 4]], values.sum(axis=0)[[0, 4]], rtol=1e-5)
+    assert np.abs(sums[1:4]).max() < 1
+
+    response = client.get('/aggregation', query_string={'columns': columns[1]},
+                          headers={'Accept': 'application/octet-stream'})
+    assert response.status_code == 200 and response.headers['X-Slots'] == '[1]'
+    assert client.get('/aggregation?columns=Unknown').status_code == 400
+
+def test_range_aggregation(client, stores):
+    '''Ensure a Record ID range is summed through the index and bad bounds are rejected'''
+    encryption_obj, values = stores
+    response = client.get('/range_aggregation?first_id=2&last_id=4')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['records'] == 3
+    np.testing.assert_allclose(decrypted(encryption_obj, body)[:len(routes.financial_columns)],
+                               values[1:4].sum(axis=0), rtol=1e-5)
+    assert client.get('/range_aggregation?first_id=4&last_id=2').status_code == 400
+    assert client.get('/range_aggregation?first_id=20&last_id=30').status_code == 404
+
+def test_group_aggregation(client, stores):
+    '''Ensure each group is summed with its record count and ?by= is required'''
+    encryption_obj, values = stores
+    response = client.get('/group_aggregation?by=Region')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['counts'] == {'North': 2, 'South': 2, 'East': 1}
+    np.testing.assert_allclose(decrypted(encryption_obj, body['data']['South'])[:len(routes.financial_columns)],
+                               values[[1, 4]].sum(axis=0), rtol=1e-5)
+    assert client.get('/group_aggregation').status_code == 400
+    assert client.get('/group_aggregation?by=Month').status_code == 404
+
+def test_filtered_aggregation(client, stores):
+    '''Ensure the SQLite store is summed over the filtered records only'''
+    encryption_obj, values = stores
+    response = client.get('/filtered_aggregation?first_id=2&filter=Region:North&filter=Region:East')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['records'] == 2
+    np.testing.assert_allclose(decrypted(encryption_obj, body)[:len(routes.financial_columns)],
+                               values[[2, 3]].sum(axis=0), rtol=1e-5)
+    assert client.get('/filtered_aggregation?filter=Region').status_code == 400
+    assert client.get('/filtered_aggregation?filter=Region:West').status_code == 404
+
+def test_statistics(client, stores):
+    '''Ensure the moments and a weighted sum come back as ciphertexts with the plaintext count'''
+    encryption_obj, values = stores
+    response = client.post('/statistics', json={'weights': {'half': {'1': 0.5, '2': 0.5}}})
+    assert response.status_code == 200
+    body = response.get_json()
+    n_columns = len(routes.financial_columns)
+    assert body['count'] == len(values)
+    np.testing.assert_allclose(decrypted(encryption_obj, body['data']['mean'])[:n_columns],
+                               values.mean(axis=0), rtol=1e-4)
+    np.testing.assert_allclose(decrypted(encryption_obj, body['data']['weighted_sums']['half'])[:n_columns],
+                               values[:2].mean(axis=0), rtol=1e-4)
+    assert client.post('/statistics', json={'weights': {'half': [1, 2]}}).status_code == 400
+
+def test_delete_record(client, stores):
+    '''Ensure a deleted record leaves the aggregate and cannot be deleted twice'''
+    encryption_obj, values = stores
+    assert client.get('/aggregation').status_code == 200
+    assert client.delete('/records/2').status_code == 200
+    assert client.delete('/records/2').status_code == 404
+    body = client.get('/aggregation').get_json()
+    np.testing.assert_allclose(decrypted(encryption_obj, body)[:len(routes.financial_columns)],
+                               np.delete(values, 1, axis=0).sum(axis=0), rtol=1e-5)
+    assert client.delete('/records/3?backend=sqlite').status_code == 200
+    assert client.get('/filtered_aggregation').get_json()['records'] == 4
+
+def test_writes_wait_for_ingest(client, stores):
+    '''Ensure /encrypt_all and DELETE /records answer 503 while another ingest holds the store'''
+    client.application.config['BULK_LOCK_TIMEOUT'] = 0.1
+    lock = ingest_lock(routes.encrypted_data_paths[ROW_LAYOUT])
+    with lock:
+        for response in (client.get('/encrypt_all'), client.delete('/records/1')):
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == str(client.application.config['BULK_RETRY_AFTER'])
+    assert client.delete('/records/1').status_code == 200
+    assert not lock.locked()
+
+def test_decrypt_all(client, stores):
+    '''Ensure the CSV and NPY exports stream every record and the summary returns the totals'''
+    _, values = stores
+    response = client.get('/decrypt_all')
+    assert response.status_code == 200 and response.is_streamed
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[0].startswith('Record ID,') and len(lines) == len(values) + 1
+    np.testing.assert_allclose(np.loadtxt(io.StringIO('\n'.join(lines[1:])), delimiter=',')[:, 1:],
+                               values, atol=0.01)
+
+    array = np.load(io.BytesIO(client.get('/decrypt_all?format=npy').get_data()))
+    assert list(array['Record ID']) == [1, 2, 3, 4, 5]
+    totals = client.get('/decrypt_all?format=summary').get_json()['totals']
+    np.testing.assert_allclose([totals[column] for column in routes.financial_columns],
+                               values.sum(axis=0), atol=0.05)
+    assert client.get('/decrypt_all?format=xml').status_code == 400
+
+def wait_for_job(client, job_id, timeout=30):
+    '''Poll a job through the API until it finishes'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f'/jobs/{job_id}').get_json()
+        if status['status'] in (DONE, FAILED):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+def test_jobs(client, stores):
+    '''Ensure background aggregate and decrypt jobs report their status and serve their results'''
+    encryption_obj, values = stores
+    response = client.post('/jobs', query_string={'kind': 'aggregate', 'columns': routes.financial_columns[0]})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert wait_for_job(client, job_id)['processed'] == len(values)
+    body = client.get(f'/jobs/{job_id}/result').get_json()
+    assert body['slots'] == [0]
+    assert abs(decrypted(encryption_obj, body)[0] - values[:, 0].sum()) < 1
+
+    job_id = client.post('/jobs?kind=decrypt&format=csv').get_json()['job_id']
+    wait_for_job(client, job_id)
+    response = client.get(f'/jobs/{job_id}/result')
+    assert response.status_code == 200
+    assert len(response.get_data(as_text=True).splitlines()) == len(values) + 1
+    response.close()
+    os.remove(job_result(job_id)[1]['path'])
+    assert client.post('/jobs?kind=unknown').status_code == 400
+    assert client.get('/jobs/unknown').status_code == 404
+
+def test_metrics(client, stores):
+    '''Ensure request latencies show up in the Prometheus exposition'''
+    client.get('/aggregation')
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert '# TYPE phe_request_seconds histogram' in text
+    assert 'phe_request_seconds_count{endpoint="main.aggregation"}' in text
+
+def test_aggregation_after_new_keys(client, stores, request):
+    '''Ensure the cached sum of a store from previous keys is not served after regenerating them'''
+    assert client.get('/aggregation').status_code == 200
+    request.getfixturevalue('key_dir')
+    assert client.post('/generate_keys?layout=row').status_code == 200
+    assert client.get('/aggregation').status_code == 500
+    assert client.get('/decrypt_all?format=summary').status_code == 500
+
+def test_tuned_keys_project_columns(client, key_dir, tmp_path, monkeypatch):
+    '''Ensure keys tuned for sums still leave the level a column projection needs'''
+    store_path = str(tmp_path / 'encrypted.bin')
+    monkeypatch.setitem(routes.encrypted_data_paths, ROW_LAYOUT, store_path)
+    response = client.post('/generate_keys?tune=true&layout=row&depth=0')
+    assert response.status_code == 200
+    assert len(response.get_json()['profile']['qi_sizes']) >= 3
+
+    encrypt_store(store_path)
+    column = routes.financial_columns[1]
+    response = client.get('/aggregation', query_string={'columns': column})
+    assert response.status_code == 200
+    assert response.get_json()['slots'] == [1]
+
+def test_projection_without_level(client, key_dir, tmp_path, monkeypatch):
+    '''Ensure a projection the keys leave no level for is answered with 409'''
+    store_path = str(tmp_path / 'encrypted.bin')
+    monkeypatch.setitem(routes.encrypted_data_paths, ROW_LAYOUT, store_path)
+    assert ensure_keys(regenerate=True, layout=ROW_LAYOUT, n_value=2**13, scale_bits=40, qi_sizes=[60, 60])
+    encrypt_store(store_path)
+
+    assert client.get('/aggregation').status_code == 200
+    response = client.get('/aggregation', query_string={'columns': routes.financial_columns[0]})
+    assert response.status_code == 409
+    assert 'No multiplicative level left' in response.get_json()['error']
@@ -0,0 +1,83 @@
+'''Module to test sharded aggregation with local worker processes standing in for nodes'''
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pytest
+from werkzeug.serving import make_server
+from app import create_app
+from app.encryption import load_context_public, load_secret, decrypt_value, deserialised
+from app.ingest import parallel_encrypt
+from app.sharding import split_shards, sharded_aggregate
+
+COLUMNS = ['Revenue (£)', 'Expenses (£)', 'Savings (£)', 'Investments (£)', 'Loans (£)']
+
+def serve_shard(store_path, ports):
+    '''Run a worker node for one shard on an ephemeral port'''
+    app = create_app()
+    app.config['SHARD_DATA_PATH'] = store_path
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+@pytest.fixture(scope='module')
+def shard_workers(tmp_path_factory):
+    '''Encrypt three shards of a synthetic dataset and serve each from its own process'''
+    rng = np.random.default_rng(0)
+    financial_data = pd.DataFrame(np.round(rng.uniform(0, 1000, (30, len(COLUMNS))), 2), columns=COLUMNS)
+    financial_data.insert(0, 'Record ID', np.arange(1, 31))
+    encryption_obj = load_context_public()
+
+    context = multiprocessing.get_context('fork')
+    ports = context.Queue()
+    processes = []
+    for index, shard in enumerate(split_shards(financial_data, 3)):
+        store_path = str(tmp_path_factory.mktemp('shards') / f'shard_{index}.bin')
+        parallel_encrypt(shard, store_path, encryption_obj, workers=1)
+        process = context.Process(target=serve_shard, args=(store_path, ports), daemon=True)
+        process.start()
+        processes.append(process)
+    urls = [f'http://127.0.0.1:{ports.get(timeout=30)}' for _ in processes]
+    yield urls, financial_data[COLUMNS].to_numpy().sum(axis=0)
+    for process in processes:
+        process.terminate()
+        process.join()
+
+def test_split_shards():
+    '''Ensure shards are disjoint and cover every record'''
+    financial_data = pd.DataFrame({'Record ID': range(1, 11), 'Revenue': range(10)})
+    shards = split_shards(financial_data, 3)
+    assert [len(shard) for shard in shards] == [3, 4, 3]
+    assert sorted(pd.concat(shards)['Record ID']) == list(range(1, 11))
+
+def test_sharded_aggregate(shard_workers):
+    '''Ensure partials from every worker reduce to the plaintext totals'''
+    urls, expected = shard_workers
+    encryption_obj = load_secret(load_context_public())
+    total, records, errors = sharded_aggregate(urls, encryption_obj)
+    assert errors == {}
+    assert sum(records.values()) == 30
+    np.testing.assert_allclose(decrypt_value(encryption_obj, total)[:len(COLUMNS)], expected, rtol=1e-5)
+
+    total, _, _ = sharded_aggregate(urls, encryption_obj, query={'columns': [COLUMNS[0], COLUMNS[4]]})
+    decrypted = decrypt_value(encryption_obj, total)[:len(COLUMNS)]
+    np.testing.assert_allclose(decrypted[[0, 4]], expected[[0, 4]], rtol=1e-5)
+    assert np.abs(decrypted[1:4]).max() < 1e-2
+
+def test_sharded_aggregation_route(shard_workers):
+    '''Ensure the coordinator route decrypts once and refuses a partial sum when a worker is down'''
+    urls, expected = shard_workers
+    app = create_app()
+    app.config['SHARD_URLS'] = urls
+    client = app.test_client()
+    response = client.get('/sharded_aggregation')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['records'] == 30 and body['shards'] == 3
+    encryption_obj = load_secret(load_context_public())
+    total = deserialised(body['data'], encryption_obj, body['mod_level'])
+    np.testing.assert_allclose(decrypt_value(encryption_obj, total)[:len(COLUMNS)], expected, rtol=1e-5)
+
+    app.config['SHARD_URLS'] = urls + ['http://127.0.0.1:9']
+    response = client.get('/sharded_aggregation')
+    assert response.status_code == 502
+    assert list(response.get_json()['shards']) == ['http://127.0.0.1:9']
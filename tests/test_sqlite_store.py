@@ -0,0 +1,80 @@
+'''Module to test the SQLite ciphertext store'''
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from Pyfhel import Pyfhel
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value
+from app.ingest import parallel_encrypt
+from app.sqlite_store import (
+    create_store,
+    append_records,
+    delete_record,
+    build_filter,
+    iter_records,
+    count_records,
+    filtered_aggregate,
+)
+from app import sqlite_store
+
+def test_build_filter():
+    '''Ensure ID bounds and dimension predicates become parameterised conditions'''
+    condition, parameters = build_filter(2, None, {'Region': ['North', 'South']})
+    assert condition.startswith('deleted = 0 AND record_id >= ?')
+    assert parameters == [2, 'Region', 'North', 'South']
+
+def test_append_and_filter(tmp_path, monkeypatch):
+    '''Ensure batched inserts stream back through indexed filters and deletions are skipped'''
+    monkeypatch.setattr('app.sqlite_store.FETCH_BATCH_SIZE', 2)
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.db')
+    create_store(store_path, encryption_obj, mod_level=1)
+
+    regions = ['North', 'South', 'North', 'East', 'South', 'North']
+    data = np.arange(1, 7, dtype=np.float64) * 10.5
+    records = [(record_id, encrypt_value(encryption_obj, value), {'Region': region})
+               for record_id, (value, region) in enumerate(zip(data, regions), 1)]
+    assert append_records(store_path, encryption_obj, records, batch_size=4) == 6
+
+    with sqlite3.connect(store_path) as connection:
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    record_ids = [record_id for record_id, _ in iter_records(store_path, encryption_obj)]
+    assert record_ids == [1, 2, 3, 4, 5, 6]
+    (_, ciphertext), = iter_records(store_path, encryption_obj, first_id=2, last_id=2)
+    assert ciphertext.mod_level == 1
+
+    assert delete_record(store_path, 3) == 1
+    assert count_records(store_path, where={'Region': 'North'}) == 2
+
+    total, n_records = filtered_aggregate(store_path, encryption_obj, first_id=2, where={'Region': ['North', 'South']})
+    assert n_records == 3
+    assert abs(decrypt_value(encryption_obj, total)[0] - (data[1] + data[4] + data[5])) < 1e-3
+    assert filtered_aggregate(store_path, encryption_obj, where={'Region': 'West'}) == (None, 0)
+
+def test_parallel_encrypt_into_sqlite(tmp_path):
+    '''Ensure the parallel ingest pipeline can write to the SQLite store'''
+    encryption_obj = load_secret(load_context_public())
+    financial_data = pd.DataFrame({
+        'Record ID': [1, 2, 3],
+        'Region': ['North', 'South', 'North'],
+        'Revenue': [100.5, 200.25, 300.0],
+    })
+    store_path = str(tmp_path / 'encrypted.db')
+    assert parallel_encrypt(financial_data, store_path, encryption_obj, workers=2,
+                            backend=sqlite_store)['rows'] == 3
+    total, n_records = filtered_aggregate(store_path, encryption_obj, where={'Region': 'North'})
+    assert n_records == 2
+    assert abs(decrypt_value(encryption_obj, total)[0] - 400.5) < 1e-3
+
+def test_fingerprint_mismatch(tmp_path):
+    '''Ensure a store written under another context is rejected'''
+    store_path = str(tmp_path / 'encrypted.db')
+    create_store(store_path, load_context_public())
+    other_obj = Pyfhel()
+    other_obj.contextGen(scheme='CKKS', n=2**13, scale=2**30, qi_sizes=[60, 30, 30, 60])
+    other_obj.keyGen()
+    with pytest.raises(ValueError):
+        list(iter_records(store_path, other_obj))
+    with pytest.raises(FileNotFoundError):
+        count_records(str(tmp_path / 'missing.db'))
@@ -0,0 +1,62 @@
+'''Module to test the homomorphic statistics engine'''
+import numpy as np
+import pytest
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value
+from app import statistics
+from app.statistics import encode_constant, parallel_statistics, decrypt_statistics
+from app.store import create_store, append_records
+
+def test_encode_constant_is_cached():
+    '''Ensure a constant is encoded once per mod level'''
+    encryption_obj = load_context_public()
+    encodings = {}
+    plaintext = encode_constant(encryption_obj, 0.5, 1, encodings)
+    assert plaintext.mod_level == 1
+    assert encode_constant(encryption_obj, 0.5, 1, encodings) is plaintext
+    assert encode_constant(encryption_obj, 0.5, 0, encodings) is not plaintext
+    assert len(encodings) == 2
+
+def test_encode_constant_cache_is_bounded(monkeypatch):
+    '''Ensure the least recently used constant is evicted once the cache is full'''
+    monkeypatch.setattr(statistics, 'MAX_ENCODINGS', 2)
+    encryption_obj = load_context_public()
+    encodings = {}
+    plaintext = encode_constant(encryption_obj, 0.5, 1, encodings)
+    encode_constant(encryption_obj, 0.25, 1, encodings)
+    assert encode_constant(encryption_obj, 0.5, 1, encodings) is plaintext
+    encode_constant(encryption_obj, 0.125, 1, encodings)
+    assert list(encodings) == [(0.5, 1), (0.125, 1)]
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_parallel_statistics(monkeypatch, tmp_path, workers):
+    '''Ensure one pass gives the plaintext count, mean, variance and weighted sums'''
+    monkeypatch.setattr('app.statistics.MIN_PARTITION_SIZE', 2)
+    encryption_obj = load_secret(load_context_public())
+
+    data = np.array([[1200.5, -30.0], [850.25, 12.5], [40.0, 7.75], [999.0, 0.0],
+                     [15.5, -2.25], [600.0, 45.0], [320.75, 3.0]])
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj, mod_level=1)
+    append_records(store_path, encryption_obj,
+                   ((record_id, encrypt_value(encryption_obj, row)) for record_id, row in enumerate(data, 1)))
+
+    weights = {'half': {record_id: 0.5 for record_id in range(1, 8)}, 'pair': {2: 2.0, 5: -1.0}}
+    moments = parallel_statistics(store_path, encryption_obj, weights=weights, workers=workers)
+    statistics = decrypt_statistics(encryption_obj, moments, 2)
+
+    assert statistics['count'] == 7
+    assert np.allclose(statistics['sum'], data.sum(axis=0), atol=1e-2)
+    assert np.allclose(statistics['mean'], data.mean(axis=0), atol=1e-2)
+    assert np.allclose(statistics['sum_of_squares'], (data ** 2).sum(axis=0), rtol=1e-5)
+    assert np.allclose(statistics['variance'], data.var(axis=0), rtol=1e-4)
+    assert np.allclose(statistics['weighted_sums']['half'], data.sum(axis=0) * 0.5, atol=1e-2)
+    assert np.allclose(statistics['weighted_sums']['pair'], 2.0 * data[1] - data[4], atol=1e-2)
+
+def test_empty_statistics(tmp_path):
+    '''Ensure an empty store has a zero count and no ciphertexts'''
+    encryption_obj = load_context_public()
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    moments = parallel_statistics(store_path, encryption_obj, weights={'w': {1: 1.0}})
+    assert moments['count'] == 0
+    assert moments['sum'] is None and moments['mean'] is None and moments['weighted_sums']['w'] is None
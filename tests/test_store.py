@@ -0,0 +1,121 @@
+'''Module to test the binary ciphertext store'''
+import numpy as np
+import pytest
+from Pyfhel import Pyfhel
+from app.encryption import load_context_public, load_secret, encrypt_value, decrypt_value
+from app.store import (
+    create_store,
+    append_records,
+    record_count,
+    read_header,
+    iter_raw_records,
+    iter_records,
+    index_path,
+    find_record,
+    delete_record,
+    configure_compression,
+    store_compression,
+    VERSION,
+)
+
+def test_append_and_stream(tmp_path):
+    '''Ensure appended ciphertexts stream back in order and decrypt correctly'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+
+    data = np.array([10.5, -10.5, 0.0, 42.42, 12345.678], dtype=np.float64)
+    assert append_records(store_path, encryption_obj,
+                          [(i, encrypt_value(encryption_obj, number)) for i, number in enumerate(data[:3])]) == 3
+    assert append_records(store_path, encryption_obj,
+                          [(i + 3, encrypt_value(encryption_obj, number)) for i, number in enumerate(data[3:])]) == 2
+    assert record_count(store_path) == 5
+
+    records = list(iter_records(store_path, encryption_obj))
+    assert [record_id for record_id, _ in records] == [0, 1, 2, 3, 4]
+    for (_, ciphertext), number in zip(records, data):
+        assert abs(decrypt_value(encryption_obj, ciphertext)[0] - number) < 1e-3
+
+    # Ranges read through the offset index
+    assert [record_id for record_id, _ in iter_raw_records(store_path, 1, 3)] == [1, 2]
+
+    # Deleted records are skipped by readers
+    delete_record(store_path, find_record(store_path, 2))
+    assert find_record(store_path, 2) is None
+    assert [record_id for record_id, _ in iter_raw_records(store_path)] == [0, 1, 3, 4]
+    assert record_count(store_path) == 5
+
+def test_store_id_changes_on_create(tmp_path):
+    '''Ensure recreating a store gives it a new id'''
+    encryption_obj = load_context_public()
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+    first_id = read_header(store_path)[2]
+    create_store(store_path, encryption_obj)
+    assert read_header(store_path)[2] != first_id
+
+def test_empty_store(tmp_path):
+    '''Ensure a new store has no records'''
+    encryption_obj = load_context_public()
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+
+    assert record_count(store_path) == 0
+    assert list(iter_records(store_path, encryption_obj)) == []
+    assert read_header(store_path)[0] == VERSION
+
+def test_fingerprint_mismatch(tmp_path):
+    '''Ensure a store cannot be read or extended with a different context'''
+    encryption_obj = load_context_public()
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj)
+
+    other_obj = Pyfhel()
+    other_obj.contextGen(scheme='CKKS', n=2**13, scale=2**30, qi_sizes=[60, 30, 60])
+    other_obj.keyGen()
+    with pytest.raises(ValueError):
+        list(iter_records(store_path, other_obj))
+    with pytest.raises(ValueError):
+        append_records(store_path, other_obj, [])
+
+def test_not_a_store(tmp_path):
+    '''Ensure files without the store header are rejected'''
+    store_path = tmp_path / 'encrypted.bin'
+    store_path.write_bytes(b'\0' * 64)
+    (tmp_path / 'encrypted.bin.idx').write_bytes(b'')
+    with pytest.raises(ValueError):
+        read_header(str(store_path))
+    assert index_path(str(store_path)) == str(store_path) + '.idx'
+
+def test_store_mod_level(tmp_path):
+    '''Ensure records are stored at the header mod level and read back at that level'''
+    encryption_obj = load_secret(load_context_public())
+    store_path = str(tmp_path / 'encrypted.bin')
+    create_store(store_path, encryption_obj, mod_level=1)
+    assert read_header(store_path).mod_level == 1
+
+    append_records(store_path, encryption_obj, [(1, encrypt_value(encryption_obj, 42.42))])
+    (_, ciphertext), = iter_records(store_path, encryption_obj)
+    assert ciphertext.mod_level == 1
+    total = ciphertext + encrypt_value(encryption_obj, 1.0)
+    assert abs(decrypt_value(encryption_obj, total)[0] - 43.42) < 1e-3
+
+def test_store_compression(tmp_path):
+    '''Ensure records written under different compression modes read back alike'''
+    encryption_obj = load_secret(load_context_public())
+    path = str(tmp_path / 'encrypted.bin')
+    create_store(path, encryption_obj)
+    default = store_compression()
+    try:
+        for record_id, compression in enumerate(('none', 'gzip', 'zstd'), start=1):
+            configure_compression(compression)
+            append_records(path, encryption_obj, [(record_id, encrypt_value(encryption_obj, float(record_id)))])
+        with pytest.raises(ValueError):
+            configure_compression('zlib')
+    finally:
+        configure_compression(default)
+
+    sizes = [len(payload) for _, payload in iter_raw_records(path)]
+    assert sizes[0] > sizes[2]
+    values = [decrypt_value(encryption_obj, ciphertext)[0] for _, ciphertext in iter_records(path, encryption_obj)]
+    np.testing.assert_allclose(values, [1.0, 2.0, 3.0], atol=1e-3)
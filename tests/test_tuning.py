@@ -0,0 +1,54 @@
+'''Module to test the CKKS parameter tuner'''
+import numpy as np
+import pandas as pd
+from app.tuning import (
+    SECURITY_BITS,
+    value_bits,
+    split_primes,
+    modulus_chain,
+    choose_parameters,
+    sample_frames,
+    tune_parameters,
+    save_profile,
+    load_profile,
+)
+
+def test_modulus_chain():
+    '''Ensure primes stay within SEAL limits and the special prime is the largest'''
+    assert value_bits(75000, 10**6) == 37
+    assert value_bits(75000, 10**6, depth=1) == 53
+    assert split_primes(76) == [38, 38]
+    assert split_primes(30) == [30]
+    chain = modulus_chain(30, 53, depth=1)
+    assert chain == [47, 47, 30, 47]
+    assert all(bits <= 60 for bits in chain)
+
+def test_choose_parameters():
+    '''Ensure the smallest secure ring keeps a rescale level and larger workloads move up'''
+    n_value, scale, qi_sizes = choose_parameters(75000, 10, n_columns=5)
+    assert n_value == 2**13 and sum(qi_sizes) <= SECURITY_BITS[n_value]
+    assert len(qi_sizes) == 3 and qi_sizes[-2] == scale
+    n_value, scale, qi_sizes = choose_parameters(75000, 10**6, n_columns=5, depth=1)
+    assert n_value == 2**13 and qi_sizes[-2] == scale
+    assert choose_parameters(75000, 100, n_columns=2**15) is None
+
+def test_tune_parameters(tmp_path, monkeypatch):
+    '''Ensure the tuned profile passes its sample check and round trips through the key directory'''
+    values = np.random.default_rng(0).uniform(0, 100000, (100, 5))
+    profile = tune_parameters(values, expected_records=10**4, depth=1, precision=0.01)
+    assert profile['n_value'] < 2**14
+    assert profile['checked_error_ratio'] <= 1
+    assert profile['value_bits'] == value_bits(values.max(), 10**4, depth=1)
+
+    monkeypatch.setattr('app.tuning.KEY_DIR', str(tmp_path))
+    assert load_profile() is None
+    save_profile(profile)
+    assert load_profile() == profile
+
+def test_sample_frames():
+    '''Ensure streamed frames give the leading sample, the overall max |value| and the row count'''
+    frame = pd.DataFrame({'Record ID': np.arange(50), 'Revenue': np.arange(50.0), 'Loans': -np.arange(50.0)})
+    sample, max_abs, n_rows = sample_frames([frame, frame.assign(Loans=-1000.0)], ['Revenue', 'Loans'])
+    assert sample.shape == (64, 2)
+    np.testing.assert_array_equal(sample[50:], [[index, -1000.0] for index in range(14)])
+    assert max_abs == 1000.0 and n_rows == 100